@@ -0,0 +1,153 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+__version__ = "0.1.0"
+
+# Columns of the ontology tables (as in generate_ontology_tables, which is only imported when building the tables)
+SUBJECT_COL = "Subject"
+OBJECT_COL = "Object"
+DISEASE_LOCATION_COL = "DiseaseLocation"
+LOCATION_COL = "Location"
+
+# Relations along which anatomical sites contain the disease locations below them: subClassOf and 'part of'
+LOCATION_CLOSURE_PREDICATES = ("rdfs:subClassOf", "BFO:0000050")
+
+# Columns of the mappings table copied into the location index, which are those of the search results
+MAPPING_COLUMNS = ("SourceTermID", "SourceTerm", "MappedTermLabel", "MappedTermCURIE", "MappingScore")
+
+
+def get_disease_locations_table_name(ontology_name):
+    return ontology_name + "_disease_locations"
+
+
+def get_location_closure_table_name(ontology_name):
+    return ontology_name + "_location_closure"
+
+
+def get_location_resources_table_name(dataset_name):
+    return dataset_name + "_location_resources"
+
+
+def get_disease_locations_table(labels_df):
+    """
+    Get the (term, location) pairs of the disease locations of the terms in the given labels table, whose
+    'DiseaseLocation' column has the comma-separated locations of each term (see disease_locations)
+    :return: data frame with 'Subject' (term) and 'Location' columns, with one row per pair
+    """
+    from generate_ontology_tables import fix_identifiers
+    locations = labels_df[[SUBJECT_COL, DISEASE_LOCATION_COL]].dropna()
+    locations = locations.assign(**{LOCATION_COL: locations[DISEASE_LOCATION_COL].str.split(",")})
+    locations = locations.explode(LOCATION_COL)[[SUBJECT_COL, LOCATION_COL]]
+    locations[LOCATION_COL] = locations[LOCATION_COL].str.strip()
+    locations = locations[locations[LOCATION_COL] != ""]
+    locations = fix_identifiers(locations, columns=[LOCATION_COL])
+    return locations.drop_duplicates().reset_index(drop=True)
+
+
+# Get the anatomical sites that contain each of the given locations, from the entailed edges of the given predicates
+#  (by default subClassOf and part-of) in the SemanticSQL database of an anatomy ontology, e.g. the pancreas and the
+#  abdomen for the islets of Langerhans. Each location is also a site of its own, whether or not it is in the ontology
+def get_location_closure_table(semsql_db_file, locations, predicates=LOCATION_CLOSURE_PREDICATES):
+    from generate_ontology_tables import fix_identifiers, connect_semsql_db
+    connection = connect_semsql_db(semsql_db_file)
+    try:
+        closure_df = pd.read_sql_query(f"SELECT DISTINCT subject, object FROM entailed_edge "
+                                       f"WHERE predicate IN ({', '.join('?' * len(predicates))}) "
+                                       f"AND substr(object, 1, 2) != '_:'", connection, params=tuple(predicates))
+    finally:
+        connection.close()
+    closure_df = closure_df.rename(columns={"subject": SUBJECT_COL, "object": OBJECT_COL})
+    closure_df = fix_identifiers(closure_df, columns=[SUBJECT_COL, OBJECT_COL])
+    locations = pd.Series(pd.unique(pd.Series(locations, dtype=object)), dtype=object)
+    closure_df = closure_df[closure_df[SUBJECT_COL].isin(locations)]
+    closure_df = pd.concat([pd.DataFrame({SUBJECT_COL: locations, OBJECT_COL: locations}), closure_df])
+    return closure_df.drop_duplicates().reset_index(drop=True)
+
+
+# Build the index of resources by the anatomical sites of the diseases they are mapped to, from the mappings table and
+#  the disease locations and location closure tables (see get_disease_locations_table and get_location_closure_table).
+#  Each row has a site, a mapping of a term located in the site, and the location of the term within the site. The
+#  table is clustered by site (a WITHOUT ROWID table keyed by site first), so the resources of a site are read by a
+#  single range lookup of its key
+def build_location_index(connection, dataset_name, ontology_name):
+    start = time.time()
+    table_name = get_location_resources_table_name(dataset_name)
+    columns = ", ".join(f"m.{column}" for column in MAPPING_COLUMNS)
+    with connection:
+        connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+        connection.execute(f"""CREATE TABLE {table_name} (
+                                   Site TEXT, SourceTermID TEXT, SourceTerm TEXT, MappedTermLabel TEXT,
+                                   MappedTermCURIE TEXT, MappingScore REAL, DiseaseLocation TEXT,
+                                   PRIMARY KEY (Site, SourceTermID, MappedTermCURIE, DiseaseLocation)) WITHOUT ROWID""")
+        row_count = connection.execute(
+            f"""INSERT OR IGNORE INTO {table_name}
+                SELECT c.{OBJECT_COL}, {columns}, dl.{LOCATION_COL}
+                FROM {dataset_name}_mappings m
+                JOIN {get_disease_locations_table_name(ontology_name)} dl ON dl.{SUBJECT_COL} = m.MappedTermCURIE
+                JOIN {get_location_closure_table_name(ontology_name)} c ON c.{SUBJECT_COL} = dl.{LOCATION_COL}
+                WHERE m.SourceTermID IS NOT NULL""").rowcount
+    print(f"Built index of {row_count} resources by anatomical site ({time.time() - start:.1f} seconds)")
+
+
+# Get the query of the resources whose mapped terms are located in the :site parameter or, if include_parts is True,
+#  in any of its parts or subclasses. The location of each term within the site is given in the 'DiseaseLocation'
+#  column, so a resource mapped to a term with more than one location in the site is listed once per location
+def get_location_search_query(dataset_name, include_parts=True):
+    return f"""SELECT
+                    m.SourceTermID AS 'OpenGWASID',
+                    m.SourceTerm AS 'OpenGWASTrait',
+                    m.MappedTermLabel AS 'OntologyTerm',
+                    m.MappedTermCURIE AS 'OntologyTermID',
+                    m.MappingScore AS 'MappingConfidence',
+                    m.DiseaseLocation AS 'DiseaseLocation'
+                FROM {get_location_resources_table_name(dataset_name)} m
+                WHERE m.Site = :site{"" if include_parts else " AND m.DiseaseLocation = :site"}
+                ORDER BY m.SourceTermID, m.MappedTermCURIE, m.DiseaseLocation"""
+
+
+# Get the query that answers the same searches as get_location_search_query without the location index, by joining
+#  the mappings, disease locations and location closure tables when searching
+def _get_unindexed_location_query(dataset_name, ontology_name):
+    return f"""SELECT m.SourceTermID, m.SourceTerm, m.MappedTermLabel, m.MappedTermCURIE, m.MappingScore,
+                    dl.{LOCATION_COL}
+                FROM {get_location_closure_table_name(ontology_name)} c
+                JOIN {get_disease_locations_table_name(ontology_name)} dl ON dl.{LOCATION_COL} = c.{SUBJECT_COL}
+                JOIN {dataset_name}_mappings m ON m.MappedTermCURIE = dl.{SUBJECT_COL}
+                WHERE c.{OBJECT_COL} = :site AND m.SourceTermID IS NOT NULL
+                GROUP BY m.SourceTermID, m.MappedTermCURIE, dl.{LOCATION_COL}
+                ORDER BY m.SourceTermID, m.MappedTermCURIE, dl.{LOCATION_COL}"""
+
+
+# Compare the latencies of searches of the anatomical sites with the most resources using the location index versus
+#  joining the disease location and closure tables when searching, and check that both give the same resources
+def benchmark_location_search(database_file, dataset_name="opengwas", ontology_name="efo", site_count=20,
+                              repetitions=5):
+    from query_database import SearchEngine
+    with SearchEngine(database_file, dataset_name=dataset_name, ontology_name=ontology_name) as engine:
+        sites = [row[0] for row in engine.connection.execute(
+            f"SELECT Site FROM {get_location_resources_table_name(dataset_name)} GROUP BY Site "
+            f"ORDER BY COUNT(*) DESC, Site LIMIT ?", (site_count,))]
+        unindexed_query = _get_unindexed_location_query(dataset_name, ontology_name)
+        latencies = {"location index": [], "joins": []}
+        mismatches = 0
+        for _ in range(repetitions):
+            for site in sites:
+                start = time.perf_counter()
+                indexed_results = engine.resources_located_in(site)
+                latencies["location index"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                joined_results = engine.connection.execute(unindexed_query, {"site": site}).fetchall()
+                latencies["joins"].append(time.perf_counter() - start)
+                mismatches += indexed_results.values.tolist() != [list(row) for row in joined_results]
+        print(f"Searches of the {len(sites)} anatomical sites with the most resources in {database_file}:")
+        for method, method_latencies in latencies.items():
+            p50, p95 = np.percentile(method_latencies, [50, 95]) * 1000
+            print(f"\t{method}: p50 {p50:.2f} ms, p95 {p95:.2f} ms")
+        print(f"\tsites with different results: {mismatches}")
+        return mismatches
+
+
+if __name__ == "__main__":
+    benchmark_location_search(sys.argv[1] if len(sys.argv) > 1 else "../opengwas_search.db")
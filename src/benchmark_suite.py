@@ -0,0 +1,403 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import itertools
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime
+import generate_ontology_tables
+from generate_ontology_tables import get_semsql_tables_for_ontology, fix_identifiers, SUBJECT_COL, OBJECT_COL
+from generate_mapping_report import get_term_resources_from_edges, get_mapping_counts_from_term_resources
+from build_database import import_df_to_db, configure_build_connection, finalize_database
+from query_database import SearchEngine
+
+__version__ = "0.1.0"
+
+# Sizes of today's data (1x): the number of EFO classes, and the number of OpenGWAS records (of which about half are
+#  mapped to EFO terms)
+BASE_TERM_COUNT = 40000
+BASE_RECORD_COUNT = 22000
+DEFAULT_SCALES = (1, 10, 100)
+
+BENCHMARKS_FOLDER = "../benchmarks/"
+HISTORY_FILE = BENCHMARKS_FOLDER + "benchmark_history.jsonl"
+EXAMPLE_QUERY_FOLDER = "../test/example_query/"
+
+# A stage is reported as a regression if it takes this many times longer than the median of its last HISTORY_WINDOW
+#  runs at the same scale, and at least REGRESSION_MIN_SECONDS longer (so that noise in fast stages is ignored)
+REGRESSION_THRESHOLD = 1.25
+REGRESSION_MIN_SECONDS = 0.05
+HISTORY_WINDOW = 5
+
+QUERY_TERM_COUNT = 100
+SEARCH_MODES = {"exact": (False, False), "direct_subclasses": (True, True), "inferred_subclasses": (True, False)}
+
+SEMSQL_COLUMNS = ("stanza", "subject", "predicate", "object", "value", "datatype", "language", "graph")
+DISEASE_LOCATION_PROPERTY = "EFO:0000784"
+LABEL_WORDS = ("acute", "chronic", "juvenile", "familial", "congenital", "primary", "secondary", "hereditary",
+               "disease", "disorder", "syndrome", "carcinoma", "deficiency", "measurement", "levels", "cancer",
+               "pancreas", "liver", "heart", "lung", "kidney", "brain", "skin", "blood", "bone", "eye")
+RECORD_ID_PREFIXES = ("ieu-a", "ieu-b", "ukb-a", "ukb-b", "ukb-d", "finn-b", "ebi-a", "bbj-a", "prot-a", "met-c")
+
+
+# Get the identifier of the i-th term of a synthetic ontology. As in SemanticSQL builds of EFO, most terms are given
+#  as CURIEs and some as IRIs (which fix_identifiers then converts to CURIEs)
+def _get_synthetic_term(index):
+    if index % 20 == 1:
+        return f"http://purl.obolibrary.org/obo/MONDO_{index:07d}"
+    if index % 20 == 2:
+        return f"http://www.orpha.net/ORDO/Orphanet_{index}"
+    return f"EFO:{index:07d}"
+
+
+def generate_semsql_database(database_file, term_count, seed=0):
+    """
+    Generate a synthetic SemanticSQL database of an ontology with the given number of classes, with the tables and
+    views read by generate_ontology_tables: statements (labels, synonyms, cross-references, deprecations and disease
+    location restrictions), edge, entailed_edge (the reflexive transitive closure of edge, computed in SQL) and the
+    views over statements. Every class but the root has a parent in a 4-ary tree, and a quarter have a second parent
+    """
+    rng = np.random.default_rng(seed)
+    if os.path.isfile(database_file):
+        os.remove(database_file)
+    connection = sqlite3.connect(database_file)
+    configure_build_connection(connection)
+    terms = [_get_synthetic_term(index) for index in range(term_count)]
+    parents = [[] if index == 0 else [terms[(index - 1) // 4]] for index in range(term_count)]
+    for index in np.flatnonzero(rng.random(term_count) < 0.25):
+        if index > 1:
+            second_parent = terms[rng.integers(0, index)]
+            if second_parent not in parents[index]:
+                parents[index].append(second_parent)
+    words = rng.integers(0, len(LABEL_WORDS), size=(term_count, 3))
+
+    statements = [("efo", "efo", "owl:versionInfo", None, "synthetic", "xsd:string", None, None)]
+    for index, term in enumerate(terms):
+        label = f"{LABEL_WORDS[words[index, 0]]} {LABEL_WORDS[words[index, 1]]} {LABEL_WORDS[words[index, 2]]} {index}"
+        statements.append((term, term, "rdf:type", "owl:Class", None, None, None, None))
+        statements.append((term, term, "rdfs:label", None, label, "xsd:string", None, None))
+        statements.extend((term, term, "rdfs:subClassOf", parent, None, None, None, None) for parent in parents[index])
+        if index % 3 == 0:
+            statements.append((term, term, "oio:hasExactSynonym", None, f"{label} synonym", "xsd:string", None, None))
+        if index % 5 < 2:
+            statements.append((term, term, "oio:hasDbXref", None, f"MESH:D{index:06d}", "xsd:string", None, None))
+        if index % 50 == 7:
+            statements.append((term, term, "owl:deprecated", None, "true", "xsd:boolean", None, None))
+        if index % 20 == 3:  # disease location restriction (existential, or universal for every 10th)
+            restriction = f"_:location{index}"
+            filler = "owl:allValuesFrom" if index % 200 == 3 else "owl:someValuesFrom"
+            statements.append((term, term, "rdfs:subClassOf", restriction, None, None, None, None))
+            statements.append((term, restriction, "owl:onProperty", DISEASE_LOCATION_PROPERTY, None, None, None, None))
+            statements.append((term, restriction, filler, f"UBERON:{index % 997:07d}", None, None, None, None))
+    with connection:
+        connection.execute(f"CREATE TABLE statements ({', '.join(f'{column} TEXT' for column in SEMSQL_COLUMNS)})")
+        connection.executemany(f"INSERT INTO statements VALUES ({', '.join('?' * len(SEMSQL_COLUMNS))})", statements)
+        connection.execute("CREATE TABLE edge (subject TEXT, predicate TEXT, object TEXT)")
+        connection.executemany("INSERT INTO edge VALUES (?, 'rdfs:subClassOf', ?)",
+                               ((term, parent) for term, term_parents in zip(terms, parents)
+                                for parent in term_parents))
+        connection.execute("CREATE INDEX edge_subject ON edge (subject)")
+        connection.execute("CREATE TABLE entailed_edge (subject TEXT, predicate TEXT, object TEXT)")
+        connection.execute("""INSERT INTO entailed_edge
+                              WITH RECURSIVE ancestors(subject, object) AS (
+                                  SELECT subject, subject FROM statements WHERE predicate = 'rdf:type'
+                                  UNION
+                                  SELECT a.subject, e.object FROM ancestors a JOIN edge e ON e.subject = a.object)
+                              SELECT subject, 'rdfs:subClassOf', object FROM ancestors""")
+        connection.execute("CREATE VIEW has_exact_synonym_statement AS "
+                           "SELECT * FROM statements WHERE predicate = 'oio:hasExactSynonym'")
+        connection.execute("CREATE VIEW has_dbxref_statement AS SELECT stanza, subject, predicate, object, value, "
+                           "datatype, language FROM statements WHERE predicate = 'oio:hasDbXref'")
+        connection.execute("CREATE VIEW owl_some_values_from AS "
+                           "SELECT onProperty.subject AS id, onProperty.object AS on_property, f.object AS filler "
+                           "FROM statements AS onProperty, statements AS f WHERE onProperty.predicate = "
+                           "'owl:onProperty' AND onProperty.subject = f.subject AND f.predicate = 'owl:someValuesFrom'")
+        connection.execute("CREATE VIEW owl_subclass_of_some_values_from AS "
+                           "SELECT subClassOf.stanza, subClassOf.subject, svf.on_property AS predicate, "
+                           "svf.filler AS object FROM statements AS subClassOf, owl_some_values_from AS svf "
+                           "WHERE subClassOf.predicate = 'rdfs:subClassOf' AND svf.id = subClassOf.object")
+    connection.close()
+
+
+def generate_opengwas_tables(labels_df, record_count, seed=0):
+    """
+    Generate synthetic OpenGWAS metadata with the given number of records, and mappings of their traits to the terms
+    in the given labels table. Traits are drawn such that a few terms are very common (as 'body mass index' is), and
+    about half of the records are mapped
+    :return: metadata and mappings data frames, with the columns of the tables built by build_database
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, len(labels_df) + 1) ** 0.8
+    term_rows = rng.permutation(len(labels_df))[rng.choice(len(labels_df), size=record_count,
+                                                           p=weights / weights.sum())]
+    terms_df = labels_df.iloc[term_rows].reset_index(drop=True)
+    prefixes = np.asarray(RECORD_ID_PREFIXES)[rng.integers(0, len(RECORD_ID_PREFIXES), size=record_count)]
+    metadata_df = pd.DataFrame({
+        "id": [f"{prefix}-{index}" for prefix, index in zip(prefixes, range(record_count))],
+        "trait": terms_df[OBJECT_COL].str.capitalize().values,
+        "pmid": rng.integers(20000000, 38000000, size=record_count).astype(str),
+        "year": rng.integers(2008, 2024, size=record_count),
+        "population": rng.choice(["European", "East Asian", "African", "Mixed"], size=record_count),
+        "sample_size": rng.integers(1000, 500000, size=record_count)})
+    mapped = rng.random(record_count) < 0.5
+    mappings_df = pd.DataFrame({
+        "SourceTermID": metadata_df["id"].values[mapped],
+        "SourceTerm": metadata_df["trait"].values[mapped],
+        "MappedTermLabel": terms_df[OBJECT_COL].values[mapped],
+        "MappedTermCURIE": terms_df[SUBJECT_COL].values[mapped],
+        "MappedTermIRI": terms_df["IRI"].values[mapped],
+        "MappingScore": np.round(rng.uniform(0.6, 1.0, size=mapped.sum()), 3),
+        "Tags": None})
+    return metadata_df, mappings_df
+
+
+# Time a call of function(*args, **kwargs), and add the time taken (and the given number of rows, if any) to results
+def _time_stage(results, stage, function, *args, rows=None, **kwargs):
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    results[stage] = {"seconds": round(time.perf_counter() - start, 4)}
+    if rows is not None:
+        results[stage]["rows"] = rows(value) if callable(rows) else rows
+    print(f"\t{stage}: {results[stage]['seconds']:.3f} seconds" +
+          (f" ({results[stage]['rows']} rows)" if rows is not None else ""))
+    return value
+
+
+def run_benchmarks(scale, work_folder, seed=0, query_term_count=QUERY_TERM_COUNT):
+    """
+    Build a search database from synthetic data of the given scale (relative to today's data), timing each stage of
+    the build and then the searches of each subclass mode
+    :return: dictionary of the seconds taken by each stage (and the number of rows it processed, and for searches,
+        the median and 95th percentile latencies)
+    """
+    term_count, record_count = int(BASE_TERM_COUNT * scale), int(BASE_RECORD_COUNT * scale)
+    print(f"Benchmarking scale {scale}x ({term_count} ontology terms, {record_count} records)...")
+    os.makedirs(work_folder, exist_ok=True)
+    semsql_db_file = os.path.join(work_folder, f"synthetic_{scale}x.db")
+    search_db_file = os.path.join(work_folder, f"synthetic_{scale}x_search.db")
+    results = {}
+    _time_stage(results, "generate_semsql_database", generate_semsql_database, semsql_db_file, term_count, seed=seed)
+
+    # Extract the ontology tables, with a new (empty) CURIE normalizer, as in a new build
+    generate_ontology_tables._curie_normalizer = None
+    edges_df, entailed_edges_df, labels_df, _, synonyms_df, _ = _time_stage(
+        results, "get_semsql_tables_for_ontology", get_semsql_tables_for_ontology,
+        ontology_url=Path(semsql_db_file).resolve().as_uri(), ontology_name=f"SYNTHETIC_{scale}X",
+        db_output_folder=work_folder, cache_folder=os.path.join(work_folder, "semsql_cache"),
+        include_disease_locations=True, rows=lambda tables: sum(len(table) for table in tables[:5]))
+    with sqlite3.connect(semsql_db_file) as connection:
+        raw_edges_df = pd.read_sql_query("SELECT subject AS Subject, object AS Object FROM entailed_edge", connection)
+    generate_ontology_tables._curie_normalizer = None
+    _time_stage(results, "fix_identifiers", fix_identifiers, raw_edges_df, columns=[SUBJECT_COL, OBJECT_COL],
+                rows=len(raw_edges_df))
+
+    metadata_df, mappings_df = _time_stage(results, "generate_opengwas_tables", generate_opengwas_tables, labels_df,
+                                           record_count, seed=seed, rows=lambda tables: len(tables[1]))
+    if os.path.isfile(search_db_file):
+        os.remove(search_db_file)
+    connection = sqlite3.connect(search_db_file)
+    configure_build_connection(connection)
+    tables = {"opengwas_metadata": metadata_df, "opengwas_mappings": mappings_df, "efo_edges": edges_df,
+              "efo_entailed_edges": entailed_edges_df, "efo_synonyms": synonyms_df}
+
+    def import_tables():
+        for table_name, table_df in tables.items():
+            import_df_to_db(connection, data_frame=table_df, table_name=table_name)
+    _time_stage(results, "import_df_to_db", import_tables, rows=sum(len(table_df) for table_df in tables.values()))
+
+    def get_mapping_counts():
+        _, term_resources_df = get_term_resources_from_edges(mappings_df=mappings_df, terms_df=labels_df,
+                                                             edges_df=edges_df, source_term_id_col="SourceTermID",
+                                                             mapped_term_iri_col="MappedTermIRI",
+                                                             resources=metadata_df["id"])
+        return get_mapping_counts_from_term_resources(term_resources_df)
+    counts_df = _time_stage(results, "get_mapping_counts", get_mapping_counts, rows=len(mappings_df))
+    import_df_to_db(connection, data_frame=pd.merge(labels_df, counts_df, on="IRI"), table_name="efo_labels")
+    _time_stage(results, "finalize_database", finalize_database, connection,
+                indexed_columns={"opengwas_mappings": ["MappedTermCURIE", "SourceTermID"],
+                                 "efo_edges": ["Subject", ("Object", "Subject")],
+                                 "efo_entailed_edges": ["Subject", ("Object", "Subject")]})
+    connection.close()
+
+    # Search the most frequently mapped terms and as many random terms (with and without mappings)
+    with SearchEngine(search_db_file) as engine:
+        search_terms = [row[0] for row in engine.connection.execute(
+            "SELECT Subject FROM efo_labels ORDER BY Direct + Inherited DESC, Subject LIMIT ?", (query_term_count,))]
+        search_terms += np.random.default_rng(seed).choice(labels_df[SUBJECT_COL].values, size=query_term_count,
+                                                           replace=False).tolist()
+        for mode, (include_subclasses, direct_subclasses_only) in SEARCH_MODES.items():
+            latencies, result_count = [], 0
+            for search_term in search_terms:
+                start = time.perf_counter()
+                result_count += len(engine.resources_annotated_with_term(search_term, include_subclasses,
+                                                                         direct_subclasses_only))
+                latencies.append(time.perf_counter() - start)
+            p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+            stage = f"resources_annotated_with_term[{mode}]"
+            results[stage] = {"seconds": round(sum(latencies), 4), "rows": result_count,
+                              "p50_ms": round(p50, 3), "p95_ms": round(p95, 3)}
+            print(f"\t{stage}: {sum(latencies):.3f} seconds for {len(search_terms)} searches "
+                  f"(p50 {p50:.2f} ms, p95 {p95:.2f} ms, {result_count} results)")
+    return results
+
+
+# Get the commit of the code being benchmarked, if it is in a git repository
+def _get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def read_history(history_file=HISTORY_FILE):
+    if not os.path.isfile(history_file):
+        return []
+    with open(history_file) as file_in:
+        return [json.loads(line) for line in file_in if line.strip() != ""]
+
+
+def append_history(run, history_file=HISTORY_FILE):
+    os.makedirs(os.path.dirname(history_file) or ".", exist_ok=True)
+    with open(history_file, "a") as file_out:
+        file_out.write(json.dumps(run) + "\n")
+
+
+def find_regressions(run, history, threshold=REGRESSION_THRESHOLD, window=HISTORY_WINDOW):
+    """
+    Compare the stage timings of the given run with the median of the last runs (at most window runs) at the same
+    scale in the given history
+    :return: list of (stage, seconds, median seconds of the previous runs) of the stages that got slower
+    """
+    previous_runs = [previous for previous in history if previous["scale"] == run["scale"]][-window:]
+    regressions = []
+    for stage, result in run["results"].items():
+        previous_seconds = [previous["results"][stage]["seconds"] for previous in previous_runs
+                            if stage in previous["results"]]
+        if len(previous_seconds) == 0:
+            continue
+        median_seconds = float(np.median(previous_seconds))
+        if result["seconds"] > median_seconds * threshold and \
+                result["seconds"] - median_seconds > REGRESSION_MIN_SECONDS:
+            regressions.append((stage, result["seconds"], median_seconds))
+    return regressions
+
+
+def build_reference_database(database_file, resources_folder="../resources/"):
+    """
+    Build a search database from the mappings, ontology edges and labels bundled in the resources folder, whose
+    searches give the results in the example query folder. The inferred subclass edges are the reflexive transitive
+    closure of the asserted edges (which are saved in efo_entailed_edges.tsv by generate_ontology_tables)
+    """
+    mappings_file = os.path.join(resources_folder, "opengwas_mappings.csv")
+    mappings_df = pd.read_csv(mappings_file, skiprows=_count_header_comment_lines(mappings_file))
+    mappings_df.columns = mappings_df.columns.str.replace(" ", "")
+    edges_df = pd.read_csv(os.path.join(resources_folder, "efo_entailed_edges.tsv"), sep="\t")
+    labels_df = pd.read_csv(os.path.join(resources_folder, "efo_labels.tsv"), sep="\t")
+    if os.path.isfile(database_file):
+        os.remove(database_file)
+    connection = sqlite3.connect(database_file)
+    configure_build_connection(connection)
+    import_df_to_db(connection, data_frame=mappings_df, table_name="opengwas_mappings")
+    import_df_to_db(connection, data_frame=edges_df, table_name="efo_edges")
+    import_df_to_db(connection, data_frame=labels_df, table_name="efo_labels")
+    with connection:
+        connection.execute("CREATE INDEX idx_efo_edges_Subject ON efo_edges (Subject)")
+        connection.execute("CREATE TABLE efo_entailed_edges (`Subject` TEXT, `Object` TEXT)")
+        connection.execute("""INSERT INTO efo_entailed_edges
+                              WITH RECURSIVE ancestors(Subject, Object) AS (
+                                  SELECT Subject, Subject FROM efo_labels
+                                  UNION SELECT Subject, Subject FROM efo_edges
+                                  UNION SELECT Object, Object FROM efo_edges
+                                  UNION
+                                  SELECT a.Subject, e.Object FROM ancestors a JOIN efo_edges e ON e.Subject = a.Object)
+                              SELECT Subject, Object FROM ancestors""")
+    finalize_database(connection, indexed_columns={"opengwas_mappings": ["MappedTermCURIE", "SourceTermID"],
+                                                   "efo_edges": [("Object", "Subject")],
+                                                   "efo_entailed_edges": ["Subject", ("Object", "Subject")]})
+    connection.close()
+
+
+# Count the '#' comment lines at the top of the given file (e.g. the run details that text2term writes before the
+#  mappings). Only these are skipped, as values in the rows below may start with '#' too (e.g. the trait '#Arthrosis')
+def _count_header_comment_lines(file):
+    with open(file) as file_in:
+        return sum(1 for _ in itertools.takewhile(lambda line: line.startswith("#"), file_in))
+
+
+def check_example_queries(database_file, example_query_folder=EXAMPLE_QUERY_FOLDER):
+    """
+    Run the searches in the example query folder (whose .txt files have the query parameters and results count, and
+    .tsv files the results, as written by query_database.do_example_query) and compare their results
+    :return: list of the example queries whose results differ
+    """
+    mismatches = []
+    with SearchEngine(database_file) as engine:
+        for parameters_file in sorted(Path(example_query_folder).glob("*.txt")):
+            parameters = {}
+            for line in parameters_file.read_text().splitlines():
+                name, _, value = line.partition("=")
+                if line.startswith("# query results count:"):
+                    parameters["count"] = int(line.rsplit(":", 1)[1])
+                elif value != "":
+                    parameters[name.strip()] = value.strip().strip("'")
+            results_df = engine.resources_annotated_with_term(parameters["search_term"],
+                                                              parameters["include_subclasses"] == "True",
+                                                              parameters["direct_subclasses_only"] == "True")
+            results_file = parameters_file.with_suffix(".tsv")
+            same_results = len(results_df) == parameters["count"] and (
+                not results_file.is_file() or results_df.to_csv(sep="\t", index=False) == results_file.read_text())
+            print(f"\t{parameters_file.stem}: {len(results_df)} results ({'OK' if same_results else 'MISMATCH'})")
+            if not same_results:
+                mismatches.append(parameters_file.stem)
+    return mismatches
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the build and search of synthetic search databases")
+    parser.add_argument("--scales", type=float, nargs="+", default=list(DEFAULT_SCALES),
+                        help="sizes of the synthetic data, relative to today's EFO and OpenGWAS sizes")
+    parser.add_argument("--work-folder", default=BENCHMARKS_FOLDER + "work",
+                        help="folder for the synthetic databases")
+    parser.add_argument("--history-file", default=HISTORY_FILE)
+    parser.add_argument("--golden-database", default="",
+                        help="search database to check the example queries against (by default, a database built "
+                             "from the bundled resources)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+# Check the example queries, run the benchmarks at each scale, report any regressions against the history of previous
+#  runs and add the results to the history. Exits with status 1 if any example query failed or any stage regressed
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    print("Checking example queries...")
+    golden_database = arguments.golden_database
+    if golden_database == "":
+        os.makedirs(arguments.work_folder, exist_ok=True)
+        golden_database = os.path.join(arguments.work_folder, "reference_search.db")
+        build_reference_database(golden_database)
+    failed_queries = check_example_queries(golden_database)
+
+    history = read_history(arguments.history_file)
+    all_regressions = []
+    for scale in arguments.scales:
+        scale = int(scale) if float(scale).is_integer() else scale
+        run = {"timestamp": datetime.now().isoformat(timespec="seconds"), "commit": _get_git_commit(),
+               "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "scale": scale,
+               "results": run_benchmarks(scale, arguments.work_folder, seed=arguments.seed)}
+        regressions = find_regressions(run, history)
+        for stage, seconds, median_seconds in regressions:
+            print(f"REGRESSION at scale {scale}x: {stage} took {seconds:.3f} seconds (median of previous runs: "
+                  f"{median_seconds:.3f} seconds)")
+        all_regressions.extend(regressions)
+        append_history(run, arguments.history_file)
+    if len(failed_queries) > 0:
+        print(f"Example queries with different results: {', '.join(failed_queries)}")
+    sys.exit(1 if failed_queries or all_regressions else 0)
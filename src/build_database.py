@@ -1,30 +1,59 @@
 import os
+import glob
+import uuid
 import sqlite3
 import time
-import text2term
+import importlib.metadata
 import bioregistry
 import pandas as pd
-from tqdm import tqdm
 from pathlib import Path
-from metapub import PubMedFetcher
-from generate_ontology_tables import get_semsql_tables_for_ontology
-from generate_mapping_report import get_mapping_counts
+import generate_ontology_tables
+from generate_ontology_tables import get_semsql_tables, get_semsql_db_file, get_semsql_labels_for_ontology, \
+    import_semsql_tables_to_db, DISEASE_LOCATION_COL
+from generate_mapping_report import get_term_resources_from_edges, get_mapping_counts_from_term_resources
+from resource_bitmaps import get_resource_bitmaps_table, get_bitmap_resources_table
+from text_search import build_text_search_tables
+from metadata_facets import get_typed_metadata_table, get_facet_index_columns
+from compact_schema import compact_database, drop_compact_table
+from anatomy_search import get_disease_locations_table, get_location_closure_table, build_location_index, \
+    get_disease_locations_table_name, get_location_closure_table_name, LOCATION_COL
+from pubmed_references import update_references_table
+import trait_mapping
+import curie_normalizer
+import disease_locations
+import subclass_closure
+import ontology_snapshots
+from build_manifest import get_source_hash
+from trait_mapping import TraitMapper, TraitMappingCache
+from ontology_snapshots import OntologySnapshotStore
 
 __version__ = "1.3.0"
 
 DB_RESOURCES_FOLDER = "../resources/"
+TRAIT_MAPPING_CACHE_FILE = "trait_mapping_cache.db"
+ONTOLOGY_SNAPSHOTS_FOLDER = "ontology_snapshots"
 
 text2term_mapping_source_term_col = "SourceTerm"
 text2term_mapping_source_term_id_col = "SourceTermID"
 text2term_mapping_target_term_iri_col = "MappedTermIRI"
 text2term_mapping_score_col = "MappingScore"
 
+# Stages whose results can be reused across builds when given a build manifest (see build_manifest.BuildManifest)
+BUILD_STAGES = ("ontology_tables", "mappings")
+
 
 # Assemble a SQLite database that contains:
 # 1) The original user-specified metadata table
 # 3) SemanticSQL tables of the specified ontology that enable search by leveraging the ontology class hierarchy
 # 4) Mappings of the values in the specified column of the metadata table to terms in the specified ontology
 # 5) Counts of how many data points in the metadata were mapped—either directly or indirectly—to each ontology term
+# 6) Full-text tables of the ontology term labels and synonyms, and of the metadata values and reference titles
+# 7) Given an anatomy ontology among the additional ontologies, the disease locations of the ontology terms, their
+#     closure over the anatomy ontology, and an index of the metadata records by anatomical site
+# With compact_schema=True, the edges, labels and mappings tables are dictionary-encoded behind views of the same
+#  names (see compact_schema)
+# Given a build manifest, the results of the stages in BUILD_STAGES are reused from the previous build unless their
+#  inputs changed
 def build_database(metadata_df, dataset_name, ontology_name,
                    resource_col=text2term_mapping_source_term_col,
                    resource_id_col=text2term_mapping_source_term_id_col,
@@ -32,8 +61,13 @@ def build_database(metadata_df, dataset_name, ontology_name,
                    ontology_term_iri_col=text2term_mapping_target_term_iri_col,
                    ontology_semsql_db_url="", ontology_url="", pmid_col="",
                    ontology_mappings_df=None, mapping_minimum_score=0.7, mapping_base_iris=(),
-                   include_cross_ontology_references_table=False, additional_tables=(), additional_ontologies=()):
+                   include_cross_ontology_references_table=False, additional_tables=(), additional_ontologies=(),
+                   ontology_extraction_workers=1, direct_ontology_import=False, build_manifest=None,
+                   trait_mapping_workers=1, ontology_version="", metadata_column_types=None,
+                   anatomy_ontology="uberon", compact_schema=False):
     ontology_name = ontology_name.lower()
+    if build_manifest is not None:
+        build_manifest.check_stages(BUILD_STAGES)
 
     # Get target ontology URL from the specified ontology name
     if ontology_url == "":
@@ -42,48 +76,91 @@ def build_database(metadata_df, dataset_name, ontology_name,
     # Create SQLite database
     if output_database_filepath == "":
         output_database_filepath = "../" + dataset_name + "_search.db"
-    Path(output_database_filepath).touch()
-    db_connection = sqlite3.connect(output_database_filepath)
+    # The database is built in a new file, which replaces the output file once the build is complete, so that no tables
+    #  of a previous build are left in it and a failed build leaves the previous database as it is. Files left by
+    #  failed builds are deleted first
+    for temporary_file in glob.glob(glob.escape(output_database_filepath) + ".*.tmp"):
+        os.remove(temporary_file)
+    temporary_database_filepath = f"{output_database_filepath}.{uuid.uuid4().hex}.tmp"
+    db_connection = sqlite3.connect(temporary_database_filepath)
+    configure_build_connection(db_connection)
 
-    # Add the given metadata table to the database
+    # Add the given metadata table to the database, with the given columns (facets that searches can be filtered by) of
+    #  the given SQL types (see metadata_facets.get_typed_metadata_table)
+    if metadata_column_types is not None:
+        metadata_df = get_typed_metadata_table(metadata_df, metadata_column_types)
     import_df_to_db(db_connection, data_frame=metadata_df, table_name=dataset_name + "_metadata")
 
-    # Add ontology tables to the database
+    # Add ontology tables to the database. The tables of all ontologies are extracted first (in parallel, given more
+    #  than one worker), and then imported one ontology at a time. With direct_ontology_import=True, all tables but
+    #  the labels are copied straight from the SemanticSQL databases instead (see import_semsql_tables_to_db)
+    additional_ontologies = [ontology.lower() for ontology in additional_ontologies]
+    anatomy_ontology = anatomy_ontology.lower()
+    if direct_ontology_import:
+        all_ontology_tables = [None] * (len(additional_ontologies) + 1)
+    else:
+        ontology_names = [ontology_name] + additional_ontologies
+        ontology_semsql_db_urls = [ontology_semsql_db_url] + [""] * len(additional_ontologies)
+        all_ontology_tables = _run_build_stage(build_manifest, "ontology_tables",
+                                               lambda: _get_ontology_tables_inputs(ontology_names,
+                                                                                   ontology_semsql_db_urls),
+                                               get_ontology_tables, ontology_names=ontology_names,
+                                               ontology_semsql_db_urls=ontology_semsql_db_urls,
+                                               workers=ontology_extraction_workers)
     primary_ontology_labels_df = import_ontology_tables(db_connection, ontology_name=ontology_name,
                                                         ontology_semsql_db_url=ontology_semsql_db_url,
                                                         include_crossrefs_table=include_cross_ontology_references_table,
-                                                        primary_ontology=True)
-    for ontology in additional_ontologies:
-        import_ontology_tables(db_connection, ontology_name=ontology.lower(), ontology_semsql_db_url="",
-                               include_crossrefs_table=False, primary_ontology=False)
-
-    # Get details (title, abstract, journal) from PubMed about references in the specified PMID column
-    references_table_filename = DB_RESOURCES_FOLDER + dataset_name + "_references.tsv"
-    if not os.path.isfile(references_table_filename):
-        references_df = get_pubmed_details(metadata_df=metadata_df, dataset_name=dataset_name, pmid_col=pmid_col)
-    else:
-        # TODO incrementally update the existing table with any new references in the metadata
-        references_df = pd.read_csv(references_table_filename, sep="\t")
+                                                        primary_ontology=True, ontology_tables=all_ontology_tables[0],
+                                                        direct_import=direct_ontology_import)
+    for ontology, ontology_tables in zip(additional_ontologies, all_ontology_tables[1:]):
+        import_ontology_tables(db_connection, ontology_name=ontology, ontology_semsql_db_url="",
+                               include_crossrefs_table=False, primary_ontology=False, ontology_tables=ontology_tables,
+                               direct_import=direct_ontology_import)
+
+    # Get details (title, abstract, journal) from PubMed about references in the specified PMID column. Only references
+    #  that are not yet in the existing references table are fetched
+    references_df = get_pubmed_details(metadata_df=metadata_df, dataset_name=dataset_name, pmid_col=pmid_col)
     import_df_to_db(db_connection, data_frame=references_df, table_name=dataset_name + "_references")
 
     # Map the values in the specified metadata table column to the specified ontology
+    metadata_resource_ids = metadata_df[resource_id_col] if resource_id_col in metadata_df.columns else ()
+    metadata_resource_col, metadata_resource_id_col = resource_col, resource_id_col
     if ontology_mappings_df is None:
-        ontology_mappings_df = map_metadata_to_ontologies(metadata_df=metadata_df, dataset_name=dataset_name,
-                                                          ontology_url=ontology_url, min_score=mapping_minimum_score,
-                                                          source_term_col=resource_col,
-                                                          source_term_id_col=resource_id_col,
-                                                          base_iris=mapping_base_iris)
+        source_term_cols = [resource_col] + ([resource_id_col] if resource_id_col != "" else [])
+        mapping_inputs = {"source_terms": metadata_df[source_term_cols], "ontology_url": ontology_url,
+                          "ontology_version": ontology_version,
+                          "min_score": mapping_minimum_score, "base_iris": list(mapping_base_iris),
+                          "text2term": importlib.metadata.version("text2term"),
+                          "code": get_source_hash(map_metadata_to_ontologies, trait_mapping, ontology_snapshots)}
+        ontology_mappings_df = _run_build_stage(build_manifest, "mappings", lambda: mapping_inputs,
+                                                map_metadata_to_ontologies, metadata_df=metadata_df,
+                                                dataset_name=dataset_name, ontology_url=ontology_url,
+                                                min_score=mapping_minimum_score, source_term_col=resource_col,
+                                                source_term_id_col=resource_id_col, base_iris=mapping_base_iris,
+                                                workers=trait_mapping_workers, ontology_version=ontology_version)
         resource_col = text2term_mapping_source_term_col
         resource_id_col = text2term_mapping_source_term_id_col
         ontology_term_iri_col = text2term_mapping_target_term_iri_col
         ontology_mappings_df.columns = ontology_mappings_df.columns.str.replace(' ', '')
     import_df_to_db(db_connection, data_frame=ontology_mappings_df, table_name=dataset_name + "_mappings")
 
-    # Get counts of mappings
-    counts_df = get_mapping_counts(mappings_df=ontology_mappings_df, ontology_iri=ontology_url,
-                                   source_term_col=resource_col, save_ontology=True,
-                                   source_term_id_col=resource_id_col,
-                                   mapped_term_iri_col=ontology_term_iri_col)
+    # Get counts of mappings, by propagating the mappings up the asserted subClassOf edges of the ontology. The sets of
+    #  resources behind the counts are also added to the database as bitmaps, with bits in the order of the metadata
+    #  table, so that counts over any subset of the resources can be computed when searching (see resource_bitmaps)
+    print("Computing mapping counts and resource bitmaps from ontology edges...")
+    start = time.time()
+    edges_df = pd.read_sql_query(f"SELECT Subject, Object FROM {ontology_name}_edges", db_connection)
+    resources, term_resources_df = get_term_resources_from_edges(mappings_df=ontology_mappings_df,
+                                                                 terms_df=primary_ontology_labels_df,
+                                                                 edges_df=edges_df, source_term_id_col=resource_id_col,
+                                                                 mapped_term_iri_col=ontology_term_iri_col,
+                                                                 resources=metadata_resource_ids)
+    counts_df = get_mapping_counts_from_term_resources(term_resources_df)
+    import_df_to_db(db_connection, data_frame=get_resource_bitmaps_table(term_resources_df),
+                    table_name=ontology_name + "_resource_bitmaps")
+    import_df_to_db(db_connection, data_frame=get_bitmap_resources_table(resources),
+                    table_name=ontology_name + "_bitmap_resources")
+    print(f"...done ({time.time() - start:.1f} seconds)")
     counts_df.to_csv(DB_RESOURCES_FOLDER + ontology_name + "_mappings_counts.tsv", sep="\t", index=False)
 
     # Merge the counts table with the labels table on the "IRI" column
@@ -98,22 +175,111 @@ def build_database(metadata_df, dataset_name, ontology_name,
         for table_name in additional_tables.keys():
             import_df_to_db(db_connection, data_frame=additional_tables[table_name], table_name=table_name)
 
+    # Add the (term, location) pairs of the disease locations of the ontology terms, the anatomical sites that contain
+    #  each location (along the subClassOf and part-of edges of the anatomy ontology), and the index of resources by
+    #  the sites of the diseases they were mapped to, so that searches by anatomical site are single lookups (see
+    #  anatomy_search)
+    if anatomy_ontology in additional_ontologies and DISEASE_LOCATION_COL in primary_ontology_labels_df.columns:
+        disease_locations_df = get_disease_locations_table(primary_ontology_labels_df)
+        import_df_to_db(db_connection, data_frame=disease_locations_df,
+                        table_name=get_disease_locations_table_name(ontology_name))
+        anatomy_semsql_db_file = get_semsql_db_file(ontology_url=_get_semsql_db_url(anatomy_ontology),
+                                                    ontology_name=anatomy_ontology.upper(),
+                                                    db_output_folder=DB_RESOURCES_FOLDER)
+        import_df_to_db(db_connection,
+                        data_frame=get_location_closure_table(anatomy_semsql_db_file,
+                                                              disease_locations_df[LOCATION_COL]),
+                        table_name=get_location_closure_table_name(ontology_name))
+        build_location_index(db_connection, dataset_name=dataset_name, ontology_name=ontology_name)
 
-def import_ontology_tables(db_connection, ontology_name, ontology_semsql_db_url,
-                           include_crossrefs_table, primary_ontology=True):
-    # Get SemanticSQL ontology tables and add them to the database
+    # Add full-text tables of the ontology term labels and synonyms and of the metadata traits and reference titles, so
+    #  that free text can be resolved to ontology terms and records when searching (see text_search)
+    build_text_search_tables(db_connection, dataset_name=dataset_name, ontology_name=ontology_name,
+                             resource_col=metadata_resource_col, resource_id_col=metadata_resource_id_col,
+                             pmid_col=pmid_col)
+
+    # Replace the edges, labels and mappings tables by integer-keyed tables over a dictionary of terms, and views with
+    #  the names and columns of the original tables (which are then indexed through their encoded tables)
+    if compact_schema:
+        compact_database(db_connection, dataset_name=dataset_name,
+                         ontology_names=[ontology_name] + additional_ontologies)
+
+    # Index the columns used to join tables when searching. The subclasses of a term are looked up through indexes on
+    #  the (Object, Subject) columns of the edges tables, which also cover the Subject column. The metadata of the
+    #  resources found are looked up through an index of their IDs and facet columns, which covers faceted searches
+    indexed_columns = {dataset_name + "_mappings": ["MappedTermCURIE", "SourceTermID"]}
+    indexed_columns[ontology_name + "_resource_bitmaps"] = ["IRI"]
+    indexed_columns[get_disease_locations_table_name(ontology_name)] = ["Subject", ("Location", "Subject")]
+    indexed_columns[get_location_closure_table_name(ontology_name)] = ["Subject", ("Object", "Subject")]
+    if metadata_column_types is not None and metadata_resource_id_col in metadata_df.columns:
+        indexed_columns[dataset_name + "_metadata"] = [get_facet_index_columns(metadata_df, metadata_resource_id_col,
+                                                                               metadata_column_types)]
+    for ontology in [ontology_name] + additional_ontologies:
+        indexed_columns[ontology + "_edges"] = ["Subject", ("Object", "Subject")]
+        indexed_columns[ontology + "_entailed_edges"] = ["Subject", ("Object", "Subject")]
+    finalize_database(db_connection, indexed_columns=indexed_columns)
+    db_connection.close()
+    os.replace(temporary_database_filepath, output_database_filepath)
+    print_import_report()
+
+
+# Call function(*args, **kwargs) to get the result of the given build stage or, if a build manifest is given, reuse the
+#  result of the previous build when the stage inputs (given by calling get_inputs) are unchanged
+def _run_build_stage(build_manifest, stage, get_inputs, function, *args, **kwargs):
+    if build_manifest is None:
+        return function(*args, **kwargs)
+    return build_manifest.run_stage(stage, get_inputs(), function, *args, **kwargs)
+
+
+# The ontology tables depend on the contents of the SemanticSQL databases (whose cached files are named after their
+#  checksums) and on the source code of the modules that extract the tables
+def _get_ontology_tables_inputs(ontology_names, ontology_semsql_db_urls):
+    semsql_db_checksums = {}
+    for ontology_name, ontology_semsql_db_url in zip(ontology_names, ontology_semsql_db_urls):
+        semsql_db_file = get_semsql_db_file(ontology_url=_get_semsql_db_url(ontology_name, ontology_semsql_db_url),
+                                            ontology_name=ontology_name.upper(), db_output_folder=DB_RESOURCES_FOLDER)
+        semsql_db_checksums[ontology_name] = Path(semsql_db_file).name
+    return {"semsql_dbs": semsql_db_checksums,
+            "code": get_source_hash(get_ontology_tables, generate_ontology_tables, curie_normalizer,
+                                    disease_locations, subclass_closure)}
+
+
+# Get the SemanticSQL tables of the given ontologies, the first of which is the primary ontology (if primary_ontology
+#  is True). Ontologies are processed in a pool of worker processes if workers > 1
+def get_ontology_tables(ontology_names, ontology_semsql_db_urls, primary_ontology=True, workers=1):
     start = time.time()
+    jobs = []
+    for index, (ontology_name, ontology_semsql_db_url) in enumerate(zip(ontology_names, ontology_semsql_db_urls)):
+        jobs.append(dict(ontology_url=_get_semsql_db_url(ontology_name, ontology_semsql_db_url),
+                         ontology_name=ontology_name.upper(),
+                         tables_output_folder=DB_RESOURCES_FOLDER,
+                         db_output_folder=DB_RESOURCES_FOLDER,
+                         save_tables=True,
+                         include_disease_locations=(primary_ontology and index == 0)))
+    ontology_tables = get_semsql_tables(jobs, workers=workers)
+    print(f"...done ({time.time() - start:.1f} seconds)")
+    return ontology_tables
+
+
+def _get_semsql_db_url(ontology_name, ontology_semsql_db_url=""):
     if ontology_semsql_db_url == "":
         ontology_semsql_db_url = "https://s3.amazonaws.com/bbop-sqlite/" + ontology_name + ".db.gz"
-    edges_df, entailed_edges_df, labels_df, dbxrefs_df, synonyms_df, ontology_version = \
-        get_semsql_tables_for_ontology(
-            ontology_url=ontology_semsql_db_url,
-            ontology_name=ontology_name.upper(),
-            tables_output_folder=DB_RESOURCES_FOLDER,
-            db_output_folder=DB_RESOURCES_FOLDER,
-            save_tables=True,
-            include_disease_locations=primary_ontology)
-    print(f"...done ({time.time() - start:.1f} seconds)")
+    return ontology_semsql_db_url
+
+
+def import_ontology_tables(db_connection, ontology_name, ontology_semsql_db_url,
+                           include_crossrefs_table, primary_ontology=True, ontology_tables=None, direct_import=False):
+    if direct_import:
+        return import_ontology_tables_directly(db_connection, ontology_name=ontology_name,
+                                               ontology_semsql_db_url=ontology_semsql_db_url,
+                                               include_crossrefs_table=include_crossrefs_table,
+                                               primary_ontology=primary_ontology)
+    # Get SemanticSQL ontology tables (unless already given) and add them to the database
+    if ontology_tables is None:
+        ontology_tables = get_ontology_tables(ontology_names=[ontology_name],
+                                              ontology_semsql_db_urls=[ontology_semsql_db_url],
+                                              primary_ontology=primary_ontology)[0]
+    edges_df, entailed_edges_df, labels_df, dbxrefs_df, synonyms_df, ontology_version = ontology_tables
     import_df_to_db(db_connection, data_frame=edges_df, table_name=ontology_name + "_edges")
     import_df_to_db(db_connection, data_frame=entailed_edges_df, table_name=ontology_name + "_entailed_edges")
     import_df_to_db(db_connection, data_frame=synonyms_df, table_name=ontology_name + "_synonyms")
@@ -124,26 +290,112 @@ def import_ontology_tables(db_connection, ontology_name, ontology_semsql_db_url,
     return labels_df
 
 
-dtypes = {'int64': 'INTEGER', 'float64': 'REAL', 'object': 'TEXT', 'datetime64': 'TEXT'}
+# Add SemanticSQL ontology tables to the database by copying them directly from the SemanticSQL database file, such
+#  that only the labels table is loaded into a data frame (to add IRIs and disease locations)
+def import_ontology_tables_directly(db_connection, ontology_name, ontology_semsql_db_url,
+                                    include_crossrefs_table, primary_ontology=True):
+    start = time.time()
+    semsql_db_file = get_semsql_db_file(ontology_url=_get_semsql_db_url(ontology_name, ontology_semsql_db_url),
+                                        ontology_name=ontology_name.upper(),
+                                        db_output_folder=DB_RESOURCES_FOLDER)
+    _import_statistics.extend(
+        import_semsql_tables_to_db(db_connection, semsql_db_file=semsql_db_file, table_prefix=ontology_name,
+                                   include_dbxrefs_table=include_crossrefs_table))
+    labels_df, ontology_version = get_semsql_labels_for_ontology(semsql_db_file,
+                                                                 include_disease_locations=primary_ontology)
+    print(f"...done ({time.time() - start:.1f} seconds)")
+    if not primary_ontology:
+        import_df_to_db(db_connection, data_frame=labels_df, table_name=ontology_name + "_labels")
+    return labels_df
+
+
+dtypes = {'int64': 'INTEGER', 'Int64': 'INTEGER', 'float64': 'REAL', 'bool': 'INTEGER', 'object': 'TEXT',
+          'datetime64': 'TEXT'}
+
+IMPORT_CHUNK_SIZE = 50000
+
+# Pragmas used while the database is being built. The database can always be rebuilt, so journaling and syncing to
+#  disk are disabled, and a large page cache (in KiB, given as a negative number) is used
+BUILD_PRAGMAS = {"journal_mode": "OFF", "synchronous": "OFF", "cache_size": -512000, "temp_store": "MEMORY"}
+
+# Number of rows and seconds taken to import each table in the current build
+_import_statistics = []
+
+
+def configure_build_connection(connection):
+    for pragma, value in BUILD_PRAGMAS.items():
+        connection.execute(f"PRAGMA {pragma}={value}")
+    _import_statistics.clear()
+
+
+# Create indexes on the given columns of the given tables (the keys used to join tables when searching), and then
+#  update the query planner statistics and compact the database. Multi-column indexes are given as tuples of columns
+def finalize_database(connection, indexed_columns):
+    start = time.time()
+    existing_tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    for table_name, columns in indexed_columns.items():
+        if table_name in existing_tables:
+            for column in columns:
+                column = (column,) if isinstance(column, str) else tuple(column)
+                connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{'_'.join(column)} "
+                                   f"ON {table_name} ({', '.join(column)})")
+    connection.commit()
+    connection.execute("ANALYZE")
+    connection.execute("VACUUM")
+    print(f"Created indexes and compacted database ({time.time() - start:.1f} seconds)")
+
+
+def print_import_report():
+    print("Rows imported per table:")
+    for table_name, row_count, seconds in _import_statistics:
+        print(f"\t{table_name}: {row_count} rows in {seconds:.2f} seconds "
+              f"({row_count / max(seconds, 1e-6):.0f} rows/second)")
 
 
 # Import the given data frame to the SQLite database through the specified connection
-# The CREATE TABLE statement is built using the given data frame's column names and inferred data types
-def import_df_to_db(connection, data_frame, table_name):
+# The CREATE TABLE statement is built using the given data frame's column names and inferred data types, and the rows
+#  are inserted in chunks within a single transaction
+def import_df_to_db(connection, data_frame, table_name, chunk_size=IMPORT_CHUNK_SIZE):
+    start = time.time()
     columns = []
     for column_name, dtype in zip(data_frame.columns, data_frame.dtypes):
         sql_type = dtypes.get(str(dtype), 'TEXT')
         column_name = column_name.replace(":", "_")
         column_name = column_name.replace(" ", "")
         columns.append(f"`{column_name}` {sql_type}")
-    create_table_query = f'CREATE TABLE IF NOT EXISTS {table_name} ({", ".join(columns)})'
-    connection.cursor().execute(create_table_query)
-    data_frame.to_sql(table_name, connection, if_exists="replace", index=False)
+    insert_query = f'INSERT INTO {table_name} VALUES ({", ".join("?" * len(columns))})'
+    drop_compact_table(connection, table_name)
+    with connection:
+        connection.execute(f'DROP TABLE IF EXISTS {table_name}')
+        connection.execute(f'CREATE TABLE {table_name} ({", ".join(columns)})')
+        for chunk_start in range(0, len(data_frame), chunk_size):
+            connection.executemany(insert_query, _get_rows(data_frame.iloc[chunk_start:chunk_start + chunk_size]))
+    _import_statistics.append((table_name, len(data_frame), time.time() - start))
+
+
+# Get the rows of the given data frame as tuples of values that can be stored by sqlite3: missing values become None
+#  and timestamps become strings
+def _get_rows(data_frame):
+    columns = []
+    for column_name, dtype in zip(data_frame.columns, data_frame.dtypes):
+        column = data_frame[column_name]
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            column = column.map(str, na_action="ignore")
+        if column.hasnans:
+            column = column.astype(object).where(column.notna(), None)
+        columns.append(column.tolist())
+    return zip(*columns)
 
 
 # Map values in the specified metadata column to terms in the specified ontology set
+# Each distinct (normalized) value is mapped once, and values mapped by any previous build with the same ontology
+#  version and mapping parameters are taken from the trait mapping cache (see trait_mapping.TraitMapper). Mapping
+#  scores depend only on the value and the ontology, so they can differ slightly from text2term's, whose TF-IDF
+#  weights also depend on the other values. With workers > 1, values are mapped in a pool of
+#  worker processes, with the same results. The ontology terms are taken from the snapshot of the given ontology
+#  version (see ontology_snapshots.OntologySnapshotStore), so the ontology is only parsed once per version
 def map_metadata_to_ontologies(metadata_df, dataset_name, ontology_url, min_score, source_term_col,
-                               source_term_id_col, base_iris=()):
+                               source_term_id_col, base_iris=(), workers=1, ontology_version=""):
     print(f"Mapping values in metadata column '{source_term_col}' to terms in '{ontology_url}'...")
     start = time.time()
     source_terms = metadata_df[source_term_col].tolist()
@@ -151,45 +403,25 @@ def map_metadata_to_ontologies(metadata_df, dataset_name, ontology_url, min_scor
         source_term_ids = metadata_df[source_term_id_col].tolist()
     else:
         source_term_ids = ()
-    mappings = text2term.map_terms(source_terms=source_terms, source_terms_ids=source_term_ids,
-                                   target_ontology=ontology_url, excl_deprecated=True, save_graphs=False,
-                                   max_mappings=1, min_score=min_score, save_mappings=True,
-                                   output_file=DB_RESOURCES_FOLDER + dataset_name + "_mappings.csv",
-                                   base_iris=base_iris)
+    mapping_cache = TraitMappingCache(DB_RESOURCES_FOLDER + TRAIT_MAPPING_CACHE_FILE)
+    mapper = TraitMapper(target_ontology=ontology_url, base_iris=base_iris, min_score=min_score, max_mappings=1,
+                         excl_deprecated=True, cache=mapping_cache, workers=workers,
+                         snapshot_store=OntologySnapshotStore(DB_RESOURCES_FOLDER + ONTOLOGY_SNAPSHOTS_FOLDER),
+                         ontology_version=ontology_version)
+    mappings = mapper.map_terms(source_terms=source_terms, source_term_ids=source_term_ids,
+                                output_file=DB_RESOURCES_FOLDER + dataset_name + "_mappings.csv")
+    mapping_cache.close()
     mappings.columns = mappings.columns.str.replace(" ", "")  # remove spaces from column names
     print(f"...done ({time.time() - start:.1f} seconds)")
     return mappings
 
 
-# Get publication details from PubMed (title, abstract, journal, etc) for the PMIDS in the specified column
+# Get publication details from PubMed (title, abstract, journal, etc) for the PMIDS in the specified column, adding any
+#  PMIDs that are missing from the existing references table (if any) to that table
 def get_pubmed_details(metadata_df, dataset_name, pmid_col):
     print("Fetching publication metadata from PubMed...")
     start = time.time()
-    pmids = metadata_df[pmid_col].dropna().unique()
-    fetch = PubMedFetcher()
-    articles = []
-    for pmid in tqdm(pmids):
-        article_details = get_pubmed_article_details(fetch, pmid)
-        if article_details != "":
-            articles.append(article_details)
-    references_df = pd.DataFrame(articles, columns=[pmid_col, 'Journal', 'Title', 'Abstract', 'Year', 'URL'])
-    references_df.to_csv(DB_RESOURCES_FOLDER + dataset_name + "_references.tsv", sep="\t", index=False)
+    references_df = update_references_table(references_file=DB_RESOURCES_FOLDER + dataset_name + "_references.tsv",
+                                            pmids=metadata_df[pmid_col], pmid_col=pmid_col)
     print(f"...done ({time.time() - start:.1f} seconds)")
     return references_df
-
-
-def get_pubmed_article_details(pubmed_fetcher, pmid, repeat=True):
-    if pmid != "0" and pmid != "nan":
-        try:
-            article = pubmed_fetcher.article_by_pmid(pmid)
-            title = article.title
-            journal = article.journal
-            year = article.year
-            abstract = article.abstract
-            url = article.url
-            return pmid, journal, title, abstract, year, url
-        except Exception as e:
-            # Try to fetch details once more. Sometimes the NCBI API errors out, but a second attempt (usually) succeeds
-            if repeat:
-                return get_pubmed_article_details(pubmed_fetcher, pmid, repeat=False)
-    return ""
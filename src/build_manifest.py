@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import hashlib
+import inspect
+import pandas as pd
+from datetime import datetime
+
+__version__ = "0.1.0"
+
+ALL_STAGES = "all"
+
+
+class BuildManifest:
+    """
+    Records, for each stage of a database build, a hash of the stage's inputs (e.g., metadata rows, ontology database
+    checksums, mapping parameters and the source code of the stage, see get_source_hash) together with the artifact
+    the stage produced. A stage is only run again if its inputs changed since the last build, if its artifact is
+    missing, or if it is forced; otherwise its artifact is loaded from the artifacts folder. The manifest is a JSON
+    file of the form:
+        {"stages": {"<stage>": {"inputs_hash": ..., "artifact": ..., "completed": ..., "seconds": ...}}}
+    """
+
+    def __init__(self, manifest_file, artifacts_folder=None, force_stages=()):
+        self.manifest_file = manifest_file
+        if artifacts_folder is None:
+            artifacts_folder = os.path.join(os.path.dirname(manifest_file), "build_artifacts")
+        self.artifacts_folder = artifacts_folder
+        self.force_stages = set(force_stages)
+        os.makedirs(artifacts_folder, exist_ok=True)
+        self._stages = self._read()
+
+    def check_stages(self, stages):
+        unknown_stages = self.force_stages.difference(stages, [ALL_STAGES])
+        if unknown_stages:
+            raise ValueError(f"Unknown build stage(s) {sorted(unknown_stages)}. Valid stages are: {list(stages)}")
+
+    def is_forced(self, stage):
+        return ALL_STAGES in self.force_stages or stage in self.force_stages
+
+    def is_current(self, stage, inputs_hash):
+        entry = self._stages.get(stage)
+        return not self.is_forced(stage) and entry is not None and entry["inputs_hash"] == inputs_hash and \
+            os.path.isfile(os.path.join(self.artifacts_folder, entry["artifact"]))
+
+    def run_stage(self, stage, inputs, function, *args, **kwargs):
+        """
+        Get the result of the given build stage, by loading its artifact if the stage inputs are unchanged, or else by
+        calling function(*args, **kwargs) and saving the (picklable) result as the new artifact of the stage
+        :param stage: name of the stage
+        :param inputs: dictionary of everything the stage result depends on (see get_inputs_hash)
+        """
+        inputs_hash = get_inputs_hash(inputs)
+        if self.is_current(stage, inputs_hash):
+            print(f"Build stage '{stage}' is up to date, reusing its artifact")
+            with open(os.path.join(self.artifacts_folder, self._stages[stage]["artifact"]), "rb") as file_in:
+                return pickle.load(file_in)
+        reason = "forced" if self.is_forced(stage) else "inputs changed" if stage in self._stages else "no artifact"
+        print(f"Running build stage '{stage}' ({reason})")
+        start = time.time()
+        result = function(*args, **kwargs)
+        artifact = stage + ".pkl"
+        temporary_file = os.path.join(self.artifacts_folder, f".{artifact}.{uuid.uuid4().hex}.tmp")
+        with open(temporary_file, "wb") as file_out:
+            pickle.dump(result, file_out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file, os.path.join(self.artifacts_folder, artifact))
+        self._stages[stage] = {"inputs_hash": inputs_hash, "artifact": artifact,
+                               "completed": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+                               "seconds": round(time.time() - start, 1)}
+        self._write()
+        return result
+
+    def _read(self):
+        if not os.path.isfile(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as file_in:
+            return json.load(file_in).get("stages", {})
+
+    def _write(self):
+        temporary_file = self.manifest_file + f".{uuid.uuid4().hex}.tmp"
+        with open(temporary_file, "w") as file_out:
+            json.dump({"version": __version__, "stages": self._stages}, file_out, indent=2)
+        os.replace(temporary_file, self.manifest_file)
+
+
+def get_inputs_hash(inputs):
+    """
+    Get a SHA-256 hash of the given stage inputs: a dictionary whose values are data frames (hashed by their column
+    names, dtypes and rows), or JSON-serializable values
+    """
+    sha256 = hashlib.sha256()
+    for name in sorted(inputs):
+        value = inputs[name]
+        sha256.update(name.encode("utf-8"))
+        if isinstance(value, pd.DataFrame):
+            sha256.update(_hash_data_frame(value).encode("utf-8"))
+        else:
+            sha256.update(json.dumps(value, sort_keys=True, default=str).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def get_source_hash(*sources):
+    """
+    Get a SHA-256 hash of the source code of the given modules or functions (the code a stage runs), so that the stage
+    is run again whenever that code changes, whether or not a version number was updated with it
+    """
+    sha256 = hashlib.sha256()
+    for source in sources:
+        sha256.update(inspect.getsource(source).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def _hash_data_frame(data_frame):
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps([[str(column), str(dtype)] for column, dtype in data_frame.dtypes.items()]).encode())
+    try:
+        row_hashes = pd.util.hash_pandas_object(data_frame, index=False)
+    except TypeError:  # columns with unhashable values, such as lists
+        row_hashes = pd.util.hash_pandas_object(data_frame.astype(str), index=False)
+    sha256.update(row_hashes.values.tobytes())
+    return sha256.hexdigest()
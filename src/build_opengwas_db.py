@@ -1,10 +1,12 @@
 import os
-import sys
 import tarfile
+import argparse
 import time
 import ieugwaspy
 import pandas as pd
 from datetime import datetime
+from build_manifest import BuildManifest, ALL_STAGES
+from metadata_facets import OPENGWAS_FACET_TYPES
 
 __version__ = "0.3.0"
 
@@ -15,10 +17,10 @@ SEARCH_DB_VERSION = "0.10.0"
 
 DATASET_NAME = "opengwas"
 OUTPUT_DATABASE_FILEPATH = "../" + DATASET_NAME + "_search.db"
+BUILD_MANIFEST_FILEPATH = "../resources/build_manifest.json"
 
 
 def delete_existing_resources():
-    _delete_file("../resources/efo.db")
     _delete_file("../resources/efo_dbxrefs.tsv")
     _delete_file("../resources/efo_edges.tsv")
     _delete_file("../resources/efo_entailed_edges.tsv")
@@ -26,8 +28,8 @@ def delete_existing_resources():
     _delete_file("../resources/efo_mappings_counts.tsv")
     _delete_file("../resources/opengwas_mappings.csv")
     _delete_file("../resources/opengwas_metadata.tsv")
-    _delete_file("../resources/opengwas_references.tsv")
     _delete_file("../opengwas_search.db")
+    _delete_file(BUILD_MANIFEST_FILEPATH)
 
 
 def _delete_file(file):
@@ -44,13 +46,31 @@ def get_version_info_table(metadata_timestamp):
     return df
 
 
-# Takes an optional argument that is an NCBI API KEY, which is used to query PubMed faster.
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Build the OpenGWAS search database")
+    parser.add_argument("ncbi_api_key", nargs="?", help="NCBI API Key, which is used to query PubMed faster")
+    parser.add_argument("--force-stage", action="append", default=[], metavar="STAGE",
+                        help="re-run the given build stage (ontology_tables or mappings) even if its inputs are "
+                             f"unchanged since the last build; '{ALL_STAGES}' re-runs all stages. Can be given more "
+                             "than once")
+    parser.add_argument("--clean", action="store_true",
+                        help="delete all resources generated by previous builds before building")
+    parser.add_argument("--compact-schema", action="store_true",
+                        help="store the edges, labels and mappings tables dictionary-encoded, behind views with the "
+                             "same names and columns (see compact_schema)")
+    return parser.parse_args()
+
+
+# Stages of the build whose inputs (metadata, ontology versions, mapping parameters and code versions) are unchanged
+#  since the last build are skipped, and their results are taken from the build manifest artifacts instead
 if __name__ == "__main__":
-    delete_existing_resources()
+    arguments = parse_arguments()
+    if arguments.clean:
+        delete_existing_resources()
 
     # Check if an NCBI API Key is provided
-    if len(sys.argv) > 1:
-        os.environ["NCBI_API_KEY"] = sys.argv[1]
+    if arguments.ncbi_api_key is not None:
+        os.environ["NCBI_API_KEY"] = arguments.ncbi_api_key
         print(f"Using NCBI API Key: {os.environ.get('NCBI_API_KEY')}")
     else:
         print("NCBI API Key not provided—PubMed queries will be slower. Provide API Key as a parameter to this module.")
@@ -74,6 +94,8 @@ if __name__ == "__main__":
                    metadata_df=metadata_df,
                    ontology_name="EFO",
                    ontology_url=f"http://www.ebi.ac.uk/efo/releases/v{EFO_VERSION}/efo.owl",
+                   ontology_version=EFO_VERSION,
+                   metadata_column_types=OPENGWAS_FACET_TYPES,
                    pmid_col="pmid",
                    resource_col="trait",
                    resource_id_col="id",
@@ -84,7 +106,11 @@ if __name__ == "__main__":
                                       "http://purl.obolibrary.org/obo/HP", "http://www.orpha.net/ORDO",
                                       "http://purl.obolibrary.org/obo/DOID"),
                    additional_tables={"version_info": version_info_df},
-                   additional_ontologies=["UBERON"])
+                   additional_ontologies=["UBERON"],
+                   ontology_extraction_workers=2,
+                   compact_schema=arguments.compact_schema,
+                   trait_mapping_workers=os.cpu_count(),
+                   build_manifest=BuildManifest(BUILD_MANIFEST_FILEPATH, force_stages=arguments.force_stage))
 
     base_filename = os.path.basename(OUTPUT_DATABASE_FILEPATH)
     with tarfile.open(OUTPUT_DATABASE_FILEPATH + ".tar.xz", "w:xz") as tar:
@@ -0,0 +1,268 @@
+import os
+import time
+import lzma
+import shutil
+import sqlite3
+import argparse
+import numpy as np
+
+__version__ = "0.1.0"
+
+# Dictionary of all the terms in the ontology tables and mappings of a compact database, which the encoded tables
+#  refer to by ID
+TERMS_TABLE = "terms"
+
+# Suffix of the names of the (dictionary-encoded) tables behind the compatibility views of a compact database
+ENCODED_TABLE_SUFFIX = "_encoded"
+
+# Columns of the tables that are encoded, by kind of table: the column of the term (or the columns of the subject and
+#  object terms, for edges tables), and the columns whose values are stored only if they differ from the label and IRI
+#  of the term in the dictionary
+EDGE_COLUMNS = ("Subject", "Object")
+LABELS_TERM_COLUMNS = {"term": "Subject", "label": "Object", "iri": "IRI"}
+MAPPINGS_TERM_COLUMNS = {"term": "MappedTermCURIE", "label": "MappedTermLabel", "iri": "MappedTermIRI"}
+
+
+def get_encoded_table_name(table_name):
+    return table_name + ENCODED_TABLE_SUFFIX
+
+
+def is_compact_database(connection, dataset_name="opengwas", ontology_name="efo"):
+    """
+    Check whether the mappings and (entailed) edges tables of the given dataset and ontology, in the database of the
+    given connection, have the compact layout (see compact_database)
+    """
+    encoded_tables = [get_encoded_table_name(table_name) for table_name in
+                      (dataset_name + "_mappings", ontology_name + "_edges", ontology_name + "_entailed_edges")]
+    return set(encoded_tables) <= _get_tables(connection)
+
+
+# Drop the compatibility view of the given name and its encoded table, if the name is that of a view, so that a table
+#  of the same name can be created again (e.g. when a database of the compact layout is built again with the row
+#  layout). A table of the given name is left to be dropped with DROP TABLE. The terms dictionary is dropped with the
+#  last encoded table
+def drop_compact_table(connection, table_name):
+    if (table_name,) not in connection.execute("SELECT name FROM sqlite_master WHERE type='view'"):
+        return
+    with connection:
+        connection.execute(f"DROP VIEW {table_name}")
+        connection.execute(f"DROP TABLE IF EXISTS {get_encoded_table_name(table_name)}")
+        if not any(name.endswith(ENCODED_TABLE_SUFFIX) for name in _get_tables(connection)):
+            connection.execute(f"DROP TABLE IF EXISTS {TERMS_TABLE}")
+
+
+# Convert the edges, entailed edges and labels (with counts) tables of the given ontologies and the mappings table of
+#  the given dataset, in the database of the given connection, to the compact layout:
+# 1) A 'terms' dictionary of the CURIEs of all terms in those tables, with their IRIs and labels (taken from the
+#     labels tables, in the order of the given ontologies, and then from the mappings table)
+# 2) For each table, a '<table>_encoded' WITHOUT ROWID table, keyed by the integer IDs of its terms. Labels and IRIs
+#     are only stored where they differ from those in the dictionary (e.g. the label given by the mapping tool)
+# 3) For each table, a view with the name and columns of the original table, which decodes the encoded table
+# Each view is checked to have the same rows as the original table before the original is dropped. Tables that are
+#  missing, have other columns than expected, or whose rows could not be encoded exactly are left as they are. Terms
+#  already in the dictionary keep their IDs, so tables that were encoded before (e.g. by a previous call) stay valid.
+#  VACUUM the database afterwards to release the space of the original tables
+def compact_database(connection, dataset_name, ontology_names):
+    start = time.time()
+    tables = _get_tables(connection)
+    labels_tables = [name + "_labels" for name in ontology_names
+                     if _has_columns(connection, tables, name + "_labels", LABELS_TERM_COLUMNS.values())]
+    edges_tables = [name + suffix for name in ontology_names for suffix in ("_edges", "_entailed_edges")
+                    if name + suffix in tables and _get_columns(connection, name + suffix) == list(EDGE_COLUMNS)]
+    mappings_tables = [dataset_name + "_mappings"] if _has_columns(
+        connection, tables, dataset_name + "_mappings", [*MAPPINGS_TERM_COLUMNS.values(), "SourceTermID"]) else []
+    with connection:
+        _create_terms_table(connection, labels_tables, mappings_tables, edges_tables)
+        encoded_tables = [_encode_edges_table(connection, table_name) for table_name in edges_tables]
+        encoded_tables += [_encode_terms_table(connection, table_name, LABELS_TERM_COLUMNS, [])
+                           for table_name in labels_tables]
+        encoded_tables += [_encode_terms_table(connection, table_name, MAPPINGS_TERM_COLUMNS, ["SourceTermID"])
+                           for table_name in mappings_tables]
+    for table_name, view_query in encoded_tables:
+        with connection:
+            if _has_same_rows(connection, table_name, view_query):
+                connection.execute(f"DROP TABLE {table_name}")
+                connection.execute(f"CREATE VIEW {table_name} AS {view_query}")
+            else:
+                print(f"\t{table_name} could not be encoded exactly, and was left as it is")
+                connection.execute(f"DROP TABLE {get_encoded_table_name(table_name)}")
+    print(f"Converted database to compact layout ({time.time() - start:.1f} seconds)")
+
+
+def _get_tables(connection):
+    return {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+
+def _get_columns(connection, table_name):
+    return [row[1] for row in connection.execute(f"PRAGMA table_info({table_name})")]
+
+
+def _has_columns(connection, tables, table_name, columns):
+    return table_name in tables and set(columns) <= set(_get_columns(connection, table_name))
+
+
+def _get_column_types(connection, table_name):
+    return {row[1]: row[2] for row in connection.execute(f"PRAGMA table_info({table_name})")}
+
+
+def _create_terms_table(connection, labels_tables, mappings_tables, edges_tables):
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {TERMS_TABLE} (id INTEGER PRIMARY KEY, "
+                       f"curie TEXT NOT NULL UNIQUE, iri TEXT, label TEXT)")
+    sources = [(table_name, LABELS_TERM_COLUMNS) for table_name in labels_tables]
+    sources += [(table_name, MAPPINGS_TERM_COLUMNS) for table_name in mappings_tables]
+    for table_name, term_columns in sources:
+        connection.execute(f"INSERT OR IGNORE INTO {TERMS_TABLE} (curie, iri, label) "
+                           f"SELECT `{term_columns['term']}`, `{term_columns['iri']}`, `{term_columns['label']}` "
+                           f"FROM {table_name} WHERE `{term_columns['term']}` IS NOT NULL")
+    for table_name in edges_tables:
+        for column in EDGE_COLUMNS:
+            connection.execute(f"INSERT OR IGNORE INTO {TERMS_TABLE} (curie) "
+                               f"SELECT DISTINCT {column} FROM {table_name} WHERE {column} IS NOT NULL")
+
+
+# Encode an edges table as a table of (subject ID, object ID) pairs keyed by object and then subject, as the edges
+#  are looked up by object when searching for the subclasses of a term. Returns the query of the view of the table
+def _encode_edges_table(connection, table_name):
+    encoded_table = get_encoded_table_name(table_name)
+    connection.execute(f"DROP TABLE IF EXISTS {encoded_table}")
+    connection.execute(f"CREATE TABLE {encoded_table} (SubjectID INTEGER NOT NULL, ObjectID INTEGER NOT NULL, "
+                       f"PRIMARY KEY (ObjectID, SubjectID)) WITHOUT ROWID")
+    connection.execute(f"INSERT OR IGNORE INTO {encoded_table} "
+                       f"SELECT s.id, o.id FROM {table_name} e "
+                       f"JOIN {TERMS_TABLE} s ON s.curie = e.Subject JOIN {TERMS_TABLE} o ON o.curie = e.Object")
+    connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{encoded_table}_SubjectID ON {encoded_table} (SubjectID)")
+    return table_name, (f"SELECT s.curie AS Subject, o.curie AS Object FROM {encoded_table} e "
+                        f"JOIN {TERMS_TABLE} s ON s.id = e.SubjectID JOIN {TERMS_TABLE} o ON o.id = e.ObjectID")
+
+
+# Encode a table with a term column (and label and IRI columns) as a table keyed by the ID of the term followed by the
+#  given key columns, with the rest of its columns as they are. Returns the query of the view of the table
+def _encode_terms_table(connection, table_name, term_columns, key_columns):
+    encoded_table = get_encoded_table_name(table_name)
+    column_types = _get_column_types(connection, table_name)
+    other_columns = [column for column in column_types if column != term_columns["term"]]
+    connection.execute(f"DROP TABLE IF EXISTS {encoded_table}")
+    connection.execute(f"CREATE TABLE {encoded_table} (TermID INTEGER NOT NULL, "
+                       f"{', '.join(f'`{column}` {column_types[column]}' for column in other_columns)}, "
+                       f"PRIMARY KEY (TermID{''.join(f', `{column}`' for column in key_columns)})) WITHOUT ROWID")
+    encoded_values = {term_columns["label"]: "label", term_columns["iri"]: "iri"}
+    values = [f"CASE WHEN x.`{column}` IS t.{encoded_values[column]} THEN NULL ELSE x.`{column}` END"
+              if column in encoded_values else f"x.`{column}`" for column in other_columns]
+    connection.execute(f"INSERT OR IGNORE INTO {encoded_table} SELECT t.id, {', '.join(values)} FROM {table_name} x "
+                       f"JOIN {TERMS_TABLE} t ON t.curie = x.`{term_columns['term']}`")
+    for column in key_columns:
+        connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{encoded_table}_{column} ON {encoded_table} (`{column}`)")
+    decoded_columns = [f"t.curie AS `{column}`" if column == term_columns["term"] else
+                       f"COALESCE(x.`{column}`, t.{encoded_values[column]}) AS `{column}`"
+                       if column in encoded_values else f"x.`{column}`" for column in column_types]
+    return table_name, (f"SELECT {', '.join(decoded_columns)} FROM {encoded_table} x "
+                        f"JOIN {TERMS_TABLE} t ON t.id = x.TermID")
+
+
+def get_compact_search_query(dataset_name="opengwas", ontology_name="efo", include_subclasses=True,
+                             direct_subclasses_only=False):
+    """
+    Get the query of a compact database that gives the same results, with the same parameters, as
+    query_database.get_search_query. The subclasses of the search term are joined to its mappings by term ID, instead
+    of by CURIE through the views of the tables
+    """
+    mappings_table = get_encoded_table_name(dataset_name + "_mappings")
+    edges_table = get_encoded_table_name(ontology_name + ("_edges" if direct_subclasses_only else "_entailed_edges"))
+    query_terms = f"SELECT id FROM {TERMS_TABLE} WHERE curie = ?"
+    if include_subclasses:
+        query_terms += f"""
+                    UNION
+                    SELECT e.SubjectID FROM {edges_table} e JOIN {TERMS_TABLE} o ON o.id = e.ObjectID
+                    WHERE o.curie = ?"""
+    return f"""WITH query_terms(TermID) AS (
+                    {query_terms})
+                SELECT DISTINCT
+                    x.SourceTermID AS 'OpenGWASID',
+                    x.SourceTerm AS 'OpenGWASTrait',
+                    COALESCE(x.MappedTermLabel, t.label) AS 'OntologyTerm',
+                    t.curie AS 'OntologyTermID',
+                    x.MappingScore AS 'MappingConfidence'
+                FROM query_terms q
+                JOIN {mappings_table} x ON x.TermID = q.TermID
+                JOIN {TERMS_TABLE} t ON t.id = x.TermID
+                ORDER BY x.SourceTermID"""
+
+
+# Check whether the given view query has the same (distinct) rows as the given table
+def _has_same_rows(connection, table_name, view_query):
+    for first, second in ((f"SELECT * FROM {table_name}", view_query), (view_query, f"SELECT * FROM {table_name}")):
+        if connection.execute(f"SELECT EXISTS ({first} EXCEPT {second})").fetchone()[0]:
+            return False
+    return True
+
+
+# Get the size of the given file compressed with xz, as in the .tar.xz archive of the database
+def _get_compressed_size(file):
+    compressor = lzma.LZMACompressor()
+    size = 0
+    with open(file, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b""):
+            size += len(compressor.compress(chunk))
+    return size + len(compressor.flush())
+
+
+# Convert a copy of the given database to the compact layout, and report the sizes of both databases (and,
+#  optionally, of their xz-compressed files) and the latencies of the same searches in both, checking that their
+#  results are the same
+def benchmark_compact_schema(database_file, compact_database_file="", dataset_name="opengwas", ontology_names=("efo",),
+                             term_count=50, repetitions=3, compressed_sizes=False):
+    from query_database import SearchEngine
+    if compact_database_file == "":
+        compact_database_file = os.path.splitext(database_file)[0] + "_compact.db"
+    shutil.copyfile(database_file, compact_database_file)
+    connection = sqlite3.connect(compact_database_file)
+    compact_database(connection, dataset_name=dataset_name, ontology_names=list(ontology_names))
+    connection.execute("ANALYZE")
+    connection.execute("VACUUM")
+    connection.close()
+
+    print(f"Row and compact layouts of {database_file}:")
+    for layout, file in (("row", database_file), ("compact", compact_database_file)):
+        size = f"\t{layout}: {os.path.getsize(file) / 2 ** 20:.1f} MiB"
+        if compressed_sizes:
+            size += f" ({_get_compressed_size(file) / 2 ** 20:.1f} MiB compressed)"
+        print(size)
+    with SearchEngine(database_file, dataset_name=dataset_name, ontology_name=ontology_names[0]) as row_engine, \
+            SearchEngine(compact_database_file, dataset_name=dataset_name,
+                         ontology_name=ontology_names[0]) as compact_engine:
+        search_terms = [row[0] for row in row_engine.connection.execute(
+            f"SELECT Subject FROM {ontology_names[0]}_labels WHERE Direct + Inherited > 0 "
+            f"ORDER BY Direct + Inherited DESC, Subject LIMIT ?", (term_count,))]
+        for include_subclasses, direct_subclasses_only in ((False, False), (True, True), (True, False)):
+            latencies = {"row": [], "compact": []}
+            mismatches = 0
+            for _ in range(repetitions):
+                for search_term in search_terms:
+                    results = {}
+                    for layout, engine in (("row", row_engine), ("compact", compact_engine)):
+                        start = time.perf_counter()
+                        results[layout] = engine.resources_annotated_with_term(search_term, include_subclasses,
+                                                                               direct_subclasses_only)
+                        latencies[layout].append(time.perf_counter() - start)
+                    mismatches += not results["row"].equals(results["compact"])
+            print(f"\tinclude_subclasses={include_subclasses}, direct_subclasses_only={direct_subclasses_only}: " +
+                  ", ".join(f"{layout} p50 {np.percentile(layout_latencies, 50) * 1000:.1f} ms, "
+                            f"p95 {np.percentile(layout_latencies, 95) * 1000:.1f} ms"
+                            for layout, layout_latencies in latencies.items()) +
+                  f", {mismatches} searches with different results")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compare the row and compact layouts of a search database")
+    parser.add_argument("database_file", nargs="?", default="../opengwas_search.db")
+    parser.add_argument("compact_database_file", nargs="?", default="",
+                        help="file of the compact copy of the database (by default '<database>_compact.db')")
+    parser.add_argument("--compressed-sizes", action="store_true",
+                        help="also report the sizes of the databases compressed with xz (slow)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    benchmark_compact_schema(arguments.database_file, arguments.compact_database_file,
+                             compressed_sizes=arguments.compressed_sizes)
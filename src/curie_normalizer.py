@@ -0,0 +1,204 @@
+import bioregistry
+import pandas as pd
+
+__version__ = "0.1.0"
+
+DBPEDIA_IRI = "http://dbpedia.org"
+DBPEDIA_RESOURCE_IRI = "http://dbpedia.org/resource/"
+DBPEDIA_PREFIX = "DBR"
+
+# Characters after which an IRI 'stem' (i.e., its namespace) ends, e.g. 'http://purl.obolibrary.org/obo/MONDO_'
+STEM_DELIMITERS = "/#_:=?&"
+STEM_PATTERN = "^(.*[" + STEM_DELIMITERS + "])"
+
+# Placeholder identifier used to derive a single IRI template per CURIE prefix
+TEMPLATE_IDENTIFIER = "0000000TEMPLATE0000000"
+
+
+class CurieNormalizer:
+    """
+    Converts IRIs to CURIEs (and CURIEs back to IRIs) over entire data frame columns. Values are de-duplicated before
+    being resolved and the results are memoized across calls, so each distinct value is resolved at most once.
+
+    IRIs are resolved using a precompiled copy of the Bioregistry prefix map, organised as a hash table of URI
+    prefixes bucketed by length for longest-prefix lookups. The lookup is done once per IRI stem (the part of the IRI
+    up to its last delimiter), and the identifiers are then attached to the resolved prefixes. This is equivalent to
+    calling bioregistry.curie_from_iri on every value, followed by the CURIE formatting rules in _format_curies.
+    """
+
+    def __init__(self, prefix_map=None, iri_priority=("obofoundry", "default", "bioregistry")):
+        if prefix_map is None:
+            prefix_map = bioregistry.manager.converter.reverse_prefix_map  # maps URI prefixes to CURIE prefixes
+        self.iri_priority = list(iri_priority)
+        self._uri_prefixes = dict(prefix_map)
+        self._uri_prefix_lengths = sorted({len(uri_prefix) for uri_prefix in self._uri_prefixes}, reverse=True)
+        # Stems that are a proper prefix of some URI prefix. IRIs with these stems may match a URI prefix longer than
+        #  their stem, so they are resolved individually rather than by stem
+        self._extended_stems = set()
+        for uri_prefix in self._uri_prefixes:
+            for index, character in enumerate(uri_prefix[:-1]):
+                if character in STEM_DELIMITERS:
+                    self._extended_stems.add(uri_prefix[:index + 1])
+        self._stem_cache = {}
+        self._curie_cache = {}
+        self._iri_cache = {}
+        self._iri_templates = {}
+        self.reset_profile()
+
+    def reset_profile(self):
+        self._profile = dict.fromkeys(["values", "candidates", "unique", "cache_hits", "cache_misses",
+                                       "stem_lookups", "iri_lookups", "unresolved", "iri_values", "iri_unique",
+                                       "iri_cache_hits", "iri_cache_misses", "iri_fallbacks"], 0)
+
+    def profile(self):
+        """
+        Get the hit/miss profile of this normalizer since it was created or since the last call to reset_profile()
+        :return: dictionary with the counts of values seen, unique values resolved, cache hits and misses, prefix
+            lookups done per stem and per IRI, IRIs that could not be resolved to a CURIE, and the equivalent counts
+            for CURIE-to-IRI conversions
+        """
+        return dict(self._profile)
+
+    def profile_summary(self):
+        p = self._profile
+        return f"{p['values']} values, {p['unique']} unique IRIs ({p['cache_hits']} cache hits, " \
+               f"{p['cache_misses']} misses), {p['stem_lookups']} stem and {p['iri_lookups']} IRI prefix lookups, " \
+               f"{p['unresolved']} unresolved; {p['iri_values']} CURIEs to IRIs ({p['iri_cache_hits']} cache hits, " \
+               f"{p['iri_cache_misses']} misses, {p['iri_fallbacks']} resolved individually)"
+
+    def normalize_series(self, series):
+        """
+        Replace IRIs in the given series with CURIEs. Values that are missing or do not contain '<' or 'http' are
+        returned unchanged, and values containing comma-separated IRIs are converted to comma-separated CURIEs
+        """
+        self._profile["values"] += len(series)
+        if series.empty:
+            return series
+        strings = series.astype(str)
+        mask = series.notna() & (strings.str.contains("<", regex=False) | strings.str.contains("http", regex=False))
+        if not mask.any():
+            return series
+        candidates = series[mask]
+        unique_values = pd.unique(candidates)
+        missing = [value for value in unique_values if value not in self._curie_cache]
+        self._profile["candidates"] += len(candidates)
+        self._profile["unique"] += len(unique_values)
+        self._profile["cache_hits"] += len(unique_values) - len(missing)
+        self._profile["cache_misses"] += len(missing)
+        if missing:
+            self._curie_cache.update(self._resolve_terms(missing))
+        series = series.copy()
+        series[mask] = candidates.map(self._curie_cache)
+        return series
+
+    def normalize(self, term):
+        return self.normalize_series(pd.Series([term], dtype=object)).iloc[0]
+
+    def get_iris(self, series):
+        """
+        Get the IRIs of the CURIEs in the given series. CURIEs of a prefix are expanded from a single IRI template
+        for that prefix, which is checked against Bioregistry; prefixes whose template cannot be verified are
+        expanded by calling bioregistry.get_iri on each CURIE
+        """
+        self._profile["iri_values"] += len(series)
+        if series.empty:
+            return pd.Series([], index=series.index, dtype=object)
+        unique_curies = pd.unique(series.dropna())
+        missing = [curie for curie in unique_curies if curie not in self._iri_cache]
+        self._profile["iri_unique"] += len(unique_curies)
+        self._profile["iri_cache_hits"] += len(unique_curies) - len(missing)
+        self._profile["iri_cache_misses"] += len(missing)
+        for curie in missing:
+            self._iri_cache[curie] = self._get_iri(curie)
+        return series.map(self._iri_cache)
+
+    def _get_iri(self, curie):
+        if DBPEDIA_PREFIX in curie:
+            return DBPEDIA_RESOURCE_IRI + curie.split(":")[1]
+        prefix, separator, identifier = curie.partition(":")
+        if not separator:
+            return self._get_iri_from_bioregistry(curie)
+        if prefix not in self._iri_templates:
+            self._iri_templates[prefix] = self._get_iri_template(prefix, identifier)
+        template = self._iri_templates[prefix]
+        if template is None:
+            return self._get_iri_from_bioregistry(curie)
+        return template[0] + identifier + template[1]
+
+    def _get_iri_template(self, prefix, identifier):
+        template_iri = bioregistry.get_iri(prefix + ":" + TEMPLATE_IDENTIFIER, priority=self.iri_priority)
+        if template_iri is None or template_iri.count(TEMPLATE_IDENTIFIER) != 1:
+            return None
+        template = tuple(template_iri.split(TEMPLATE_IDENTIFIER))
+        # Bioregistry may standardize identifiers of some prefixes, in which case templates would not be exact
+        if template[0] + identifier + template[1] != self._get_iri_from_bioregistry(prefix + ":" + identifier):
+            return None
+        return template
+
+    def _get_iri_from_bioregistry(self, curie):
+        self._profile["iri_fallbacks"] += 1
+        return bioregistry.get_iri(curie, priority=self.iri_priority)
+
+    def _resolve_terms(self, terms):
+        terms = pd.Series(terms, dtype=object)
+        cleaned = terms.str.replace("<", "", regex=False).str.replace(">", "", regex=False)
+        is_list = cleaned.str.contains(",", regex=False)
+        tokens = cleaned[is_list].str.split(",").apply(lambda token_list: [token.strip() for token in token_list])
+        iris = pd.unique(pd.concat([cleaned[~is_list], tokens.explode()], ignore_index=True).dropna())
+        curies = self._resolve_iris(iris)
+        resolved = cleaned[~is_list].map(curies)
+        resolved_lists = tokens.apply(lambda token_list: ",".join(curies[token] for token in token_list))
+        resolved = pd.concat([resolved, resolved_lists]).reindex(terms.index)
+        return dict(zip(terms, resolved))
+
+    def _resolve_iris(self, iris):
+        iris = pd.Series(iris, dtype=object)
+        stems = iris.str.extract(STEM_PATTERN, expand=False)
+        for stem in pd.unique(stems.dropna()):
+            if stem not in self._stem_cache:
+                if stem in self._extended_stems:
+                    self._stem_cache[stem] = False  # must be resolved per IRI
+                else:
+                    self._stem_cache[stem] = self._longest_uri_prefix(stem)
+                    self._profile["stem_lookups"] += 1
+        prefixes, identifiers = [], []
+        for iri, stem in zip(iris, stems):
+            match = self._stem_cache[stem] if isinstance(stem, str) else False
+            if match is False:
+                match = self._longest_uri_prefix(iri)
+                self._profile["iri_lookups"] += 1
+            if match is None:
+                prefixes.append(None)
+                identifiers.append(None)
+            else:
+                prefixes.append(match[1])
+                identifiers.append(iri[len(match[0]):])
+        curies = pd.Series(prefixes, dtype=object) + ":" + pd.Series(identifiers, dtype=object)
+        curies = _format_curies(curies)
+        unresolved = curies.isna()
+        self._profile["unresolved"] += int(unresolved.sum())
+        curies[unresolved] = _get_unresolved_curies(iris[unresolved])
+        return dict(zip(iris, curies))
+
+    def _longest_uri_prefix(self, iri):
+        for length in self._uri_prefix_lengths:
+            if length <= len(iri):
+                uri_prefix = iri[:length]
+                if uri_prefix in self._uri_prefixes:
+                    return uri_prefix, self._uri_prefixes[uri_prefix]
+        return None
+
+
+def _format_curies(curies):
+    curies = curies.str.upper()
+    curies = curies.str.replace("OBO:", "obo:", regex=False)
+    curies = curies.str.replace("NCBITAXON:", "NCBITaxon:", regex=False)
+    return curies
+
+
+# IRIs that have no CURIE are kept as-is, except for DBpedia resources which get a 'DBR' CURIE
+def _get_unresolved_curies(iris):
+    if iris.empty:
+        return iris
+    is_dbpedia = iris.str.contains(DBPEDIA_IRI, regex=False)
+    return iris.where(~is_dbpedia, DBPEDIA_PREFIX + ":" + iris.str.rsplit("/", n=1).str[1])
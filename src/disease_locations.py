@@ -0,0 +1,146 @@
+import sys
+import time
+import pandas as pd
+from collections import deque
+
+__version__ = "0.1.0"
+
+DISEASE_LOCATION_PROPERTY = "EFO:0000784"  # 'has disease location'
+DISEASE_LOCATION_VIEWS = ("owl_subclass_of_some_values_from", "owl_subclass_of_only_values_from")
+
+
+class DiseaseLocationResolver:
+    """
+    Computes the disease location(s) of all ontology classes in a SemanticSQL database in one pass. The subClassOf
+    edges and the existential and universal disease location restrictions are each loaded with a single query, and
+    the nearest-ancestor disease locations are then propagated from parents to children in topological order.
+
+    The results are the same as those of a breadth-first search from each class up its superclass hierarchy that
+    stops at the first class (in BFS order) with disease location restrictions. Existential restrictions take
+    precedence over universal ones, and blank nodes and owl:Thing are ignored.
+    """
+
+    def __init__(self, connection, location_property=DISEASE_LOCATION_PROPERTY, views=DISEASE_LOCATION_VIEWS):
+        self._parents = self._load_parents(connection)
+        self._own_locations = self._load_locations(connection, location_property, views)
+        self._locations = self._resolve_all()
+
+    def get_disease_location(self, term):
+        return self._locations.get(term, pd.NA)
+
+    def get_disease_locations(self, terms):
+        return pd.Series([self._locations.get(term, pd.NA) for term in terms], index=terms.index, dtype=object)
+
+    @staticmethod
+    def _load_parents(connection):
+        edges = pd.read_sql_query("SELECT subject, object FROM edge WHERE predicate='rdfs:subClassOf'", connection)
+        edges = edges[~edges["object"].str.startswith("_", na=False)]  # remove blank nodes
+        edges = edges[edges["object"] != "owl:Thing"]
+        edges = edges.drop_duplicates()
+        return edges.groupby("subject", sort=False)["object"].agg(list).to_dict()
+
+    @staticmethod
+    def _load_locations(connection, location_property, views):
+        own_locations = {}
+        for view in views:
+            locations = pd.read_sql_query(f"SELECT subject, object FROM {view} WHERE predicate=?", connection,
+                                          params=(location_property,))
+            locations = locations[~locations["object"].str.startswith("_", na=False)]  # remove blank nodes
+            for subject, objects in locations.groupby("subject", sort=False)["object"].agg(list).items():
+                own_locations.setdefault(subject, objects)  # existential restrictions are checked first
+        return {subject: ",".join(objects) for subject, objects in own_locations.items()}
+
+    def _resolve_all(self):
+        # Integer-code the classes and order them such that every class comes after all of its superclasses
+        nodes = list(dict.fromkeys([*self._parents.keys(),
+                                    *(parent for parents in self._parents.values() for parent in parents),
+                                    *self._own_locations.keys()]))
+        node_ids = {node: index for index, node in enumerate(nodes)}
+        parents = [[node_ids[parent] for parent in self._parents.get(node, ())] for node in nodes]
+        children = [[] for _ in nodes]
+        pending_parents = [len(node_parents) for node_parents in parents]
+        for child, node_parents in enumerate(parents):
+            for parent in node_parents:
+                children[parent].append(child)
+        queue = deque(index for index, count in enumerate(pending_parents) if count == 0)
+
+        # For each class, keep the distance to its nearest ancestor with locations and those locations. BFS visits
+        #  superclasses in the order they are listed, so on ties the first parent's result is kept
+        nearest = [None] * len(nodes)
+        resolved = [False] * len(nodes)
+        while queue:
+            node = queue.popleft()
+            resolved[node] = True
+            own_locations = self._own_locations.get(nodes[node])
+            if own_locations is not None:
+                nearest[node] = (0, own_locations)
+            else:
+                for parent in parents[node]:
+                    parent_nearest = nearest[parent]
+                    if parent_nearest is not None and \
+                            (nearest[node] is None or parent_nearest[0] + 1 < nearest[node][0]):
+                        nearest[node] = (parent_nearest[0] + 1, parent_nearest[1])
+            for child in children[node]:
+                pending_parents[child] -= 1
+                if pending_parents[child] == 0:
+                    queue.append(child)
+
+        locations = {nodes[node]: node_nearest[1] for node, node_nearest in enumerate(nearest)
+                     if node_nearest is not None}
+        # Classes in (or below) subClassOf cycles cannot be ordered topologically, so search their ancestors instead
+        for node in (index for index, is_resolved in enumerate(resolved) if not is_resolved):
+            node_locations = self._search_ancestors(nodes[node])
+            if node_locations is not None:
+                locations[nodes[node]] = node_locations
+        return locations
+
+    def _search_ancestors(self, term):
+        queue = deque([term])
+        visited = {term}
+        while queue:
+            current_term = queue.popleft()
+            if current_term in self._own_locations:
+                return self._own_locations[current_term]
+            for parent in self._parents.get(current_term, ()):
+                if parent not in visited:
+                    visited.add(parent)
+                    queue.append(parent)
+        return None
+
+
+# Compare the time taken to get the disease locations of (a sample of) the classes in the given SemanticSQL database
+#  using a per-term breadth-first search over SQL queries versus using the DiseaseLocationResolver
+def benchmark_disease_locations(db_file, sample_size=1000):
+    from generate_ontology_tables import _add_views, _get_labels_table, _get_disease_location_for_term, \
+        connect_semsql_db
+    connection = connect_semsql_db(db_file)
+    cursor = connection.cursor()
+    _add_views(cursor)
+    terms = _get_labels_table(cursor)["Subject"]
+    sample = terms if sample_size is None or sample_size >= len(terms) else terms.sample(sample_size, random_state=0)
+
+    start = time.time()
+    per_term_locations = sample.apply(_get_disease_location_for_term, connection=connection)
+    per_term_time = time.time() - start
+
+    start = time.time()
+    resolver = DiseaseLocationResolver(connection)
+    bulk_locations = resolver.get_disease_locations(terms)
+    bulk_time = time.time() - start
+    cursor.close()
+    connection.close()
+
+    mismatches = (per_term_locations.fillna("") != bulk_locations[sample.index].fillna("")).sum()
+    estimated_per_term_time = per_term_time * len(terms) / len(sample)
+    print(f"Disease locations for {len(terms)} classes in {db_file}:")
+    print(f"\tper-term search: {per_term_time:.1f} seconds for {len(sample)} classes "
+          f"(~{estimated_per_term_time:.1f} seconds for all classes)")
+    print(f"\tbulk resolver: {bulk_time:.1f} seconds for all classes "
+          f"(~{estimated_per_term_time / max(bulk_time, 1e-9):.0f}x faster)")
+    print(f"\tmismatches in sample: {mismatches}")
+    return estimated_per_term_time, bulk_time, mismatches
+
+
+if __name__ == "__main__":
+    benchmark_disease_locations(db_file=sys.argv[1] if len(sys.argv) > 1 else "../resources/efo.db",
+                                sample_size=int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import hashlib
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where lock files are used instead
+    fcntl = None
+
+__version__ = "0.1.0"
+
+CHUNK_SIZE = 1024 * 1024
+LOCK_POLL_INTERVAL = 0.5
+
+
+class DownloadCache:
+    """
+    Download cache for (optionally gzip-compressed) files such as SemanticSQL ontology databases, which can be shared
+    by several builds. The layout of the cache folder is:
+        urls/<key>.json     metadata about the last download of the URL with the given key (a hash of the URL):
+                            its ETag, Last-Modified date, size and the SHA-256 checksum of the downloaded content
+        partial/<key>.part  bytes downloaded so far for an unfinished download of the URL, used to resume it
+        objects/<sha256>    (decompressed) files, named after the checksum of their downloaded content
+        locks/<key>.lock    lock files that serialize downloads of the same URL across processes
+
+    A cached file is only reused after a conditional request (If-None-Match/If-Modified-Since) confirms it is still
+    current, or if the server cannot be reached. Compressed content is decompressed as it is downloaded into a
+    temporary file, which is renamed to its final name once the download is complete and its checksum verified.
+    """
+
+    def __init__(self, cache_folder, timeout=60, chunk_size=CHUNK_SIZE):
+        self.cache_folder = cache_folder
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        for folder in ("urls", "partial", "objects", "locks"):
+            os.makedirs(os.path.join(cache_folder, folder), exist_ok=True)
+
+    def get(self, url, expected_sha256=None, decompress=None):
+        """
+        Get the local path of the file at the given URL, downloading it if it is not cached or has changed
+        :param url: URL of the file (http, https or file)
+        :param expected_sha256: optional SHA-256 checksum that the downloaded content must have
+        :param decompress: gunzip the downloaded content. By default, only content of URLs ending in .gz is decompressed
+        :return: path to the (decompressed) file in the cache
+        """
+        if decompress is None:
+            decompress = url.endswith(".gz")
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        with self._lock(key):
+            metadata = self._read_metadata(key)
+            cached_file = self._get_cached_file(metadata, expected_sha256)
+            try:
+                return self._download(url, key, metadata, cached_file, expected_sha256, decompress)
+            except (urllib.error.URLError, OSError) as error:
+                if cached_file is None:
+                    raise
+                print(f"...warning: could not check {url} for updates ({error}). Using cached file {cached_file}")
+                return cached_file
+
+    def _download(self, url, key, metadata, cached_file, expected_sha256, decompress):
+        partial_file = os.path.join(self.cache_folder, "partial", key + ".part")
+        partial_size = os.path.getsize(partial_file) if os.path.isfile(partial_file) else 0
+        request = urllib.request.Request(url)
+        if cached_file is not None:
+            if metadata.get("etag"):
+                request.add_header("If-None-Match", metadata["etag"])
+            if metadata.get("last_modified"):
+                request.add_header("If-Modified-Since", metadata["last_modified"])
+        elif partial_size > 0 and metadata.get("partial_validator"):
+            request.add_header("Range", f"bytes={partial_size}-")
+            request.add_header("If-Range", metadata["partial_validator"])
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as error:
+            if error.code == 304 and cached_file is not None:
+                return cached_file
+            if error.code == 416:  # the partial download is no longer valid
+                os.remove(partial_file)
+                return self._download(url, key, metadata, cached_file, expected_sha256, decompress)
+            raise
+        with response:
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            content_length = response.headers.get("Content-Length")
+            # file:// URLs do not support conditional requests, so compare the modification dates and sizes instead
+            if cached_file is not None and response.status is None and \
+                    last_modified == metadata.get("last_modified") and content_length == str(metadata.get("size")):
+                return cached_file
+            if response.status != 206:
+                partial_size = 0
+            metadata = {"url": url, "etag": etag, "last_modified": last_modified,
+                        "partial_validator": etag or last_modified}
+            self._write_metadata(key, metadata)
+            print(f"Downloading {url}" + (f" (resuming from byte {partial_size})..." if partial_size else "..."))
+            sha256, size, temporary_file = self._stream_to_cache(response, partial_file, partial_size, decompress)
+
+        # A connection closed before the end of the content only ends the stream, so the size received is checked. The
+        #  partial download is kept, to be resumed by the next request
+        if content_length is not None and size != partial_size + int(content_length):
+            os.remove(temporary_file)
+            raise ConnectionError(f"Download of {url} was interrupted after {size} of "
+                                  f"{partial_size + int(content_length)} bytes")
+        if expected_sha256 is not None and sha256 != expected_sha256:
+            os.remove(temporary_file)
+            os.remove(partial_file)
+            raise ValueError(f"Checksum of {url} is {sha256}, but expected {expected_sha256}")
+        object_file = os.path.join(self.cache_folder, "objects", sha256)
+        os.replace(temporary_file, object_file)
+        os.remove(partial_file)
+        metadata.update({"sha256": sha256, "size": size, "decompressed": decompress})
+        metadata.pop("partial_validator")
+        self._write_metadata(key, metadata)
+        return object_file
+
+    # Append the response content to the partial download, hashing and (optionally) decompressing it into a temporary
+    #  file as it goes. Any previously downloaded bytes are replayed from the partial download first
+    def _stream_to_cache(self, response, partial_file, partial_size, decompress):
+        sha256 = hashlib.sha256()
+        decompressor = _GzipStreamDecompressor() if decompress else None
+        temporary_file = os.path.join(self.cache_folder, "objects", f".{uuid.uuid4().hex}.tmp")
+        try:
+            size = self._write_stream(response, partial_file, partial_size, temporary_file, sha256, decompressor)
+        except BaseException:
+            if os.path.isfile(temporary_file):
+                os.remove(temporary_file)
+            raise
+        return sha256.hexdigest(), size, temporary_file
+
+    def _write_stream(self, response, partial_file, partial_size, temporary_file, sha256, decompressor):
+        size = 0
+        with open(temporary_file, "wb") as file_out:
+            def consume(chunk):
+                sha256.update(chunk)
+                file_out.write(decompressor.decompress(chunk) if decompressor is not None else chunk)
+
+            with open(partial_file, "r+b" if partial_size else "wb") as partial_out:
+                partial_out.truncate(partial_size)
+                while size < partial_size:
+                    chunk = partial_out.read(min(self.chunk_size, partial_size - size))
+                    consume(chunk)
+                    size += len(chunk)
+                partial_out.seek(partial_size)
+                for chunk in iter(lambda: response.read(self.chunk_size), b""):
+                    partial_out.write(chunk)
+                    consume(chunk)
+                    size += len(chunk)
+            if decompressor is not None:
+                file_out.write(decompressor.flush())
+            file_out.flush()
+            os.fsync(file_out.fileno())
+        return size
+
+    def _get_cached_file(self, metadata, expected_sha256):
+        sha256 = metadata.get("sha256")
+        if sha256 is None or (expected_sha256 is not None and sha256 != expected_sha256):
+            return None
+        cached_file = os.path.join(self.cache_folder, "objects", sha256)
+        return cached_file if os.path.isfile(cached_file) else None
+
+    def _read_metadata(self, key):
+        metadata_file = os.path.join(self.cache_folder, "urls", key + ".json")
+        if not os.path.isfile(metadata_file):
+            return {}
+        with open(metadata_file) as file_in:
+            return json.load(file_in)
+
+    def _write_metadata(self, key, metadata):
+        metadata_file = os.path.join(self.cache_folder, "urls", key + ".json")
+        temporary_file = metadata_file + f".{uuid.uuid4().hex}.tmp"
+        with open(temporary_file, "w") as file_out:
+            json.dump(metadata, file_out, indent=2)
+        os.replace(temporary_file, metadata_file)
+
+    @contextmanager
+    def _lock(self, key):
+        lock_file = os.path.join(self.cache_folder, "locks", key + ".lock")
+        if fcntl is not None:
+            with open(lock_file, "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        else:
+            while True:
+                try:
+                    lock = os.open(lock_file, os.O_CREAT | os.O_EXCL)
+                    break
+                except FileExistsError:
+                    time.sleep(LOCK_POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                os.close(lock)
+                os.remove(lock_file)
+
+
+# Incremental decompressor for gzip streams, including streams made of multiple gzip members
+class _GzipStreamDecompressor:
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        output = []
+        while data:
+            output.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return b"".join(output)
+
+    def flush(self):
+        return self._decompressor.flush()
@@ -1,5 +1,6 @@
 import uuid
 import pandas as pd
+from collections import deque
 from owlready2 import *
 
 __version__ = "0.8.2"
@@ -25,11 +26,13 @@ def get_mapping_counts_to_ontologies(mappings_df, ontologies_df,
                                      mapped_term_iri_col=MAPPED_TERM_IRI_COL,
                                      save_ontology=SAVE_ONTOLOGY,
                                      use_reasoning=USE_REASONING,
-                                     ontology_term_blocklist=TERM_BLOCKLIST):
+                                     ontology_term_blocklist=TERM_BLOCKLIST,
+                                     snapshot_store=None):
     all_mappings = pd.DataFrame()
     for index, row in ontologies_df.iterrows():
         ontology_name = row['acronym']
         ontology_iri = row['url']
+        ontology_version = row.get('version', "")
         ontology_mappings_df = mappings_df[mappings_df[ONTOLOGY_COL] == ontology_name]
         ontology_mappings_counts = get_mapping_counts(mappings_df=ontology_mappings_df,
                                                       ontology_iri=ontology_iri,
@@ -39,7 +42,9 @@ def get_mapping_counts_to_ontologies(mappings_df, ontologies_df,
                                                       mapped_term_iri_col=mapped_term_iri_col,
                                                       save_ontology=save_ontology,
                                                       use_reasoning=use_reasoning,
-                                                      ontology_term_blocklist=ontology_term_blocklist)
+                                                      ontology_term_blocklist=ontology_term_blocklist,
+                                                      snapshot_store=snapshot_store,
+                                                      ontology_version=ontology_version)
         ontology_mappings_counts[ONTOLOGY_COL] = ontology_name
         all_mappings = pd.concat([all_mappings, ontology_mappings_counts])
     return all_mappings
@@ -52,7 +57,14 @@ def get_mapping_counts(mappings_df, ontology_iri,
                        mapped_term_iri_col=MAPPED_TERM_IRI_COL,
                        save_ontology=SAVE_ONTOLOGY,
                        use_reasoning=USE_REASONING,
-                       ontology_term_blocklist=TERM_BLOCKLIST):
+                       ontology_term_blocklist=TERM_BLOCKLIST,
+                       snapshot_store=None,
+                       ontology_version=""):
+    if snapshot_store is not None and not save_ontology and not use_reasoning:
+        return _get_mapping_counts_from_snapshot(mappings_df, ontology_iri, ontology_version, snapshot_store,
+                                                 source_term_id_col=source_term_id_col,
+                                                 mapped_term_iri_col=mapped_term_iri_col,
+                                                 ontology_term_blocklist=ontology_term_blocklist)
     print(f"Computing mapping counts for {ontology_iri}...")
     start = time.time()
     ontology_world = World()
@@ -83,6 +95,172 @@ def get_mapping_counts(mappings_df, ontology_iri,
     return output_df
 
 
+# Get the mapping counts from the edges between the classes of the given ontology version, read from its snapshot (an
+#  OntologySnapshotStore) rather than by parsing the ontology. As owlready2 does when getting the instances of a class,
+#  the named subClassOf edges are followed upwards, and the named equivalentClass edges in both directions
+def _get_mapping_counts_from_snapshot(mappings_df, ontology_iri, ontology_version, snapshot_store,
+                                      source_term_id_col, mapped_term_iri_col, ontology_term_blocklist):
+    print(f"Computing mapping counts for {ontology_iri} (version {ontology_version or 'unspecified'})...")
+    world, ontology = snapshot_store.open(ontology_iri, ontology_version)
+    try:
+        graph = world.graph
+        iris = pd.Series(dict(graph.execute("SELECT storid, iri FROM resources").fetchall()))
+        classes = [storid for storid, in graph.execute("SELECT s FROM objs WHERE c=? AND p=? AND o=? AND s>0",
+                                                       (ontology.graph.c, rdf_type, owl_class))]
+        subclass_edges = graph.execute("SELECT s, o FROM objs WHERE p=? AND s>0 AND o>0", (rdfs_subclassof,))
+        equivalent_edges = graph.execute("SELECT s, o FROM objs WHERE p=? AND s>0 AND o>0", (owl_equivalentclass,))
+        edges = pd.DataFrame(subclass_edges.fetchall(), columns=["Subject", "Object"], dtype="int64")
+        equivalent_edges = pd.DataFrame(equivalent_edges.fetchall(), columns=["Subject", "Object"], dtype="int64")
+    finally:
+        world.close()
+    edges = pd.concat([edges, equivalent_edges, equivalent_edges.rename(columns={"Subject": "Object",
+                                                                                 "Object": "Subject"})])
+    edges_df = pd.DataFrame({"Subject": iris.reindex(edges["Subject"]).values,
+                             "Object": iris.reindex(edges["Object"]).values}).dropna()
+    class_iris = iris.reindex(classes).dropna()
+    # Classes of other ontologies in the world (e.g., imported ones) can also be mapped to, and are also counted
+    other_iris = pd.Index(pd.concat([edges_df["Subject"], edges_df["Object"]]).unique()).difference(class_iris)
+    terms = pd.concat([class_iris, pd.Series(other_iris)], ignore_index=True)
+    counts_df = get_mapping_counts_from_edges(mappings_df=mappings_df,
+                                              terms_df=pd.DataFrame({"Subject": terms, "IRI": terms}),
+                                              edges_df=edges_df,
+                                              source_term_id_col=source_term_id_col,
+                                              mapped_term_iri_col=mapped_term_iri_col,
+                                              ontology_term_blocklist=ontology_term_blocklist)
+    return counts_df[counts_df["IRI"].isin(class_iris)].reset_index(drop=True)
+
+
+# Get the same counts as get_mapping_counts, but computed from the subClassOf edges between ontology terms rather than
+#  from OWL individuals in an owlready2 world. Terms and resources are integer-coded, and the set of resources mapped
+#  to each term or any of its descendants is kept as a bitset (a Python int) that is propagated from each term to its
+#  parents in a single pass over the terms in topological order. The given edges (with the child term as subject and
+#  the parent term as object) can be the asserted edges, as followed by owlready2, or their transitive closure
+#  (the entailed edges), for which the result is the same. Mappings to multiple (comma-separated) IRIs only count as
+#  inherited mappings of each of those terms, as in get_mapping_counts
+def get_mapping_counts_from_edges(mappings_df, terms_df, edges_df,
+                                  source_term_id_col=SOURCE_TERM_ID_COL,
+                                  mapped_term_iri_col=MAPPED_TERM_IRI_COL,
+                                  ontology_term_blocklist=TERM_BLOCKLIST,
+                                  term_col="Subject", term_iri_col="IRI",
+                                  edge_subject_col="Subject", edge_object_col="Object"):
+    print("Computing mapping counts from ontology edges...")
+    start = time.time()
+    _, term_resources_df = get_term_resources_from_edges(mappings_df, terms_df, edges_df,
+                                                         source_term_id_col=source_term_id_col,
+                                                         mapped_term_iri_col=mapped_term_iri_col,
+                                                         ontology_term_blocklist=ontology_term_blocklist,
+                                                         term_col=term_col, term_iri_col=term_iri_col,
+                                                         edge_subject_col=edge_subject_col,
+                                                         edge_object_col=edge_object_col)
+    output_df = get_mapping_counts_from_term_resources(term_resources_df)
+    print(f"...done ({time.time() - start:.1f} seconds)")
+    return output_df
+
+
+# Get the counts of the resources of each term in the given data frame of term resource bitsets (as returned by
+#  get_term_resources_from_edges)
+def get_mapping_counts_from_term_resources(term_resources_df):
+    return pd.DataFrame({"IRI": term_resources_df["IRI"],
+                         "Direct": [bits.bit_count() for bits in term_resources_df["Direct"]],
+                         "Inherited": [bits.bit_count() for bits in term_resources_df["Inherited"]]},
+                        columns=['IRI', 'Direct', 'Inherited'])
+
+
+# Get the resources mapped directly to each (non-blocklisted) term and those only mapped to its descendants, as the
+#  bitsets computed by get_mapping_counts_from_edges. Bit i of each bitset stands for the i-th resource in the returned
+#  index, which starts with the given resources (if any), in the given order, followed by any other mapped resources
+#  in order of appearance
+#  :return: index of resources and a data frame of term IRIs and their 'Direct' and 'Inherited' resource bitsets
+def get_term_resources_from_edges(mappings_df, terms_df, edges_df,
+                                  source_term_id_col=SOURCE_TERM_ID_COL,
+                                  mapped_term_iri_col=MAPPED_TERM_IRI_COL,
+                                  ontology_term_blocklist=TERM_BLOCKLIST,
+                                  term_col="Subject", term_iri_col="IRI",
+                                  edge_subject_col="Subject", edge_object_col="Object", resources=()):
+    edges_df = edges_df[edges_df[edge_subject_col] != edges_df[edge_object_col]]
+    terms = pd.Index(pd.unique(pd.concat([terms_df[term_col], edges_df[edge_subject_col],
+                                          edges_df[edge_object_col]], ignore_index=True).dropna()))
+    term_count = len(terms)
+    children = terms.get_indexer(edges_df[edge_subject_col])
+    parents = terms.get_indexer(edges_df[edge_object_col])
+    terms_df = terms_df[terms_df[term_iri_col].notna()]
+    term_codes = pd.Series(terms.get_indexer(terms_df[term_col]), index=terms_df[term_iri_col].values)
+    term_codes = term_codes[~term_codes.index.duplicated()]
+
+    # Integer-code the mapped resources, and get the (directly) mapped resources of each term as bitsets
+    mappings_df = mappings_df[mappings_df[source_term_id_col].notna() & mappings_df[mapped_term_iri_col].notna()]
+    resources = pd.Index(pd.unique(pd.concat([pd.Series(resources, dtype=object),
+                                              mappings_df[source_term_id_col].astype(object)], ignore_index=True)))
+    resource_codes = resources.get_indexer(mappings_df[source_term_id_col])
+    mapped_iris = mappings_df[mapped_term_iri_col].astype(str)
+    direct_resources = [0] * term_count
+    _add_resources(direct_resources, term_codes, mapped_iris, resource_codes)
+    descendant_resources = list(direct_resources)
+    multiple_mappings = pd.DataFrame({"IRI": mapped_iris.values, "Resource": resource_codes})
+    multiple_mappings = multiple_mappings[multiple_mappings["IRI"].str.contains(",", regex=False)]
+    multiple_mappings = multiple_mappings.assign(IRI=multiple_mappings["IRI"].str.split(",")).explode("IRI")
+    _add_resources(descendant_resources, term_codes, multiple_mappings["IRI"].str.strip(),
+                   multiple_mappings["Resource"].values)
+
+    # Propagate the resources of each term to its parents, children first
+    term_parents = [[] for _ in range(term_count)]
+    pending_children = [0] * term_count
+    for child, parent in set(zip(children, parents)):
+        term_parents[child].append(parent)
+        pending_children[parent] += 1
+    queue = deque(term for term in range(term_count) if pending_children[term] == 0)
+    propagated = 0
+    while queue:
+        term = queue.popleft()
+        propagated += 1
+        for parent in term_parents[term]:
+            descendant_resources[parent] |= descendant_resources[term]
+            pending_children[parent] -= 1
+            if pending_children[parent] == 0:
+                queue.append(parent)
+    if propagated < term_count:  # terms in (or above) subClassOf cycles, whose descendants are searched instead
+        _add_cyclic_descendant_resources(descendant_resources, term_parents, pending_children)
+
+    output = []
+    for iri, term in term_codes.items():
+        if not any([iri_bit in iri for iri_bit in ontology_term_blocklist]):
+            direct = direct_resources[term]
+            output.append((iri, direct, descendant_resources[term] & ~direct))
+    output_df = pd.DataFrame({column: pd.Series(values, dtype=object)  # (bitsets may not fit in 64 bits)
+                              for column, values in zip(['IRI', 'Direct', 'Inherited'], zip(*output))},
+                             columns=['IRI', 'Direct', 'Inherited'])
+    return resources, output_df
+
+
+# Add the given resources to the bitsets of the terms with the given IRIs
+def _add_resources(term_resources, term_codes, iris, resource_codes):
+    codes = term_codes.reindex(iris.values).values
+    for term, resource in zip(codes, resource_codes):
+        if not pd.isna(term):
+            term_resources[int(term)] |= 1 << int(resource)
+
+
+def _add_cyclic_descendant_resources(descendant_resources, term_parents, pending_children):
+    term_children = [[] for _ in term_parents]
+    for child, parents in enumerate(term_parents):
+        for parent in parents:
+            term_children[parent].append(child)
+    unresolved = [term for term, count in enumerate(pending_children) if count > 0]
+    resolved = {}
+    for term in unresolved:
+        resources, visited, stack = 0, {term}, [term]
+        while stack:
+            current = stack.pop()
+            resources |= descendant_resources[current]
+            for child in term_children[current]:
+                if child not in visited:
+                    visited.add(child)
+                    stack.append(child)
+        resolved[term] = resources
+    for term, resources in resolved.items():
+        descendant_resources[term] = resources
+
+
 def _create_instances(ontology, mappings_df, source_term_id_col, source_term_secondary_id_col,
                       source_term_col, mapped_term_iri_col, save_ontology, use_reasoning):
     with ontology:
@@ -1,44 +1,54 @@
 import os
-import gzip
-import shutil
+import time
 import sqlite3
-import urllib.request
 import bioregistry
 import pandas as pd
+from pathlib import Path
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from curie_normalizer import CurieNormalizer
+from disease_locations import DiseaseLocationResolver
+from download_cache import DownloadCache
+from subclass_closure import SubclassClosure
+from compact_schema import drop_compact_table
 
-__version__ = "0.10.0"
+__version__ = "0.11.0"
 
 SUBJECT_COL = "Subject"
 OBJECT_COL = "Object"
 IRI_COL = "IRI"
 ONTOLOGY_COL = "Ontology"
 DISEASE_LOCATION_COL = "DiseaseLocation"
+SEMSQL_CACHE_FOLDER = "semsql_cache"
 IRI_PRIORITY_LIST = ["obofoundry", "default", "bioregistry"]
 
+_curie_normalizer = None
+
 
 def get_semsql_tables_for_ontologies(ontologies,
                                      tables_output_folder='../ontology-tables',
                                      db_output_folder="../ontology-db",
                                      save_tables=False, single_table_for_all_ontologies=False,
-                                     include_disease_locations=False):
-    all_edges = all_entailed_edges = all_labels = all_dbxrefs = all_synonyms = pd.DataFrame()
-    for ontology in ontologies:
-        ontology_url = "https://s3.amazonaws.com/bbop-sqlite/" + ontology.lower() + ".db.gz"
-        edges, entailed_edges, labels, dbxrefs, synonyms, version = \
-            get_semsql_tables_for_ontology(ontology_url=ontology_url,
-                                           ontology_name=ontology,
-                                           db_output_folder=db_output_folder,
-                                           save_tables=(not single_table_for_all_ontologies),
-                                           include_disease_locations=include_disease_locations)
+                                     include_disease_locations=False, workers=1, native_closure=False):
+    jobs = [dict(ontology_url="https://s3.amazonaws.com/bbop-sqlite/" + ontology.lower() + ".db.gz",
+                 ontology_name=ontology,
+                 db_output_folder=db_output_folder,
+                 save_tables=(not single_table_for_all_ontologies),
+                 include_disease_locations=include_disease_locations,
+                 native_closure=native_closure) for ontology in ontologies]
+    all_labels, all_edges, all_entailed_edges, all_dbxrefs, all_synonyms = [], [], [], [], []
+    for ontology, ontology_tables in zip(ontologies, get_semsql_tables(jobs, workers=workers)):
+        edges, entailed_edges, labels, dbxrefs, synonyms, version = ontology_tables
         if single_table_for_all_ontologies:
             labels[ONTOLOGY_COL] = edges[ONTOLOGY_COL] = entailed_edges[ONTOLOGY_COL] = dbxrefs[ONTOLOGY_COL] = \
                 synonyms[ONTOLOGY_COL] = ontology
-            all_labels = pd.concat([all_labels, labels])
-            all_edges = pd.concat([all_edges, edges])
-            all_entailed_edges = pd.concat([all_entailed_edges, entailed_edges])
-            all_dbxrefs = pd.concat([all_dbxrefs, dbxrefs])
-            all_synonyms = pd.concat([all_synonyms, synonyms])
+            all_labels.append(labels)
+            all_edges.append(edges)
+            all_entailed_edges.append(entailed_edges)
+            all_dbxrefs.append(dbxrefs)
+            all_synonyms.append(synonyms)
+    all_labels, all_edges, all_entailed_edges, all_dbxrefs, all_synonyms = \
+        [_concat_tables(tables) for tables in (all_labels, all_edges, all_entailed_edges, all_dbxrefs, all_synonyms)]
 
     if save_tables and single_table_for_all_ontologies:
         save_table(all_labels, "ontology_labels.tsv", tables_output_folder)
@@ -49,31 +59,46 @@ def get_semsql_tables_for_ontologies(ontologies,
     return all_edges, all_entailed_edges, all_labels, all_dbxrefs, all_synonyms
 
 
+# Call get_semsql_tables_for_ontology with each of the given dictionaries of keyword arguments, and return the results
+#  in the same order. With workers > 1 the ontologies are processed in a pool of worker processes, one per ontology
+def get_semsql_tables(jobs, workers=1):
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        return [get_semsql_tables_for_ontology(**job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_get_semsql_tables_for_job, jobs))
+
+
+def _get_semsql_tables_for_job(job):
+    return get_semsql_tables_for_ontology(**job)
+
+
+def _concat_tables(tables):
+    return pd.concat(tables) if len(tables) > 0 else pd.DataFrame()
+
+
+# Get the edges, entailed edges, labels, cross-references and synonyms tables, and the version, of the given ontology
+#  from its SemanticSQL database. The entailed edges are computed from the edges if the database has no entailed_edge
+#  table, or if native_closure is True (see _get_entailed_edges_table)
 def get_semsql_tables_for_ontology(ontology_url, ontology_name, tables_output_folder='../ontology-tables',
                                    db_output_folder="../ontology-db", save_tables=False,
-                                   include_disease_locations=False):
-    db_file = os.path.join(db_output_folder, ontology_name.lower() + ".db")
-    db_gz_file = db_file + ".gz"
-    if not os.path.isfile(db_file):
-        if not os.path.exists(db_output_folder):
-            os.makedirs(db_output_folder)
-        print(f"Downloading database file for {ontology_name} from {ontology_url}...")
-        urllib.request.urlretrieve(ontology_url, db_gz_file)
-        with gzip.open(db_gz_file, "rb") as file_in, open(db_file, "wb") as file_out:
-            shutil.copyfileobj(file_in, file_out)
+                                   include_disease_locations=False, cache_folder=None, native_closure=False):
+    db_file = get_semsql_db_file(ontology_url, ontology_name, db_output_folder=db_output_folder,
+                                 cache_folder=cache_folder)
     print(f"Generating tables for {ontology_name}...")
-    conn = sqlite3.connect(db_file)
+    conn = connect_semsql_db(db_file)
     cursor = conn.cursor()
     if include_disease_locations:
         _add_views(cursor)  # add database views needed for disease location retrieval
     edges_df = _get_edges_table(cursor)
-    entailed_edges_df = _get_entailed_edges_table(cursor)
+    entailed_edges_df = _get_entailed_edges_table(cursor, edges_df, native_closure=native_closure)
     labels_df = _get_labels_table(cursor, include_disease_locations)
     dbxrefs_df = _get_db_cross_references_table(cursor)
     synonyms_df = _get_synonyms_table(cursor)
     onto_version = _get_ontology_version(cursor)
     if onto_version != "":
         print(f"\t{ontology_name} version: {onto_version}")
+    print(f"\tCURIE normalization: {get_curie_normalizer().profile_summary()}")
     cursor.close()
     conn.close()
     if save_tables:
@@ -85,13 +110,130 @@ def get_semsql_tables_for_ontology(ontology_url, ontology_name, tables_output_fo
     return edges_df, entailed_edges_df, labels_df, dbxrefs_df, synonyms_df, onto_version
 
 
+# Get the path to the SemanticSQL database file of the given ontology. The file is kept in a download cache (by
+#  default in the db_output_folder) that may be shared by several builds, and is only downloaded again if it changed
+#  since it was cached
+def get_semsql_db_file(ontology_url, ontology_name, db_output_folder="../ontology-db", cache_folder=None):
+    if cache_folder is None:
+        cache_folder = os.path.join(db_output_folder, SEMSQL_CACHE_FOLDER)
+    print(f"Getting database file for {ontology_name} from {ontology_url}...")
+    return DownloadCache(cache_folder).get(ontology_url)
+
+
+# Open the given SemanticSQL database read-only. Database files are shared by all the builds that use the same download
+#  cache, so they are never changed: the views added to read them are temporary views of the connection (see _add_views)
+def connect_semsql_db(semsql_db_file):
+    return sqlite3.connect(get_read_only_uri(semsql_db_file), uri=True)
+
+
+def get_read_only_uri(db_file):
+    return Path(db_file).resolve().as_uri() + "?mode=ro"
+
+
+# Get the labels table (see _get_labels_table) and the version of the ontology in the given SemanticSQL database
+def get_semsql_labels_for_ontology(semsql_db_file, include_disease_locations=False):
+    conn = connect_semsql_db(semsql_db_file)
+    cursor = conn.cursor()
+    if include_disease_locations:
+        _add_views(cursor)  # add database views needed for disease location retrieval
+    labels_df = _get_labels_table(cursor, include_disease_locations)
+    onto_version = _get_ontology_version(cursor)
+    cursor.close()
+    conn.close()
+    return labels_df, onto_version
+
+
+# Copy the edges, entailed edges, synonyms and (optionally) cross-references tables of the given SemanticSQL database
+#  into tables named '<table_prefix>_<table>' in the database of the given connection, without loading them into
+#  Python. The SemanticSQL database is attached to the connection and the tables are filled with INSERT...SELECT
+#  statements that fix identifiers by joining with a temporary table that maps each distinct IRI to its CURIE. The
+#  resulting tables have the same contents as those returned by get_semsql_tables_for_ontology (including the entailed
+#  edges computed from the imported edges when the database has no entailed_edge table, or native_closure is True).
+#  Returns the number of rows and seconds taken to import each table
+def import_semsql_tables_to_db(connection, semsql_db_file, table_prefix, include_dbxrefs_table=True,
+                               native_closure=False):
+    import_statistics = []
+    for table_name in ("_edges", "_entailed_edges"):  # (the tables that may be views of a compact database)
+        drop_compact_table(connection, table_prefix + table_name)
+    connection.execute("ATTACH DATABASE ? AS semsql", (get_read_only_uri(semsql_db_file),))
+    try:
+        native_closure = native_closure or not _has_table(connection, "entailed_edge", schema="semsql")
+        # Each table is given by its name, its columns, the SemanticSQL table or view (and condition) its rows come
+        #  from, the source columns of its columns, and whether its objects are CURIEs that need fixing
+        tables = [(table_prefix + "_edges", [SUBJECT_COL, OBJECT_COL],
+                   "semsql.edge WHERE predicate='rdfs:subClassOf'", ["subject", "object"], True),
+                  (table_prefix + "_synonyms", [SUBJECT_COL, OBJECT_COL],
+                   "semsql.has_exact_synonym_statement", ["subject", "value"], False)]
+        if not native_closure:
+            tables.insert(1, (table_prefix + "_entailed_edges", [SUBJECT_COL, OBJECT_COL],
+                              "semsql.entailed_edge WHERE predicate='rdfs:subClassOf'", ["subject", "object"], True))
+        if include_dbxrefs_table:
+            tables.append((table_prefix + "_dbxrefs", [SUBJECT_COL, OBJECT_COL, "graph"],
+                           "semsql.has_dbxref_statement", ["subject", "value", "graph"], False))
+        _create_curie_map_table(connection, tables)
+        for table_name, columns, source, source_columns, objects_are_curies in tables:
+            print(f"...importing {table_name}")
+            start = time.time()
+            connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+            connection.execute(f"CREATE TABLE {table_name} ({', '.join(f'`{column}` TEXT' for column in columns)})")
+            source_query = f"SELECT DISTINCT {', '.join(source_columns)} FROM {source}"
+            if objects_are_curies:
+                select = "SELECT COALESCE(s.curie, t.subject), COALESCE(o.curie, t.object) " \
+                         f"FROM ({source_query}) t " \
+                         "LEFT JOIN temp.curie_map s ON s.term = t.subject " \
+                         "LEFT JOIN temp.curie_map o ON o.term = t.object"
+            else:
+                other_columns = ", ".join(f"t.{column}" for column in source_columns[1:])
+                select = f"SELECT COALESCE(s.curie, t.subject), {other_columns} " \
+                         f"FROM ({source_query}) t " \
+                         "LEFT JOIN temp.curie_map s ON s.term = t.subject " \
+                         "WHERE substr(t.subject, 1, 2) != '_:'"  # remove blank nodes
+            row_count = connection.execute(f"INSERT INTO {table_name} {select}").rowcount
+            import_statistics.append((table_name, row_count, time.time() - start))
+        if native_closure:
+            table_name = table_prefix + "_entailed_edges"
+            print(f"...computing {table_name}")
+            start = time.time()
+            edges_df = pd.read_sql_query(f"SELECT {SUBJECT_COL}, {OBJECT_COL} FROM {table_prefix}_edges", connection)
+            entailed_edges_df = _get_native_entailed_edges_table(connection.cursor(), edges_df, schema="semsql")
+            connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+            connection.execute(f"CREATE TABLE {table_name} (`{SUBJECT_COL}` TEXT, `{OBJECT_COL}` TEXT)")
+            connection.executemany(f"INSERT INTO {table_name} VALUES (?, ?)",
+                                   entailed_edges_df[[SUBJECT_COL, OBJECT_COL]].itertuples(index=False, name=None))
+            import_statistics.append((table_name, len(entailed_edges_df), time.time() - start))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.execute("DROP TABLE IF EXISTS temp.curie_map")
+        connection.execute("DETACH DATABASE semsql")
+    return import_statistics
+
+
+# Create a temporary table that maps each distinct value that needs fixing (i.e., contains '<' or 'http') in the
+#  subjects (and CURIE objects) of the given tables to its CURIE
+def _create_curie_map_table(connection, tables):
+    term_queries = []
+    for table_name, columns, source, source_columns, objects_are_curies in tables:
+        condition = " AND " if " WHERE " in source else " WHERE "
+        for column in (["subject", "object"] if objects_are_curies else ["subject"]):
+            term_queries.append(f"SELECT {column} AS term FROM {source}{condition}"
+                                f"(instr({column}, '<') > 0 OR instr({column}, 'http') > 0)")
+    terms = pd.Series([row[0] for row in connection.execute(" UNION ".join(term_queries))], dtype=object)
+    curies = get_curie_normalizer().normalize_series(terms)
+    connection.execute("CREATE TEMP TABLE curie_map (term TEXT PRIMARY KEY, curie TEXT)")
+    connection.executemany("INSERT INTO temp.curie_map VALUES (?, ?)", zip(terms, curies))
+
+
 def _add_views(cursor):
     # In EFO, some disease locations are expressed in universal restrictions—for example:
     # pancreatitis (EFO:0000278) has_disease_location only pancreas
     # Currently there are no views in the SemanticSQL build of EFO for universal restrictions, only for existential ones
+    # The views are temporary, i.e. they only exist in the given connection, as the database file is opened read-only
 
     # Create a view that mimics the existing view 'owl_some_values_from' but for universal restrictions instead
-    create_owl_only_values_from_view = "CREATE VIEW IF NOT EXISTS owl_only_values_from AS " \
+    create_owl_only_values_from_view = "CREATE TEMP VIEW IF NOT EXISTS owl_only_values_from AS " \
                                        "SELECT onProperty.subject AS id, onProperty.object AS on_property, f.object AS filler " + \
                                        "FROM statements AS onProperty, statements AS f " + \
                                        "WHERE onProperty.predicate = 'owl:onProperty' AND onProperty.subject=f.subject " + \
@@ -100,7 +242,8 @@ def _add_views(cursor):
 
     # Use the view just created to add another convenience view that mimics the existing view
     # 'owl_subclass_of_some_values_from', but again, for universal restrictions instead
-    create_owl_subclass_of_only_values_from_view = "CREATE VIEW IF NOT EXISTS owl_subclass_of_only_values_from AS " + \
+    create_owl_subclass_of_only_values_from_view = "CREATE TEMP VIEW IF NOT EXISTS " + \
+                                                   "owl_subclass_of_only_values_from AS " + \
                                                    "SELECT subClassOf.stanza, subClassOf.subject, svf.on_property AS predicate, svf.filler AS object " + \
                                                    "FROM statements AS subClassOf, owl_only_values_from AS svf " + \
                                                    "WHERE subClassOf.predicate = 'rdfs:subClassOf' AND svf.id=subClassOf.object;"
@@ -127,7 +270,11 @@ def _get_edges_table(cursor):
     return edges_df
 
 
-def _get_entailed_edges_table(cursor):
+# Get the subClassOf entailed edges of the ontology from the entailed_edge table of its SemanticSQL database or, if the
+#  database has none or native_closure is True, compute them from the given subClassOf edges
+def _get_entailed_edges_table(cursor, edges_df, native_closure=False):
+    if native_closure or not _has_table(cursor.connection, "entailed_edge"):
+        return _get_native_entailed_edges_table(cursor, edges_df)
     cursor.execute("SELECT * FROM entailed_edge WHERE predicate='rdfs:subClassOf'")
     entailed_edge_columns = [x[0] for x in cursor.description]
     entailed_edge_data = cursor.fetchall()
@@ -139,6 +286,25 @@ def _get_entailed_edges_table(cursor):
     return entailed_edges_df
 
 
+# Compute the subClassOf entailed edges of the ontology (the reflexive transitive closure of the given subClassOf edges,
+#  whose identifiers are already fixed) as SemanticSQL has them in its entailed_edge table: each class with each of its
+#  ancestors and with itself, including the classes that have no subClassOf edges
+def _get_native_entailed_edges_table(cursor, edges_df, schema="main"):
+    start = time.time()
+    cursor.execute(f"SELECT DISTINCT subject FROM {schema}.statements "
+                   "WHERE predicate='rdf:type' AND object='owl:Class' AND substr(subject, 1, 2) != '_:'")
+    classes_df = fix_identifiers(pd.DataFrame(cursor.fetchall(), columns=[SUBJECT_COL]), columns=[SUBJECT_COL])
+    closure = SubclassClosure(edges_df, terms=classes_df[SUBJECT_COL], subject_col=SUBJECT_COL, object_col=OBJECT_COL)
+    entailed_edges_df = closure.get_entailed_edges()
+    print(f"\tComputed {len(entailed_edges_df)} entailed subClassOf edges ({time.time() - start:.1f} seconds)")
+    return entailed_edges_df
+
+
+def _has_table(connection, table_name, schema="main"):
+    return connection.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type IN ('table', 'view') AND name = ?",
+                              (table_name,)).fetchone() is not None
+
+
 def _get_labels_table(cursor, include_disease_locations=False):
     # Get rdfs:label statements for ontology classes that are not deprecated
     labels_query = "SELECT * FROM statements WHERE predicate='rdfs:label' AND subject IN " + \
@@ -155,10 +321,10 @@ def _get_labels_table(cursor, include_disease_locations=False):
     labels_df = labels_df[labels_df[SUBJECT_COL].str.startswith("_:") == False]  # remove blank nodes
     labels_df = fix_identifiers(labels_df, columns=[SUBJECT_COL])
     labels_df[OBJECT_COL] = labels_df[OBJECT_COL].str.strip()
-    labels_df[IRI_COL] = labels_df[SUBJECT_COL].apply(get_iri)
+    labels_df[IRI_COL] = get_curie_normalizer().get_iris(labels_df[SUBJECT_COL])
     if include_disease_locations:
-        labels_df[DISEASE_LOCATION_COL] = labels_df[SUBJECT_COL].apply(_get_disease_location_for_term,
-                                                                       connection=cursor.connection)
+        disease_location_resolver = DiseaseLocationResolver(cursor.connection)
+        labels_df[DISEASE_LOCATION_COL] = disease_location_resolver.get_disease_locations(labels_df[SUBJECT_COL])
     return labels_df
 
 
@@ -196,9 +362,20 @@ def get_iri(curie):
         return bioregistry.get_iri(curie, priority=IRI_PRIORITY_LIST)
 
 
+# Get the (shared) normalizer used to convert IRIs to CURIEs and back, whose caches are reused across tables
+def get_curie_normalizer():
+    global _curie_normalizer
+    if _curie_normalizer is None:
+        _curie_normalizer = CurieNormalizer(iri_priority=IRI_PRIORITY_LIST)
+    return _curie_normalizer
+
+
+# Replace IRIs in the given columns with CURIEs. Equivalent to applying get_curie_id_for_term to each value, but each
+#  distinct value is resolved only once
 def fix_identifiers(df, columns=()):
+    normalizer = get_curie_normalizer()
     for column in columns:
-        df[column] = df[column].apply(get_curie_id_for_term)
+        df[column] = normalizer.normalize_series(df[column])
     return df
 
 
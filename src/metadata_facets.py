@@ -0,0 +1,117 @@
+import sys
+import time
+import json
+import numpy as np
+import pandas as pd
+
+__version__ = "0.1.0"
+
+# SQL types of the OpenGWAS metadata columns that searches can be filtered by or counted over (facets). The columns
+#  are converted to these types when the database is built (see get_typed_metadata_table), so that numeric filters
+#  compare numbers, and the metadata table is given a covering index of the resource ID and these columns
+OPENGWAS_FACET_TYPES = {"population": "TEXT", "sample_size": "INTEGER", "ncase": "INTEGER", "ncontrol": "INTEGER",
+                        "year": "INTEGER", "consortium": "TEXT", "build": "TEXT", "sex": "TEXT", "category": "TEXT"}
+
+# Facets counted by default, and the target 95th percentile latency (in milliseconds) of a faceted search (the
+#  filtered results and their facet counts) of the terms with the most records, which is dominated by the broadest
+#  terms (the root of the ontology is annotated with every record)
+DEFAULT_FACETS = ("population", "year", "consortium", "sex")
+TARGET_P95_MS = 100.0
+
+# Names of the facet filters and the conditions they add to a search (on the joined metadata 'md' and mappings 'm')
+FACET_FILTERS = {
+    "populations": "md.population IN (SELECT value FROM json_each(:populations))",
+    "min_sample_size": "md.sample_size >= :min_sample_size",
+    "min_year": "md.year >= :min_year",
+    "max_year": "md.year <= :max_year",
+    "id_prefix": "m.SourceTermID >= :id_prefix AND m.SourceTermID < :id_prefix_end",
+    "min_mapping_score": "m.MappingScore >= :min_mapping_score",
+}
+
+
+def get_typed_metadata_table(metadata_df, column_types=None):
+    """
+    Get a copy of the given metadata table in which the given columns (by default those in OPENGWAS_FACET_TYPES that
+    the table has) are converted to the given SQL types: INTEGER columns to nullable integers (values that are not
+    numbers become missing), REAL columns to floats and TEXT columns to strings
+    """
+    column_types = OPENGWAS_FACET_TYPES if column_types is None else column_types
+    metadata_df = metadata_df.copy()
+    for column, sql_type in column_types.items():
+        if column not in metadata_df.columns:
+            continue
+        values = metadata_df[column]
+        if sql_type == "INTEGER":
+            metadata_df[column] = pd.to_numeric(values, errors="coerce").round().astype("Int64")
+        elif sql_type == "REAL":
+            metadata_df[column] = pd.to_numeric(values, errors="coerce").astype("float64")
+        else:
+            metadata_df[column] = values.astype(object).where(values.notna(), None).map(str, na_action="ignore")
+    return metadata_df
+
+
+def get_facet_index_columns(metadata_df, resource_id_col="id", column_types=None):
+    """
+    Get the columns of the covering index of the metadata table: the resource ID followed by the facet columns in the
+    table, so that searches filter and count resources by their facets without reading the table itself
+    """
+    column_types = OPENGWAS_FACET_TYPES if column_types is None else column_types
+    return (resource_id_col,) + tuple(column for column in column_types if column in metadata_df.columns)
+
+
+def get_facet_conditions(populations=(), min_sample_size=None, year_range=None, id_prefix="", min_mapping_score=None):
+    """
+    Get the SQL conditions (joined by AND) and the parameters of the given facet filters:
+    :param populations: keep resources whose population (ancestry) is one of these, e.g. ["European", "East Asian"]
+    :param min_sample_size: keep resources with at least this sample size
+    :param year_range: keep resources published between these years (inclusive). Either year can be None
+    :param id_prefix: keep resources whose ID starts with this prefix, e.g. "ukb-"
+    :param min_mapping_score: keep resources whose trait was mapped with at least this score
+    :return: condition (an empty string if there are no filters) and dictionary of parameters
+    """
+    min_year, max_year = year_range if year_range is not None else (None, None)
+    values = {"populations": json.dumps(list(populations)) if len(populations) > 0 else None,
+              "min_sample_size": min_sample_size, "min_year": min_year, "max_year": max_year,
+              "id_prefix": id_prefix or None, "min_mapping_score": min_mapping_score}
+    conditions, params = [], {}
+    for name, value in values.items():
+        if value is not None:
+            conditions.append(FACET_FILTERS[name])
+            params[name] = value
+    if "id_prefix" in params:
+        params["id_prefix_end"] = id_prefix + "\U0010ffff"  # all IDs that start with the prefix sort before this
+    return " AND ".join(conditions), params
+
+
+# Time faceted searches of the terms with the most records in the given database (filtered by each of the given
+#  filters, and counting the default facets), and check the 95th percentile latency against the target
+def benchmark_faceted_search(database_file, filters=({}, {"populations": ["European"]}, {"min_sample_size": 10000},
+                                                     {"year_range": (2015, 2020), "id_prefix": "ukb-"},
+                                                     {"min_mapping_score": 0.9}),
+                             term_count=50, target_p95_ms=TARGET_P95_MS):
+    from query_database import SearchEngine
+    with SearchEngine(database_file) as engine:
+        search_terms = [row[0] for row in engine.connection.execute(
+            f"SELECT Subject FROM {engine.ontology_name}_labels ORDER BY Direct + Inherited DESC LIMIT ?",
+            (term_count,))]
+        facets = [facet for facet in DEFAULT_FACETS if facet in engine.get_metadata_columns()]
+        print(f"Faceted searches of {len(search_terms)} terms in {database_file} (facets: {', '.join(facets)}):")
+        all_latencies = []
+        for facet_filters in filters:
+            latencies = []
+            for search_term in search_terms:
+                start = time.perf_counter()
+                engine.filter_resources(search_term, **facet_filters)
+                engine.count_facets(search_term, facets=facets, **facet_filters)
+                latencies.append(time.perf_counter() - start)
+            p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+            print(f"\t{facet_filters or 'no filters'}: p50 {p50:.1f} ms, p95 {p95:.1f} ms")
+            all_latencies.extend(latencies)
+        p95 = np.percentile(all_latencies, 95) * 1000
+        print(f"Overall p95: {p95:.1f} ms ({'within' if p95 <= target_p95_ms else 'ABOVE'} the target of "
+              f"{target_p95_ms:.0f} ms)")
+        return p95 <= target_p95_ms
+
+
+if __name__ == "__main__":
+    sys.exit(0 if benchmark_faceted_search(sys.argv[1] if len(sys.argv) > 1 else "../opengwas_search.db") else 1)
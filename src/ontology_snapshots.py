@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import uuid
+import pickle
+import shutil
+import hashlib
+from contextlib import contextmanager
+from owlready2 import World
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where lock files are used instead
+    fcntl = None
+
+__version__ = "0.1.0"
+
+QUADSTORE_FILE = "quadstore.sqlite3"
+METADATA_FILE = "snapshot.json"
+LOCK_POLL_INTERVAL = 0.5
+
+
+class OntologySnapshotStore:
+    """
+    On-disk store of pre-parsed ontologies, so that an OWL file is parsed once per ontology version rather than on
+    every build. Each snapshot holds an owlready2 quadstore (a SQLite database) that is opened in read-only mode,
+    and/or artifacts derived from the parsed ontology (e.g., the term details collected by text2term), each created
+    the first time it is needed. The layout of the store folder is:
+        <name>/<version>/snapshot.json      ontology IRI and version (and base IRI and parsing time of the quadstore)
+        <name>/<version>/quadstore.sqlite3  owlready2 quadstore with the parsed ontology
+        <name>/<version>/<artifact>.pkl     pickled artifacts derived from the ontology
+    where <name> is the ontology name (by default, the OWL file name without extension). Requesting a snapshot of a new
+    version of an ontology invalidates, i.e. deletes, the snapshots of all its other versions. Builds sharing the store
+    take a lock file of the ontology (<name>.lock) to delete snapshots and to write their metadata.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def open(self, ontology_iri, version="", name=""):
+        """
+        Open the snapshot of the given ontology version in read-only mode, creating the snapshot if needed
+        :return: owlready2 World and the ontology in it. The world should be closed by the caller
+        """
+        snapshot_folder = self.get_snapshot_folder(ontology_iri, version, name)
+        metadata = _read_metadata(snapshot_folder)
+        if "base_iri" not in metadata:
+            metadata = self._create_quadstore(snapshot_folder, metadata, name or _get_ontology_name(ontology_iri))
+        world = World(filename=os.path.join(snapshot_folder, QUADSTORE_FILE), read_only=True, exclusive=False)
+        return world, world.ontologies[metadata["base_iri"]]
+
+    def get_artifact(self, ontology_iri, version, artifact_name, create, name=""):
+        """
+        Get an artifact derived from the given ontology version, calling create() (and saving its result in the
+        snapshot) if the artifact does not exist yet
+        """
+        artifact_file = os.path.join(self.get_snapshot_folder(ontology_iri, version, name), artifact_name + ".pkl")
+        if os.path.isfile(artifact_file):
+            with open(artifact_file, "rb") as file_in:
+                return pickle.load(file_in)
+        artifact = create()
+        temporary_file = artifact_file + f".{uuid.uuid4().hex}.tmp"
+        with open(temporary_file, "wb") as file_out:
+            pickle.dump(artifact, file_out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file, artifact_file)
+        return artifact
+
+    def get_snapshot_folder(self, ontology_iri, version="", name=""):
+        name = name or _get_ontology_name(ontology_iri)
+        version = version or hashlib.sha256(ontology_iri.encode("utf-8")).hexdigest()[:16]
+        snapshot_folder = os.path.join(self.folder, name, version)
+        if not self._is_snapshot_of(snapshot_folder, ontology_iri):
+            with self._lock(name):
+                # Another build sharing the store may have created the same snapshot while waiting for the lock, so
+                #  the metadata are checked again. Only the snapshots of other versions are deleted (unless this one
+                #  is of a different ontology)
+                metadata = _read_metadata(snapshot_folder)
+                if metadata is None or metadata["ontology_iri"] != ontology_iri:
+                    if metadata is None:
+                        self._delete_other_versions(name, version)
+                    else:
+                        self._delete_versions(name)
+                    os.makedirs(snapshot_folder, exist_ok=True)
+                    _write_metadata(snapshot_folder, {"ontology_iri": ontology_iri, "version": version})
+        return snapshot_folder
+
+    @staticmethod
+    def _is_snapshot_of(snapshot_folder, ontology_iri):
+        metadata = _read_metadata(snapshot_folder)
+        return metadata is not None and metadata["ontology_iri"] == ontology_iri
+
+    def invalidate(self, name):
+        """
+        Delete the snapshots of all versions of the ontology with the given name
+        """
+        with self._lock(name):
+            self._delete_versions(name)
+
+    def _delete_versions(self, name):
+        ontology_folder = os.path.join(self.folder, name)
+        if os.path.isdir(ontology_folder):
+            print(f"...deleting snapshots of {name} versions: {', '.join(sorted(os.listdir(ontology_folder)))}")
+            shutil.rmtree(ontology_folder)
+
+    def _delete_other_versions(self, name, version):
+        ontology_folder = os.path.join(self.folder, name)
+        other_versions = sorted(set(os.listdir(ontology_folder)) - {version}) if os.path.isdir(ontology_folder) else []
+        if len(other_versions) > 0:
+            print(f"...deleting snapshots of {name} versions: {', '.join(other_versions)}")
+            for other_version in other_versions:
+                shutil.rmtree(os.path.join(ontology_folder, other_version), ignore_errors=True)
+
+    @contextmanager
+    def _lock(self, name):
+        lock_file = os.path.join(self.folder, name + ".lock")
+        if fcntl is not None:
+            with open(lock_file, "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        else:
+            while True:
+                try:
+                    lock = os.open(lock_file, os.O_CREAT | os.O_EXCL)
+                    break
+                except FileExistsError:
+                    time.sleep(LOCK_POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                os.close(lock)
+                os.remove(lock_file)
+
+    def _create_quadstore(self, snapshot_folder, metadata, name):
+        print(f"Creating snapshot of {metadata['ontology_iri']} (version {metadata['version']})...")
+        start = time.time()
+        quadstore_file = os.path.join(snapshot_folder, QUADSTORE_FILE)
+        temporary_file = quadstore_file + f".{uuid.uuid4().hex}.tmp"
+        try:
+            world = World(filename=temporary_file)
+            base_iri = world.get_ontology(metadata["ontology_iri"]).load().base_iri
+            world.save()
+            world.close()
+            os.replace(temporary_file, quadstore_file)
+        finally:
+            if os.path.isfile(temporary_file):
+                os.remove(temporary_file)
+        # The metadata are read again under the lock, so that the base IRI written by another build that created the
+        #  same snapshot is kept, and so that the snapshot is not deleted while they are written
+        with self._lock(name):
+            metadata = dict(_read_metadata(snapshot_folder) or metadata)
+            if "base_iri" not in metadata:
+                metadata.update(base_iri=base_iri, parse_seconds=round(time.time() - start, 1))
+                _write_metadata(snapshot_folder, metadata)
+        print(f"...done ({time.time() - start:.1f} seconds)")
+        return metadata
+
+
+def _get_ontology_name(ontology_iri):
+    return os.path.splitext(ontology_iri.rstrip("/").rsplit("/", 1)[-1])[0].lower()
+
+
+def _write_metadata(snapshot_folder, metadata):
+    metadata_file = os.path.join(snapshot_folder, METADATA_FILE)
+    temporary_file = metadata_file + f".{uuid.uuid4().hex}.tmp"
+    with open(temporary_file, "w") as file_out:
+        json.dump(metadata, file_out, indent=2)
+    os.replace(temporary_file, metadata_file)
+
+
+def _read_metadata(snapshot_folder):
+    metadata_file = os.path.join(snapshot_folder, METADATA_FILE)
+    if not os.path.isfile(metadata_file):
+        return None
+    with open(metadata_file) as file_in:
+        return json.load(file_in)
+
+
+# Compare the time taken to load the given ontology by parsing its OWL file versus by opening a snapshot. The time taken
+#  to then list the ontology classes (as owlready2 objects) is the same in both cases, and is reported separately
+def benchmark_ontology_snapshot(ontology_iri, snapshot_folder):
+    start = time.time()
+    world = World()
+    ontology = world.get_ontology(ontology_iri).load()
+    parse_time = time.time() - start
+    start = time.time()
+    class_count = len(list(ontology.classes()))
+    classes_time = time.time() - start
+    world.close()
+
+    store = OntologySnapshotStore(snapshot_folder)
+    world, ontology = store.open(ontology_iri)  # creates the snapshot if needed
+    world.close()
+    start = time.time()
+    world, ontology = store.open(ontology_iri)
+    open_time = time.time() - start
+    snapshot_class_count = len(list(ontology.classes()))
+    world.close()
+
+    print(f"Startup time for {ontology_iri}:")
+    print(f"\tparsing OWL file: {parse_time:.2f} seconds")
+    print(f"\topening snapshot: {open_time:.2f} seconds (~{parse_time / max(open_time, 1e-9):.0f}x faster)")
+    print(f"\tlisting classes: {classes_time:.2f} seconds ({class_count} classes; {snapshot_class_count} in snapshot)")
+    return parse_time, open_time
+
+
+if __name__ == "__main__":
+    benchmark_ontology_snapshot(ontology_iri=sys.argv[1] if len(sys.argv) > 1 else
+                                "http://www.ebi.ac.uk/efo/releases/v3.57.0/efo.owl",
+                                snapshot_folder=sys.argv[2] if len(sys.argv) > 2 else "../resources/ontology_snapshots")
@@ -0,0 +1,176 @@
+import os
+import time
+import random
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import pandas as pd
+import xml.etree.ElementTree as ElementTree
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from metapub import PubMedArticle
+
+__version__ = "0.1.0"
+
+EFETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+REFERENCE_COLUMNS = ['Journal', 'Title', 'Abstract', 'Year', 'URL']
+
+# NCBI allows up to 3 requests per second without an API key, and up to 10 requests per second with one
+REQUESTS_PER_SECOND = 3
+REQUESTS_PER_SECOND_WITH_API_KEY = 10
+
+BATCH_SIZE = 200
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0  # seconds to wait before the first retry, doubled on each subsequent retry
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter that allows up to `rate` acquisitions per second on average, with bursts of
+    up to `capacity` acquisitions
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_update) * self.rate)
+                self._last_update = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class PubMedReferenceFetcher:
+    """
+    Fetches publication details (journal, title, abstract, year and URL) from PubMed for batches of PMIDs using
+    E-utilities efetch requests, which are sent concurrently under a rate limit that depends on whether an NCBI API
+    key is used. Failed requests are retried with exponential backoff.
+    """
+
+    def __init__(self, api_key=None, efetch_url=EFETCH_URL, batch_size=BATCH_SIZE, workers=None,
+                 max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF, timeout=60):
+        if api_key is None:
+            api_key = os.environ.get("NCBI_API_KEY")
+        self.api_key = api_key
+        self.efetch_url = efetch_url
+        self.batch_size = batch_size
+        requests_per_second = REQUESTS_PER_SECOND_WITH_API_KEY if api_key else REQUESTS_PER_SECOND
+        self.workers = workers if workers is not None else requests_per_second
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self._rate_limiter = TokenBucket(rate=requests_per_second)
+
+    def fetch(self, pmids):
+        """
+        Fetch the details of the given PMIDs in batches, yielding each batch of PMIDs as soon as it is fetched together
+        with a list of (pmid, journal, title, abstract, year, url) tuples. PMIDs not found in PubMed are left out.
+        If a batch fails, the batches not yet started are cancelled, those already running are still yielded when
+        they finish (so that they can be saved), and the error of the failed batch is raised after them
+        """
+        batches = [pmids[index:index + self.batch_size] for index in range(0, len(pmids), self.batch_size)]
+        first_error = None
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch_batch, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    articles = future.result()
+                except Exception as error:
+                    if first_error is None:
+                        first_error = error
+                        for other_future in futures:
+                            other_future.cancel()
+                    continue
+                yield futures[future], articles
+        if first_error is not None:
+            raise first_error
+
+    def fetch_batch(self, pmids):
+        response = self._request({"db": "pubmed", "id": ",".join(pmids), "retmode": "xml"})
+        articles = {}
+        for element in ElementTree.fromstring(response):
+            if element.tag in ("PubmedArticle", "PubmedBookArticle"):
+                article_xml = "<PubmedArticleSet>" + ElementTree.tostring(element, encoding="unicode") + \
+                              "</PubmedArticleSet>"
+                article = PubMedArticle(article_xml)
+                if article.pmid is not None:
+                    articles[article.pmid] = article
+        return [(pmid, article.journal, article.title, article.abstract, article.year, article.url)
+                for pmid, article in ((pmid, articles.get(pmid)) for pmid in pmids) if article is not None]
+
+    def _request(self, parameters):
+        if self.api_key:
+            parameters = dict(parameters, api_key=self.api_key)
+        data = urllib.parse.urlencode(parameters).encode("utf-8")
+        for attempt in range(self.max_retries + 1):
+            self._rate_limiter.acquire()
+            try:
+                with urllib.request.urlopen(self.efetch_url, data=data, timeout=self.timeout) as response:
+                    return response.read()
+            except (urllib.error.URLError, TimeoutError) as error:
+                retriable = not isinstance(error, urllib.error.HTTPError) or error.code in RETRY_STATUS_CODES
+                if not retriable or attempt == self.max_retries:
+                    raise
+                retry_after = error.headers.get("Retry-After") if isinstance(error, urllib.error.HTTPError) else None
+                if retry_after is not None and retry_after.isdigit():
+                    wait_time = int(retry_after)
+                else:
+                    wait_time = self.retry_backoff * 2 ** attempt * (1 + random.random())
+                time.sleep(wait_time)
+
+
+def get_not_found_file(references_file):
+    return os.path.splitext(references_file)[0] + "_not_found.txt"
+
+
+# Add the details of any of the given PMIDs that are not yet in the references table in the given TSV file (created
+#  if needed), and return the updated table. Details are appended to the file as each batch of PMIDs is fetched, so an
+#  interrupted update resumes where it stopped. PMIDs that PubMed did not return are appended to a list next to the
+#  table (see get_not_found_file), and are not requested again unless retry_not_found is True
+def update_references_table(references_file, pmids, pmid_col, fetcher=None, retry_not_found=False):
+    if os.path.isfile(references_file) and os.path.getsize(references_file) > 0:
+        existing_pmids = set(pd.read_csv(references_file, sep="\t", usecols=[pmid_col], dtype=str)[pmid_col])
+    else:
+        pd.DataFrame(columns=[pmid_col] + REFERENCE_COLUMNS).to_csv(references_file, sep="\t", index=False)
+        existing_pmids = set()
+    not_found_file = get_not_found_file(references_file)
+    not_found_pmids = set()
+    if os.path.isfile(not_found_file) and not retry_not_found:
+        with open(not_found_file) as file_in:
+            not_found_pmids = {line.strip() for line in file_in if line.strip() != ""}
+    pmids = [str(pmid) for pmid in pd.unique(pd.Series(pmids).dropna())]
+    missing_pmids = [pmid for pmid in pmids if pmid not in existing_pmids and pmid not in not_found_pmids and
+                     pmid != "0" and pmid != "nan"]
+    print(f"...{len(existing_pmids)} references already fetched, {len(not_found_pmids)} not found in PubMed before, "
+          f"{len(missing_pmids)} to fetch")
+    if len(missing_pmids) > 0:
+        if fetcher is None:
+            fetcher = PubMedReferenceFetcher()
+        fetched_count = 0
+        with tqdm(total=len(missing_pmids)) as progress_bar:
+            for batch_pmids, articles in fetcher.fetch(missing_pmids):
+                pd.DataFrame(articles, columns=[pmid_col] + REFERENCE_COLUMNS) \
+                    .to_csv(references_file, sep="\t", index=False, header=False, mode="a")
+                found_pmids = {article[0] for article in articles}
+                with open(not_found_file, "a") as file_out:
+                    file_out.writelines(pmid + "\n" for pmid in batch_pmids if pmid not in found_pmids)
+                fetched_count += len(articles)
+                progress_bar.update(len(batch_pmids))
+        if fetched_count < len(missing_pmids):
+            print(f"...{len(missing_pmids) - fetched_count} PMIDs were not found in PubMed "
+                  f"(listed in {not_found_file})")
+    return pd.read_csv(references_file, sep="\t")
@@ -1,9 +1,33 @@
 import os
+import sys
+import json
+import uuid
+import base64
+import time
 import sqlite3
+import argparse
 import tarfile
 import pandas as pd
+from pathlib import Path
+from text_search import get_match_expression, get_terms_query, get_metadata_query
+from metadata_facets import get_facet_conditions, DEFAULT_FACETS
+from anatomy_search import get_location_search_query
+from compact_schema import is_compact_database, get_compact_search_query
 
-__version__ = "0.5.0"
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # only needed to export results in Arrow format
+    pyarrow = None
+
+__version__ = "0.11.0"
+
+# Number of rows fetched per query when streaming results
+STREAM_BATCH_SIZE = 1000
+
+# Pragmas of the read-only connections used for searching: the database file is memory-mapped (up to the given number
+#  of bytes), and any statement that would write to the database fails
+SEARCH_PRAGMAS = {"query_only": "ON", "mmap_size": 1073741824}
 
 
 """
@@ -69,8 +93,583 @@ SQL:
     FROM opengwas_mappings m
     LEFT JOIN efo_entailed_edges ee ON (m.MappedTermCURIE = ee.Subject)
     WHERE (m.MappedTermCURIE = 'EFO:0009605' OR ee.Object = 'EFO:0009605')
+
+The queries actually run (see get_search_query) find the same resources without joining the mappings with the edges:
+the subclasses of the search term are looked up through the index on the 'Object' column of the edges table, and the
+resources mapped to the search term or to any of its subclasses through the index on the 'MappedTermCURIE' column of
+the mappings table. The search term is given as a parameter. For example, for include_subclasses=True and
+direct_subclasses_only=False:
+    SELECT DISTINCT
+        m.SourceTermID AS 'OpenGWASID',
+        ...
+    FROM opengwas_mappings m
+    WHERE m.MappedTermCURIE = ?
+        OR m.MappedTermCURIE IN (SELECT ee.Subject FROM efo_entailed_edges ee WHERE ee.Object = ?)
+    ORDER BY m.SourceTermID
+
+Many search terms can be searched at once (see SearchEngine.search_terms), in which case the search terms are bound as a
+single JSON array parameter and expanded into a table of query terms (with json_each), and the resources of all search
+terms are found by a single query, tagged with the search term they were found for. The resources found for several
+search terms can also be combined by set operations (see SearchEngine.combine_searches), e.g., to find resources
+annotated with 'infectious disease' (or its subclasses) but not with 'pancreas disease' (or its subclasses).
 """
 
+RESULT_COLUMNS = """m.SourceTermID AS 'OpenGWASID',
+                    m.SourceTerm AS 'OpenGWASTrait',
+                    m.MappedTermLabel AS 'OntologyTerm',
+                    m.MappedTermCURIE AS 'OntologyTermID',
+                    m.MappingScore AS 'MappingConfidence'"""
+RESULT_COLUMN_NAMES = ["OpenGWASID", "OpenGWASTrait", "OntologyTerm", "OntologyTermID", "MappingConfidence"]
+RESULT_COLUMN_TYPES = {"OpenGWASID": "TEXT", "OpenGWASTrait": "TEXT", "OntologyTerm": "TEXT", "OntologyTermID": "TEXT",
+                       "MappingConfidence": "REAL"}
+
+# Columns of the results of free-text searches of terms and of metadata records
+TERM_MATCH_COLUMNS = ["OntologyTermID", "OntologyTerm", "MatchedText", "MatchedField", "Score", "Records"]
+METADATA_MATCH_COLUMNS = ["OpenGWASID", "OpenGWASTrait", "Title", "Score"]
+
+
+class SearchEngine:
+    """
+    Searches a database built by build_database through a single read-only connection, which is reused by all
+    searches so that the (parameterized) search statements are prepared once and then taken from the connection's
+    statement cache. The database is opened with the pragmas in SEARCH_PRAGMAS.
+
+    Given an in-memory search index of the database (see search_index.SearchIndex), searches of single terms and
+    batches of terms are answered by the index instead, with the same results. Given a result cache (see
+    result_cache.SearchResultCache), the results of all searches are cached, keyed by the search arguments and the
+    version of the database (see get_database_version).
+    """
+
+    def __init__(self, database_file, dataset_name="opengwas", ontology_name="efo", pragmas=None, search_index=None,
+                 result_cache=None, resource_id_col="id"):
+        self.database_file = database_file
+        self.search_index = search_index
+        self.result_cache = result_cache
+        self.connection = sqlite3.connect(Path(database_file).resolve().as_uri() + "?mode=ro", uri=True,
+                                          check_same_thread=False)
+        for pragma, value in (SEARCH_PRAGMAS if pragmas is None else pragmas).items():
+            self.connection.execute(f"PRAGMA {pragma}={value}")
+        self.dataset_name = dataset_name
+        self.ontology_name = ontology_name
+        self.resource_id_col = resource_id_col
+        self._metadata_column_types = None
+        self.version = get_database_version(self.connection, database_file)
+        if result_cache is not None:
+            result_cache.set_version(self.version)
+        # The tables of a compact database are searched through their encoded tables rather than their views
+        get_query = get_compact_search_query if is_compact_database(self.connection, dataset_name, ontology_name) \
+            else get_search_query
+        self._queries = {(include_subclasses, direct_subclasses_only):
+                         get_query(dataset_name, ontology_name, include_subclasses, direct_subclasses_only)
+                         for include_subclasses in (False, True) for direct_subclasses_only in (False, True)}
+
+    def resources_annotated_with_term(self, search_term, include_subclasses=True, direct_subclasses_only=False):
+        """
+        Retrieve resources annotated with the given search term and (optionally) subclasses of that term, as the
+        function resources_annotated_with_term does
+        """
+        return self._get_results("resources_annotated_with_term", (search_term,), include_subclasses,
+                                 direct_subclasses_only, (), self._search_term, search_term, include_subclasses,
+                                 direct_subclasses_only)
+
+    def _search_term(self, search_term, include_subclasses, direct_subclasses_only):
+        if self.search_index is not None:
+            return self.search_index.resources_annotated_with_term(search_term, include_subclasses,
+                                                                   direct_subclasses_only)
+        query = self._queries[(include_subclasses, direct_subclasses_only)]
+        return _get_results_df(self.connection.execute(query, _get_search_params(search_term, include_subclasses)))
+
+    def count_resources(self, search_term, include_subclasses=True, direct_subclasses_only=False):
+        """
+        Count the distinct resources annotated with the given search term and, optionally, with its subclasses
+        """
+        if self.search_index is not None:
+            return self.search_index.count_resources(search_term, include_subclasses, direct_subclasses_only)
+        ontology_table = self.ontology_name + ("_edges" if direct_subclasses_only else "_entailed_edges")
+        query = f"""SELECT COUNT(DISTINCT m.SourceTermID)
+                    FROM {self.dataset_name}_mappings m
+                    WHERE m.MappedTermCURIE = ?"""
+        if include_subclasses:
+            query += f"""
+                        OR m.MappedTermCURIE IN (SELECT ee.Subject FROM {ontology_table} ee WHERE ee.Object = ?)"""
+        return self.connection.execute(query, _get_search_params(search_term, include_subclasses)).fetchone()[0]
+
+    def search_terms(self, search_terms, include_subclasses=True, direct_subclasses_only=False):
+        """
+        Retrieve the resources annotated with each of the given search terms (and, optionally, their subclasses) with
+        a single query
+        :return: data frame with the same columns as resources_annotated_with_term, preceded by a 'QueryTerm' column
+            with the search term each resource was found for. Rows are ordered by search term (in the given order)
+            and then by OpenGWAS ID, so the rows of each search term are those that resources_annotated_with_term
+            returns for it
+        """
+        search_terms = tuple(search_terms)
+        return self._get_results("search_terms", search_terms, include_subclasses, direct_subclasses_only, (),
+                                 self._search_terms, search_terms, include_subclasses, direct_subclasses_only)
+
+    def _search_terms(self, search_terms, include_subclasses, direct_subclasses_only):
+        if self.search_index is not None:
+            return self.search_index.search_terms(search_terms, include_subclasses, direct_subclasses_only)
+        query = f"""{self._get_hits_cte(include_subclasses, direct_subclasses_only)}
+                    SELECT DISTINCT
+                        m.QueryTerm AS 'QueryTerm',
+                        {RESULT_COLUMNS}
+                    FROM hits m
+                    ORDER BY m.Position, m.SourceTermID"""
+        return _get_results_df(self.connection.execute(query, {"terms": json.dumps(list(search_terms))}))
+
+    def combine_searches(self, any_of=(), all_of=(), none_of=(), include_subclasses=True,
+                         direct_subclasses_only=False):
+        """
+        Retrieve the resources annotated with any of the search terms in any_of (their UNION), and with every search
+        term in all_of (INTERSECT), but with none of the search terms in none_of (EXCEPT). As in any search, resources
+        annotated with subclasses of a search term count as annotated with the search term if include_subclasses=True.
+        For example, combine_searches(any_of=["EFO:0005741"], none_of=["EFO:0009605"]) finds the resources annotated
+        with 'infectious disease' but not with 'pancreas disease'
+        :return: data frame with the same columns as resources_annotated_with_term, with the mappings of each resource
+            found to (subclasses of) the search terms in any_of and all_of
+        """
+        any_of, all_of, none_of = list(any_of), list(all_of), list(none_of)
+        if len(any_of) == 0 and len(all_of) == 0:
+            raise ValueError("At least one search term must be given in any_of or all_of")
+        filters = (("any_of", tuple(any_of)), ("all_of", tuple(all_of)), ("none_of", tuple(none_of)))
+        return self._get_results("combine_searches", (), include_subclasses, direct_subclasses_only, filters,
+                                 self._combine_searches, any_of, all_of, none_of, include_subclasses,
+                                 direct_subclasses_only)
+
+    def _combine_searches(self, any_of, all_of, none_of, include_subclasses, direct_subclasses_only):
+        params = {"terms": json.dumps(any_of + all_of + none_of), "positive_terms": json.dumps(any_of + all_of),
+                  "any_of": json.dumps(any_of), "none_of": json.dumps(none_of)}
+        select_hits = "SELECT SourceTermID FROM hits WHERE QueryTerm"
+        selects = []
+        if len(any_of) > 0:
+            selects.append(f"{select_hits} IN (SELECT value FROM json_each(:any_of))")
+        for index, search_term in enumerate(all_of):
+            selects.append(f"{'INTERSECT ' if selects else ''}{select_hits} = :all_of_{index}")
+            params[f"all_of_{index}"] = search_term
+        if len(none_of) > 0:
+            selects.append(f"EXCEPT {select_hits} IN (SELECT value FROM json_each(:none_of))")
+        query = f"""{self._get_hits_cte(include_subclasses, direct_subclasses_only)}
+                    SELECT DISTINCT
+                        {RESULT_COLUMNS}
+                    FROM hits m
+                    WHERE m.QueryTerm IN (SELECT value FROM json_each(:positive_terms))
+                        AND m.SourceTermID IN ({" ".join(selects)})
+                    ORDER BY m.SourceTermID"""
+        return _get_results_df(self.connection.execute(query, params))
+
+    def iter_resources_annotated_with_term(self, search_term, include_subclasses=True, direct_subclasses_only=False,
+                                           batch_size=STREAM_BATCH_SIZE, cursor=None, metadata_columns=()):
+        """
+        Stream the resources annotated with the given search term (and, optionally, its subclasses) in batches of at
+        most batch_size rows, so that results of any size are processed in constant memory. Rows are fetched from a
+        single keyset query (see get_keyset_query), ordered in SQL by OpenGWAS ID and ontology term (the order of
+        resources_annotated_with_term), batch_size rows at a time
+        :param cursor: if given, the stream starts after the row that the cursor (see get_results_page) points to
+        :param metadata_columns: columns of the metadata table to add to each row (joined on the OpenGWAS ID)
+        :return: generator of batches, each a list of rows (tuples) with the values of the columns in
+            get_result_columns(metadata_columns)
+        """
+        query = get_keyset_query(self.dataset_name, self.ontology_name, include_subclasses, direct_subclasses_only,
+                                 self._check_metadata_columns(metadata_columns), self.resource_id_col)
+        yield from self._iter_keyset_query(query, search_term, cursor, limit=-1, batch_size=batch_size)
+
+    def _iter_keyset_query(self, query, search_term, cursor, limit, batch_size):
+        after_id, after_term = decode_results_cursor(cursor)
+        results_cursor = self.connection.execute(query, {"term": search_term, "after_id": after_id,
+                                                         "after_term": after_term, "limit": limit})
+        try:
+            while True:
+                rows = results_cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    return
+                yield rows
+        finally:
+            results_cursor.close()
+
+    def get_results_page(self, search_term, include_subclasses=True, direct_subclasses_only=False, limit=100,
+                         cursor=None, metadata_columns=()):
+        """
+        Get a page of at most limit resources annotated with the given search term (and, optionally, its subclasses),
+        starting after the given cursor (or from the first resource if cursor is None)
+        :return: data frame of the resources in the page, and the cursor of the next page (None after the last page)
+        """
+        if limit < 1:
+            raise ValueError(f"The page size limit must be at least 1, not {limit}")
+        query = get_keyset_query(self.dataset_name, self.ontology_name, include_subclasses, direct_subclasses_only,
+                                 self._check_metadata_columns(metadata_columns), self.resource_id_col)
+        rows = next(self._iter_keyset_query(query, search_term, cursor, limit=limit + 1, batch_size=limit + 1), [])
+        next_cursor = encode_results_cursor(rows[limit - 1][0], rows[limit - 1][3]) if len(rows) > limit else None
+        return pd.DataFrame(rows[:limit], columns=get_result_columns(metadata_columns)), next_cursor
+
+    def export_resources_annotated_with_term(self, output_file, search_term, include_subclasses=True,
+                                             direct_subclasses_only=False, file_format="tsv",
+                                             batch_size=STREAM_BATCH_SIZE, metadata_columns=()):
+        """
+        Write the resources annotated with the given search term (and, optionally, its subclasses) to the given TSV
+        (file_format="tsv") or Arrow IPC (file_format="arrow") file as they are streamed, one batch at a time. TSV
+        files are written as DataFrame.to_csv(sep="\t", index=False) writes them. Arrow files require pyarrow, and have
+        a single schema given by the SQL types of the columns (see get_arrow_schema)
+        :return: number of resources written
+        """
+        if file_format not in EXPORT_WRITERS:
+            raise ValueError(f"Unknown export format '{file_format}' (expected one of {', '.join(EXPORT_WRITERS)})")
+        batches = self.iter_resources_annotated_with_term(search_term, include_subclasses, direct_subclasses_only,
+                                                          batch_size=batch_size, metadata_columns=metadata_columns)
+        column_types = dict(RESULT_COLUMN_TYPES)
+        column_types.update({column: self.get_metadata_column_types()[column] for column in metadata_columns})
+        temporary_file = f"{output_file}.{uuid.uuid4().hex}.tmp"
+        try:
+            row_count = EXPORT_WRITERS[file_format](batches, column_types, temporary_file)
+            os.replace(temporary_file, output_file)
+        finally:
+            if os.path.isfile(temporary_file):
+                os.remove(temporary_file)
+        return row_count
+
+    def filter_resources(self, search_term, include_subclasses=True, direct_subclasses_only=False, populations=(),
+                         min_sample_size=None, year_range=None, id_prefix="", min_mapping_score=None,
+                         metadata_columns=("population", "sample_size", "year")):
+        """
+        Retrieve the resources annotated with the given search term (and, optionally, its subclasses) that pass the
+        given facet filters (see metadata_facets.get_facet_conditions), which are applied in SQL. For example,
+        filter_resources("EFO:0004340", populations=["European"], min_sample_size=10000, year_range=(2015, None))
+        :return: data frame with the columns of resources_annotated_with_term and the given metadata columns (those
+            in the metadata table)
+        """
+        metadata_columns = [column for column in metadata_columns if column in self.get_metadata_columns()]
+        filters = (("populations", tuple(populations)), ("min_sample_size", min_sample_size),
+                   ("year_range", tuple(year_range) if year_range is not None else None), ("id_prefix", id_prefix),
+                   ("min_mapping_score", min_mapping_score), ("metadata_columns", tuple(metadata_columns)))
+        return self._get_results("filter_resources", (search_term,), include_subclasses, direct_subclasses_only,
+                                 filters, self._filter_resources, search_term, include_subclasses,
+                                 direct_subclasses_only, dict(filters[:-1]), metadata_columns)
+
+    def _filter_resources(self, search_term, include_subclasses, direct_subclasses_only, facet_filters,
+                          metadata_columns):
+        conditions, params = get_facet_conditions(**facet_filters)
+        columns = "".join(f",\n                        md.`{column}` AS '{column}'" for column in metadata_columns)
+        query = f"""{self._get_query_terms_cte(include_subclasses, direct_subclasses_only)}
+                    SELECT DISTINCT
+                        {RESULT_COLUMNS}{columns}
+                    FROM query_terms q
+                    JOIN {self.dataset_name}_mappings m ON m.MappedTermCURIE = q.Term
+                    LEFT JOIN {self.dataset_name}_metadata md ON md.{self.resource_id_col} = m.SourceTermID
+                    {"WHERE " + conditions if conditions else ""}
+                    ORDER BY m.SourceTermID"""
+        return _get_results_df(self.connection.execute(query, dict(params, term=search_term)))
+
+    def count_facets(self, search_term, include_subclasses=True, direct_subclasses_only=False,
+                     facets=DEFAULT_FACETS, populations=(), min_sample_size=None, year_range=None, id_prefix="",
+                     min_mapping_score=None):
+        """
+        Count the resources annotated with the given search term (and, optionally, its subclasses) that pass the given
+        facet filters (as in filter_resources) by each value of each of the given facets (metadata columns), with a
+        single query
+        :return: data frame of facets, their values and the number of resources with each value ('Facet', 'Value'
+            and 'Count' columns), ordered by facet (in the given order) and then by decreasing count
+        """
+        facets = self._check_metadata_columns(facets)
+        filters = (("populations", tuple(populations)), ("min_sample_size", min_sample_size),
+                   ("year_range", tuple(year_range) if year_range is not None else None), ("id_prefix", id_prefix),
+                   ("min_mapping_score", min_mapping_score))
+        return self._get_results("count_facets", (search_term,), include_subclasses, direct_subclasses_only,
+                                 filters + (("facets", tuple(facets)),), self._count_facets, search_term,
+                                 include_subclasses, direct_subclasses_only, dict(filters), facets)
+
+    def _count_facets(self, search_term, include_subclasses, direct_subclasses_only, facet_filters, facets):
+        if len(facets) == 0:
+            return pd.DataFrame(columns=["Facet", "Value", "Count"])
+        conditions, params = get_facet_conditions(**facet_filters)
+        metadata_table = f"{self.dataset_name}_metadata"
+        facet_counts = " UNION ALL ".join(
+            f"""SELECT {position} AS Position, '{facet}' AS Facet, md.`{facet}` AS Value, COUNT(*) AS Count
+                        FROM resources r JOIN {metadata_table} md ON md.{self.resource_id_col} = r.SourceTermID
+                        GROUP BY md.`{facet}`""" for position, facet in enumerate(facets))
+        query = f"""{self._get_query_terms_cte(include_subclasses, direct_subclasses_only)},
+                    resources AS (
+                        SELECT DISTINCT m.SourceTermID
+                        FROM query_terms q
+                        JOIN {self.dataset_name}_mappings m ON m.MappedTermCURIE = q.Term
+                        LEFT JOIN {metadata_table} md ON md.{self.resource_id_col} = m.SourceTermID
+                        {"WHERE " + conditions if conditions else ""})
+                    SELECT Facet, Value, Count FROM ({facet_counts})
+                    ORDER BY Position, Count DESC, Value"""
+        return _get_results_df(self.connection.execute(query, dict(params, term=search_term)))
+
+    # Get the common table expression of the :term parameter and, optionally, of its subclasses, whose mappings are then
+    #  looked up through the index of mapped terms. Unlike the search queries, with their (correlated) subquery of
+    #  subclasses, this also stays fast once the metadata table is joined. Mappings are joined by term rather than by
+    #  row ID, as the mappings table of a compact database is a view (see compact_schema)
+    def _get_query_terms_cte(self, include_subclasses, direct_subclasses_only):
+        cte = """WITH query_terms(Term) AS (
+                        SELECT :term"""
+        if include_subclasses:
+            ontology_table = self.ontology_name + ("_edges" if direct_subclasses_only else "_entailed_edges")
+            cte += f"""
+                        UNION
+                        SELECT ee.Subject FROM {ontology_table} ee WHERE ee.Object = :term"""
+        return cte + ")"
+
+    def get_metadata_columns(self):
+        """
+        Get the names of the columns of the metadata table
+        """
+        return list(self.get_metadata_column_types())
+
+    def get_metadata_column_types(self):
+        """
+        Get the declared SQL types of the columns of the metadata table, by column name
+        """
+        if self._metadata_column_types is None:
+            self._metadata_column_types = {row[1]: row[2] for row in self.connection.execute(
+                f"PRAGMA table_info({self.dataset_name}_metadata)")}
+        return self._metadata_column_types
+
+    # Check that the given columns are in the metadata table, as they are inserted into queries as is
+    def _check_metadata_columns(self, columns):
+        unknown_columns = [column for column in columns if column not in self.get_metadata_columns()]
+        if len(unknown_columns) > 0:
+            raise ValueError(f"Unknown metadata columns: {', '.join(unknown_columns)}")
+        return list(columns)
+
+    def resources_located_in(self, site, include_parts=True):
+        """
+        Retrieve the resources mapped to diseases located in the given anatomical site (e.g. 'UBERON:0001264',
+        pancreas) or, if include_parts is True, in any of its parts or subclasses (e.g. the islets of Langerhans),
+        with a single lookup of the location index built with the database (see anatomy_search.build_location_index)
+        :return: data frame with the columns of resources_annotated_with_term and the location ('DiseaseLocation') of
+            the mapped term within the site
+        """
+        return self._get_results("resources_located_in", (site,), include_parts, False, (),
+                                 self._search_location, site, include_parts)
+
+    def _search_location(self, site, include_parts):
+        return _get_results_df(self.connection.execute(get_location_search_query(self.dataset_name, include_parts),
+                                                       {"site": site}))
+
+    def find_terms(self, text, limit=10):
+        """
+        Find the ontology terms whose labels or exact synonyms match the given free text (e.g. "pancreatitis" or "BMI"),
+        using the full-text tables built with the database (see text_search.build_text_search_tables). Terms with a
+        label or synonym equal to the text come first, followed by the other matches in order of BM25 rank
+        :return: data frame of at most limit terms, with their CURIE ('OntologyTermID') and label, the label or
+            synonym that matched best, its BM25 score and the number of records mapped to the term or its subclasses
+        """
+        return self._get_results("find_terms", (text,), False, False, (("limit", limit),), self._find_terms, text,
+                                 limit)
+
+    def _find_terms(self, text, limit):
+        match = get_match_expression(text)
+        if match == "":
+            return pd.DataFrame(columns=TERM_MATCH_COLUMNS)
+        return _get_results_df(self.connection.execute(get_terms_query(self.ontology_name),
+                                                       {"match": match, "text": text.strip(), "limit": limit}))
+
+    def search_text(self, text, max_terms=5, include_subclasses=True, direct_subclasses_only=False):
+        """
+        Retrieve the resources annotated with the ontology terms that best match the given free text (the first
+        max_terms terms found by find_terms) and, optionally, with their subclasses
+        :return: data frame with the same columns as search_terms, whose 'QueryTerm' column has the matching term
+            each resource was found for. Rows are ordered by rank of the matching terms
+        """
+        search_terms = self.find_terms(text, limit=max_terms)["OntologyTermID"].tolist()
+        if len(search_terms) == 0:
+            return pd.DataFrame(columns=["QueryTerm"] + RESULT_COLUMN_NAMES)
+        return self.search_terms(search_terms, include_subclasses, direct_subclasses_only)
+
+    def search_metadata_text(self, text, limit=100):
+        """
+        Retrieve the resources whose trait, or the title of whose PubMed reference, match the given free text, whether
+        or not they are mapped to ontology terms. Matches in traits rank above matches in titles
+        :return: data frame of at most limit resources, with their ID, trait, reference title and BM25 score
+        """
+        return self._get_results("search_metadata_text", (text,), False, False, (("limit", limit),),
+                                 self._search_metadata_text, text, limit)
+
+    def _search_metadata_text(self, text, limit):
+        match = get_match_expression(text)
+        if match == "":
+            return pd.DataFrame(columns=METADATA_MATCH_COLUMNS)
+        return _get_results_df(self.connection.execute(get_metadata_query(self.dataset_name),
+                                                       {"match": match, "limit": limit}))
+
+    # Get the results of the given search by calling search(*args), or from the result cache (if any)
+    def _get_results(self, search_type, search_terms, include_subclasses, direct_subclasses_only, filters, search,
+                     *args):
+        if self.result_cache is None:
+            return search(*args)
+        key = (self.version, search_type, search_terms, include_subclasses, direct_subclasses_only, filters)
+        return self.result_cache.get_or_compute(key, lambda: search(*args))
+
+    # Get the common table expressions of the query terms (bound to the :terms parameter as a JSON array, and numbered
+    #  by their first position in it), of the terms searched for each query term (itself and, optionally, its
+    #  subclasses), and of the mappings found for each query term (with duplicates, which the queries of hits remove).
+    #  The mappings are joined by term, through the index of mapped terms, which is also how they are looked up
+    #  through the views of a compact database
+    def _get_hits_cte(self, include_subclasses, direct_subclasses_only):
+        ontology_table = self.ontology_name + ("_edges" if direct_subclasses_only else "_entailed_edges")
+        subclasses = f"""
+                        UNION ALL
+                        SELECT q.QueryTerm, q.Position, ee.Subject FROM query_terms q
+                        JOIN {ontology_table} ee ON ee.Object = q.QueryTerm""" if include_subclasses else ""
+        return f"""WITH query_terms(QueryTerm, Position) AS (
+                        SELECT value, MIN(key) FROM json_each(:terms) GROUP BY value),
+                    searched_terms(QueryTerm, Position, Term) AS (
+                        SELECT q.QueryTerm, q.Position, q.QueryTerm FROM query_terms q{subclasses}),
+                    hits AS (
+                        SELECT s.QueryTerm, s.Position, m.SourceTermID, m.SourceTerm, m.MappedTermLabel,
+                            m.MappedTermCURIE, m.MappingScore
+                        FROM searched_terms s
+                        JOIN {self.dataset_name}_mappings m ON m.MappedTermCURIE = s.Term)"""
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_database_version(connection, database_file=""):
+    """
+    Get the version of a search database: the versions of all resources in its version_info table (the search
+    database itself, the ontologies and the metadata) or, for databases without that table, the path, size and
+    modification time of the database file
+    """
+    try:
+        versions = connection.execute("SELECT Resource, Version FROM version_info ORDER BY Resource").fetchall()
+        return ";".join(f"{resource}={version}" for resource, version in versions)
+    except sqlite3.OperationalError:  # no version_info table
+        file_status = os.stat(database_file)
+        return f"{os.path.abspath(database_file)}:{file_status.st_size}:{file_status.st_mtime_ns}"
+
+
+def get_keyset_query(dataset_name="opengwas", ontology_name="efo", include_subclasses=True,
+                     direct_subclasses_only=False, metadata_columns=(), resource_id_col="id"):
+    """
+    Get the query that finds the resources annotated with the :term parameter (and, optionally, its subclasses) in
+    keyset pages: at most :limit rows, ordered by OpenGWAS ID and ontology term ID, that come after the row with the
+    :after_id and :after_term IDs (a :limit of -1 gives all the rows after them). As in a search, the mappings are
+    looked up through the indexes of the mappings and edges tables, and only the mappings found are sorted
+    """
+    ontology_table = ontology_name + ("_edges" if direct_subclasses_only else "_entailed_edges")
+    columns = RESULT_COLUMNS + "".join(f",\n                    md.`{column}` AS '{column}'"
+                                       for column in metadata_columns)
+    metadata_join = (f"\n                LEFT JOIN {dataset_name}_metadata md ON md.{resource_id_col} = m.SourceTermID"
+                     if len(metadata_columns) > 0 else "")
+    subclasses = f"""
+                        OR m.MappedTermCURIE IN (SELECT ee.Subject FROM {ontology_table} ee WHERE ee.Object = :term)"""
+    return f"""SELECT DISTINCT
+                    {columns}
+                FROM {dataset_name}_mappings m{metadata_join}
+                WHERE (m.MappedTermCURIE = :term{subclasses if include_subclasses else ""})
+                    AND (m.SourceTermID, m.MappedTermCURIE) > (:after_id, :after_term)
+                ORDER BY m.SourceTermID, m.MappedTermCURIE
+                LIMIT :limit"""
+
+
+def get_result_columns(metadata_columns=()):
+    return RESULT_COLUMN_NAMES + list(metadata_columns)
+
+
+# Cursors of result pages are opaque (URL-safe) strings that encode the IDs of the last row of the previous page
+def encode_results_cursor(resource_id, term_id):
+    return base64.urlsafe_b64encode(json.dumps([resource_id, term_id]).encode("utf-8")).decode("ascii")
+
+
+def decode_results_cursor(cursor):
+    if cursor is None:
+        return "", ""  # before any row, as IDs are non-empty strings
+    try:
+        resource_id, term_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid results cursor: '{cursor}'")
+    return resource_id, term_id
+
+
+# Write the given batches of rows (with the columns of the given SQL types, by column name) to a TSV file incrementally,
+#  formatting values as DataFrame.to_csv does
+def _write_tsv(batches, column_types, output_file):
+    columns = list(column_types)
+    row_count = 0
+    with open(output_file, "w", newline="") as file_out:
+        pd.DataFrame(columns=columns).to_csv(file_out, sep="\t", index=False)
+        for rows in batches:
+            pd.DataFrame(rows, columns=columns).to_csv(file_out, sep="\t", index=False, header=False)
+            row_count += len(rows)
+    return row_count
+
+
+# Write the given batches of rows (with the columns of the given SQL types, by column name) to an Arrow IPC file, as one
+#  record batch per batch of rows. All batches have the schema of the SQL types, so a column can be entirely null in
+#  some batches and not in others
+def _write_arrow(batches, column_types, output_file):
+    if pyarrow is None:
+        raise ImportError("Exporting results in Arrow format requires the pyarrow package")
+    schema = get_arrow_schema(column_types)
+    row_count = 0
+    with pyarrow.ipc.new_file(output_file, schema) as writer:
+        for rows in batches:
+            arrays = [pyarrow.array(values if pyarrow.types.is_primitive(field.type) else
+                                    [None if value is None else str(value) for value in values], type=field.type)
+                      for values, field in zip(zip(*rows), schema)]
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+            row_count += len(rows)
+    return row_count
+
+
+def get_arrow_schema(column_types):
+    """
+    Get the Arrow schema of columns of the given SQL types (by column name): INTEGER columns are 64-bit integers, REAL
+    (or FLOAT/DOUBLE) columns are doubles, and columns of any other type are strings
+    """
+    if pyarrow is None:
+        raise ImportError("Exporting results in Arrow format requires the pyarrow package")
+    fields = []
+    for column, sql_type in column_types.items():
+        sql_type = (sql_type or "").upper()
+        if "INT" in sql_type:
+            arrow_type = pyarrow.int64()
+        elif any(real_type in sql_type for real_type in ("REAL", "FLOA", "DOUB")):
+            arrow_type = pyarrow.float64()
+        else:
+            arrow_type = pyarrow.string()
+        fields.append(pyarrow.field(column, arrow_type))
+    return pyarrow.schema(fields)
+
+
+EXPORT_WRITERS = {"tsv": _write_tsv, "arrow": _write_arrow}
+
+
+def get_search_query(dataset_name="opengwas", ontology_name="efo", include_subclasses=True,
+                     direct_subclasses_only=False):
+    """
+    Get the parameterized query that finds the resources annotated with a search term (given as the first parameter)
+    and, if include_subclasses=True, with its subclasses (the search term is then also the second parameter)
+    """
+    ontology_table = ontology_name + ("_edges" if direct_subclasses_only else "_entailed_edges")
+    query = f"""SELECT DISTINCT
+                    {RESULT_COLUMNS}
+                FROM {dataset_name}_mappings m
+                WHERE m.MappedTermCURIE = ?"""
+    if include_subclasses:
+        query += f"""
+                    OR m.MappedTermCURIE IN (SELECT ee.Subject FROM {ontology_table} ee WHERE ee.Object = ?)"""
+    return query + """
+                ORDER BY m.SourceTermID"""
+
+
+def _get_search_params(search_term, include_subclasses):
+    return (search_term, search_term) if include_subclasses else (search_term,)
+
+
+def _get_results_df(cursor):
+    results_columns = [x[0] for x in cursor.description]
+    return pd.DataFrame(cursor.fetchall(), columns=results_columns)
+
 
 def resources_annotated_with_term(cursor, search_term, include_subclasses=True, direct_subclasses_only=False):
     """
@@ -85,79 +684,99 @@ def resources_annotated_with_term(cursor, search_term, include_subclasses=True,
         otherwise all the resources annotated with inferred subclasses of the given term are returned
     :return: data frame containing IDs and traits of the OpenGWAS records found to be annotated with the give term
     """
-    if include_subclasses:
-        if direct_subclasses_only:
-            ontology_table = "efo_edges"
-        else:
-            ontology_table = "efo_entailed_edges"
-    else:
-        ontology_table = "efo_edges"
-
-    query = '''SELECT DISTINCT 
-                    m.SourceTermID AS 'OpenGWASID', 
-                    m.SourceTerm AS 'OpenGWASTrait',
-                    m.MappedTermLabel AS 'OntologyTerm', 
-                    m.MappedTermCURIE AS 'OntologyTermID',
-                    m.MappingScore AS 'MappingConfidence'
-                FROM opengwas_mappings m
-                LEFT JOIN ''' + ontology_table + ''' ee ON (m.MappedTermCURIE = ee.Subject)
-                WHERE (m.MappedTermCURIE = \'''' + search_term + '''\'''' + \
-            (''' OR ee.Object = \'''' + search_term + '''\'''' if include_subclasses else '''''') +\
-            ''')'''
-    results = cursor.execute(query).fetchall()
-    results_columns = [x[0] for x in cursor.description]
-    results_df = pd.DataFrame(results, columns=results_columns)
-    results_df = results_df.sort_values(by=['OpenGWASID'])
-    return results_df
+    query = get_search_query(include_subclasses=include_subclasses, direct_subclasses_only=direct_subclasses_only)
+    return _get_results_df(cursor.execute(query, _get_search_params(search_term, include_subclasses)))
 
 
-def do_example_query(cursor, search_term, include_subclasses, direct_subclasses_only):
-    df = resources_annotated_with_term(cursor,
-                                       search_term=search_term,
-                                       include_subclasses=include_subclasses,
-                                       direct_subclasses_only=direct_subclasses_only)
-    print("Resources annotated with " + search_term + ": " + ("0" if df.empty else str(df.shape[0])))
+# Write the resources annotated with the given search term to a TSV file in the example query folder as they are
+#  streamed (see SearchEngine.export_resources_annotated_with_term), along with a file of the query parameters and
+#  results count. Returns the results count
+def do_example_query(search_engine, search_term, include_subclasses, direct_subclasses_only):
     output_folder = "../test/example_query/"
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
     output_file = output_folder + "search_term_" + search_term
-    if not df.empty:
-        print(df.head().to_string() + "\n")
-        if include_subclasses:
-            if direct_subclasses_only:
-                output_file += "_" + "incl_direct_subclasses"
-            else:
-                output_file += "_" + "incl_inferred_subclasses"
-        df.to_csv(output_file + ".tsv", sep="\t", index=False)  # write out query results
+    if include_subclasses:
+        if direct_subclasses_only:
+            output_file += "_" + "incl_direct_subclasses"
+        else:
+            output_file += "_" + "incl_inferred_subclasses"
+    row_count = search_engine.export_resources_annotated_with_term(output_file + ".tsv", search_term=search_term,
+                                                                   include_subclasses=include_subclasses,
+                                                                   direct_subclasses_only=direct_subclasses_only)
+    print("Resources annotated with " + search_term + ": " + str(row_count))
+    if row_count > 0:
+        first_page, _ = search_engine.get_results_page(search_term, include_subclasses, direct_subclasses_only,
+                                                       limit=5)
+        print(first_page.to_string() + "\n")
+    else:  # no results file, and the parameters file is named after the search term only
+        os.remove(output_file + ".tsv")
+        output_file = output_folder + "search_term_" + search_term
 
     with open(output_file + ".txt", 'w') as f:  # write out query parameters and results count
         f.write("# query parameters:\n")
         f.write("search_term='%s'\n" % search_term)
         f.write("include_subclasses=%s\n" % include_subclasses)
         f.write("direct_subclasses_only=%s\n\n" % str(direct_subclasses_only))
-        f.write("# query results count: %s" % str(df.shape[0]))
-    return df
+        f.write("# query results count: %s" % str(row_count))
+    return row_count
+
+
+def do_example_queries(search_engine, search_term='EFO:0009605'):  # EFO:0009605 'pancreas disease'
+    do_example_query(search_engine, search_term=search_term, include_subclasses=False, direct_subclasses_only=False)
+    do_example_query(search_engine, search_term=search_term, include_subclasses=True, direct_subclasses_only=True)
+    do_example_query(search_engine, search_term=search_term, include_subclasses=True, direct_subclasses_only=False)
 
 
-def do_example_queries(cursor, search_term='EFO:0009605'):  # EFO:0009605 'pancreas disease'
-    do_example_query(cursor, search_term=search_term, include_subclasses=False, direct_subclasses_only=False)
-    do_example_query(cursor, search_term=search_term, include_subclasses=True, direct_subclasses_only=True)
-    do_example_query(cursor, search_term=search_term, include_subclasses=True, direct_subclasses_only=False)
+# Time the search of the given number of EFO terms (those with mappings, in order of their CURIEs) one term at a time
+#  versus in a single batch, for each kind of search, and check that both give the same results
+def benchmark_batch_search(database_file, term_count=300, repetitions=3):
+    with SearchEngine(database_file) as engine:
+        search_terms = [row[0] for row in engine.connection.execute(
+            f"SELECT Subject FROM {engine.ontology_name}_labels WHERE Direct + Inherited > 0 ORDER BY Subject LIMIT ?",
+            (term_count,))]
+        print(f"Searching {len(search_terms)} terms in {database_file}:")
+        for include_subclasses, direct_subclasses_only in ((False, False), (True, True), (True, False)):
+            start = time.time()
+            for _ in range(repetitions):
+                loop_results = [engine.resources_annotated_with_term(search_term, include_subclasses,
+                                                                     direct_subclasses_only)
+                                for search_term in search_terms]
+            loop_time = (time.time() - start) / repetitions
+            start = time.time()
+            for _ in range(repetitions):
+                batch_results = engine.search_terms(search_terms, include_subclasses, direct_subclasses_only)
+            batch_time = (time.time() - start) / repetitions
+            same_results = sum(len(results) for results in loop_results) == len(batch_results) and all(
+                results.values.tolist() == batch_results.loc[batch_results["QueryTerm"] == search_term,
+                                                             batch_results.columns[1:]].values.tolist()
+                for search_term, results in zip(search_terms, loop_results))
+            print(f"\tinclude_subclasses={include_subclasses}, direct_subclasses_only={direct_subclasses_only}: "
+                  f"{len(batch_results)} results, per-term loop {loop_time:.3f} seconds, batch {batch_time:.3f} "
+                  f"seconds (~{loop_time / max(batch_time, 1e-9):.1f}x faster){'' if same_results else ' MISMATCH'}")
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark-batch", metavar="DATABASE_FILE", default="",
+                        help="benchmark batch versus per-term search on the given database, instead of running the "
+                             "example queries")
+    arguments = parser.parse_args()
+    if arguments.benchmark_batch != "":
+        benchmark_batch_search(arguments.benchmark_batch)
+        sys.exit(0)
+
     tar_file_path = os.path.join("..", "opengwas_search.db.tar.xz")
     database_file_name = "opengwas_search.db"
 
-    with tarfile.open(tar_file_path, "r:xz") as tar:
-        tar.extract(database_file_name, path="..")
-
-    db_connection = sqlite3.connect(os.path.join("..", database_file_name))
-    db_cursor = db_connection.cursor()
-
-    do_example_queries(db_cursor, search_term="EFO:0009605")  # 'pancreas disease'
-    do_example_queries(db_cursor, search_term="EFO:0005741")  # 'infectious disease'
-    do_example_queries(db_cursor, search_term="EFO:0004324")  # 'body weights and measures'
+    # Extract the database only if it was not extracted yet, or the archive changed since it was extracted
+    database_file_path = os.path.join("..", database_file_name)
+    if not os.path.isfile(database_file_path) or os.path.getmtime(database_file_path) < os.path.getmtime(tar_file_path):
+        with tarfile.open(tar_file_path, "r:xz") as tar:
+            tar.extract(database_file_name, path="..")
+        os.utime(database_file_path)
 
-    db_cursor.close()
-    db_connection.close()
+    with SearchEngine(database_file_path) as engine:
+        do_example_queries(engine, search_term="EFO:0009605")  # 'pancreas disease'
+        do_example_queries(engine, search_term="EFO:0005741")  # 'infectious disease'
+        do_example_queries(engine, search_term="EFO:0004324")  # 'body weights and measures'
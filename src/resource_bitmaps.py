@@ -0,0 +1,157 @@
+import sys
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+__version__ = "0.1.0"
+
+# Encodings of a resource bitmap, given by its first byte. Small sets of resources are stored as arrays of their
+#  (sorted) bit positions, and larger ones as packed bitsets, whichever is smaller
+ARRAY_BITMAP = 0
+BITSET_BITMAP = 1
+
+RESOURCE_COUNT_TYPES = ("Direct", "Inherited")
+
+
+def encode_bitmap(bits):
+    """
+    Encode a set of resources, given as a bitset (a Python int whose bit i stands for the i-th resource), as bytes
+    """
+    bitset = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    positions = _get_bitset_positions(bitset)
+    if positions.size * 4 < len(bitset):
+        return bytes([ARRAY_BITMAP]) + positions.astype("<u4").tobytes()
+    return bytes([BITSET_BITMAP]) + bitset
+
+
+def decode_bitmap(bitmap):
+    """
+    Get the (sorted) positions of the resources in a bitmap encoded by encode_bitmap
+    """
+    if bitmap is None or len(bitmap) == 0:
+        return np.empty(0, dtype=np.int64)
+    if bitmap[0] == ARRAY_BITMAP:
+        return np.frombuffer(bitmap, dtype="<u4", offset=1).astype(np.int64)
+    return _get_bitset_positions(bitmap[1:])
+
+
+def _get_bitset_positions(bitset):
+    return np.flatnonzero(np.unpackbits(np.frombuffer(bitset, dtype=np.uint8), bitorder="little"))
+
+
+# Get the table of encoded Direct and Inherited resource bitmaps of the terms in the given data frame of term resource
+#  bitsets (see generate_mapping_report.get_term_resources_from_edges). Terms without resources are left out
+def get_resource_bitmaps_table(term_resources_df):
+    term_resources_df = term_resources_df[(term_resources_df["Direct"] != 0) | (term_resources_df["Inherited"] != 0)]
+    return pd.DataFrame({"IRI": term_resources_df["IRI"].values,
+                         "Direct": [encode_bitmap(bits) for bits in term_resources_df["Direct"]],
+                         "Inherited": [encode_bitmap(bits) for bits in term_resources_df["Inherited"]]})
+
+
+# Get the table of the resource identifiers that the bits of the resource bitmaps stand for
+def get_bitmap_resources_table(resources):
+    return pd.DataFrame({"Bit": np.arange(len(resources), dtype=np.int64), "ResourceID": np.asarray(resources)})
+
+
+class ResourceBitmapIndex:
+    """
+    Counts the resources mapped to each ontology term (directly, or only to its descendants) among any subset of the
+    resources, given by a filter on the metadata table, using the resource bitmaps stored in the database by the
+    build (the '<ontology>_resource_bitmaps' and '<ontology>_bitmap_resources' tables). The bitmaps are loaded once,
+    into sparse term-by-resource matrices, so that the filtered counts of all terms are computed by multiplying each
+    matrix with the filter bitmap. Without a filter, the counts are those in the '<ontology>_labels' table.
+    """
+
+    def __init__(self, connection, ontology_name="efo", dataset_name="opengwas", resource_id_col="id"):
+        self.connection = connection
+        self.metadata_table = dataset_name + "_metadata"
+        self.resource_id_col = resource_id_col
+        bitmaps_df = pd.read_sql_query(f"SELECT IRI, Direct, Inherited FROM {ontology_name}_resource_bitmaps",
+                                       connection)
+        resources_df = pd.read_sql_query(f"SELECT Bit, ResourceID FROM {ontology_name}_bitmap_resources ORDER BY Bit",
+                                         connection)
+        self.iris = pd.Index(bitmaps_df["IRI"])
+        self.resources = pd.Index(resources_df["ResourceID"].astype(str))
+        self._matrices = {count_type: self._get_matrix(bitmaps_df[count_type]) for count_type in RESOURCE_COUNT_TYPES}
+
+    def _get_matrix(self, bitmaps):
+        rows = [decode_bitmap(bitmap) for bitmap in bitmaps]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(row) for row in rows])
+        indices = np.concatenate(rows) if len(rows) > 0 else np.empty(0, dtype=np.int64)
+        return scipy.sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                                       shape=(len(rows), len(self.resources)))
+
+    def get_resource_filter(self, where="", params=(), resource_ids=None):
+        """
+        Get the filter bitmap, as a boolean array over the resources, of the resources in the metadata table that
+        satisfy the given SQL condition, e.g. where="population = ? AND year > ?" with params=("European", 2018),
+        or where="id LIKE 'ukb-%'". The condition is inserted into the query as is, so it must come from a trusted
+        source; values should be given as parameters
+        :param resource_ids: if given, only the resources with these identifiers are kept (after the SQL filter)
+        """
+        resource_filter = np.ones(len(self.resources), dtype=bool)
+        if where != "":
+            query = f"SELECT {self.resource_id_col} FROM {self.metadata_table} WHERE {where}"
+            selected_ids = [str(row[0]) for row in self.connection.execute(query, params)]
+            resource_filter &= self._get_resources_mask(selected_ids)
+        if resource_ids is not None:
+            resource_filter &= self._get_resources_mask([str(resource_id) for resource_id in resource_ids])
+        return resource_filter
+
+    def _get_resources_mask(self, resource_ids):
+        mask = np.zeros(len(self.resources), dtype=bool)
+        positions = self.resources.get_indexer(resource_ids)
+        mask[positions[positions >= 0]] = True
+        return mask
+
+    def get_filtered_counts(self, where="", params=(), resource_ids=None, resource_filter=None):
+        """
+        Get the Direct and Inherited counts of all terms with mapped resources, counting only the resources that
+        satisfy the given filter (see get_resource_filter), or those in the given filter bitmap
+        :return: data frame of term IRIs and their filtered 'Direct' and 'Inherited' counts
+        """
+        if resource_filter is None:
+            resource_filter = self.get_resource_filter(where, params, resource_ids)
+        resource_filter = resource_filter.astype(np.int32)
+        counts = {count_type: matrix @ resource_filter for count_type, matrix in self._matrices.items()}
+        return pd.DataFrame({"IRI": self.iris.values, **counts})
+
+    def get_term_resources(self, iri, count_type="Direct"):
+        """
+        Get the identifiers of the resources mapped to the given term (count_type="Direct") or only to its
+        descendants (count_type="Inherited")
+        """
+        row = self.iris.get_indexer([iri])[0]
+        if row < 0:
+            return []
+        matrix = self._matrices[count_type]
+        return self.resources[matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]].tolist()
+
+
+# Time the loading of the resource bitmaps of the given database and the computation of the counts of all terms, with
+#  no filter and with each of the given metadata filters (SQL conditions)
+def benchmark_filtered_counts(database_file, filters=("id LIKE 'ukb-%'", "id LIKE 'finn-%'", "year > 2018"),
+                              repetitions=10, **index_arguments):
+    connection = sqlite3.connect(database_file)
+    start = time.time()
+    index = ResourceBitmapIndex(connection, **index_arguments)
+    print(f"Loaded resource bitmaps of {len(index.iris)} terms and {len(index.resources)} resources "
+          f"({time.time() - start:.2f} seconds)")
+    for where in ("",) + tuple(filters):
+        start = time.time()
+        resource_filter = index.get_resource_filter(where)
+        filter_time = time.time() - start
+        start = time.time()
+        for _ in range(repetitions):
+            counts_df = index.get_filtered_counts(resource_filter=resource_filter)
+        counts_time = (time.time() - start) / repetitions
+        print(f"\t{where or 'no filter'}: {resource_filter.sum()} resources, {(counts_df['Direct'] > 0).sum()} terms "
+              f"with direct mappings (filter: {filter_time * 1000:.1f} ms, counts: {counts_time * 1000:.1f} ms)")
+    connection.close()
+
+
+if __name__ == "__main__":
+    benchmark_filtered_counts(sys.argv[1] if len(sys.argv) > 1 else "../opengwas_search.db")
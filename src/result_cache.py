@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+__version__ = "0.2.0"
+
+MAX_ENTRIES = 1024
+MAX_BYTES = 256 * 1024 * 1024
+
+
+class SearchResultCache:
+    """
+    Least-recently-used cache of search results (data frames), bounded both by number of entries and by the memory
+    used by the cached data frames. Keys start with the version of the database searched (see
+    query_database.get_database_version), so results of a database are never returned for another one, and the entries
+    of other versions are dropped as soon as a database with a new version is searched (see set_version).
+
+    With a cache file, the cache is loaded from that file when created and written to it by save(), so that it
+    survives restarts. The file is JSON (the key, columns, dtypes and rows of each result), so loading it never runs
+    code, and it is only readable and writable by its owner. The cache can be shared by several threads and search
+    engines.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, cache_file=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_file = cache_file
+        self.version = None
+        self._entries = OrderedDict()  # key -> (data frame, size in bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        if cache_file is not None and os.path.isfile(cache_file):
+            self._load()
+
+    def set_version(self, version):
+        """
+        Set the version of the database being searched, dropping the entries of all other versions
+        """
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            for key in [key for key in self._entries if key[0] != version]:
+                self._remove(key)
+                self._metrics["invalidations"] += 1
+
+    def get_or_compute(self, key, compute):
+        """
+        Get a copy of the cached result of the given key, or else compute the result by calling compute() and cache it
+        (unless the version was changed while it was computed)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._metrics["hits"] += 1
+                return entry[0].copy()
+            self._metrics["misses"] += 1
+            version = self.version
+        result = compute()
+        self.put(key, result, version=version)
+        return result.copy()
+
+    def put(self, key, result, version=None):
+        """
+        Cache the given result of the given key. The result is discarded if the key is of another version than the
+        current one or, if a version is given (the version current when the result was computed), if the current
+        version has changed since
+        """
+        size = int(result.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if (version is not None and version != self.version) or \
+                    (self.version is not None and key[0] != self.version):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._metrics["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_metrics(self):
+        """
+        Get the number of hits, misses, evictions (to keep within the size bounds) and invalidations (of entries of
+        other database versions), and the hit rate, number of entries and bytes used
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+            lookups = metrics["hits"] + metrics["misses"]
+            metrics.update(hit_rate=metrics["hits"] / lookups if lookups > 0 else 0.0, entries=len(self._entries),
+                           bytes=self._bytes)
+            return metrics
+
+    def save(self):
+        """
+        Write the cached entries of the current version to the cache file (if any), readable only by its owner
+        """
+        if self.cache_file is None:
+            return
+        with self._lock:
+            entries = [(key, result) for key, (result, _) in self._entries.items() if key[0] == self.version]
+        contents = {"version": __version__, "entries": [_encode_entry(key, result) for key, result in entries]}
+        temporary_file = f"{self.cache_file}.{uuid.uuid4().hex}.tmp"
+        with open(os.open(temporary_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as file_out:
+            json.dump(contents, file_out, default=_to_json)
+        os.replace(temporary_file, self.cache_file)
+
+    # Load the entries of the cache file, unless it is of another version of the cache (or not a cache file at all,
+    #  e.g. a file of an older version), or it is owned by another user
+    def _load(self):
+        if hasattr(os, "getuid") and os.stat(self.cache_file).st_uid != os.getuid():
+            print(f"...warning: not loading result cache {self.cache_file}, which is owned by another user")
+            return
+        try:
+            with open(self.cache_file) as file_in:
+                contents = json.load(file_in)
+        except (ValueError, UnicodeDecodeError):
+            return
+        if not isinstance(contents, dict) or contents.get("version") != __version__:
+            return
+        for entry in contents["entries"]:
+            self.put(*_decode_entry(entry))
+
+    def _remove(self, key):
+        _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Get the JSON representation of a cache entry: its key (whose tuples become lists), and the columns, dtypes and rows
+#  of its result (with missing values as None)
+def _encode_entry(key, result):
+    rows = result.astype(object).where(result.notna(), None).values.tolist()
+    return {"key": key, "columns": result.columns.tolist(), "dtypes": result.dtypes.astype(str).tolist(), "rows": rows}
+
+
+def _decode_entry(entry):
+    result = pd.DataFrame(entry["rows"], columns=entry["columns"], dtype=object)
+    result = result.astype(dict(zip(entry["columns"], entry["dtypes"])))
+    return _to_tuple(entry["key"]), result
+
+
+def _to_tuple(value):
+    return tuple(_to_tuple(item) for item in value) if isinstance(value, list) else value
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Time repeated searches of the given terms in the given database, without and with a result cache
+def benchmark_result_cache(database_file, search_terms, repetitions=10):
+    from query_database import SearchEngine
+    cache = SearchResultCache()
+    for result_cache in (None, cache):
+        with SearchEngine(database_file, result_cache=result_cache) as search_engine:
+            start = time.time()
+            for _ in range(repetitions):
+                for search_term in search_terms:
+                    search_engine.resources_annotated_with_term(search_term, include_subclasses=True)
+            search_time = (time.time() - start) / (repetitions * len(search_terms))
+        print(f"{'With' if result_cache else 'Without'} result cache: {search_time * 1000:.2f} ms per search")
+    print(f"Cache metrics: {cache.get_metrics()}")
+
+
+if __name__ == "__main__":
+    benchmark_result_cache(sys.argv[1] if len(sys.argv) > 1 else "../opengwas_search.db",
+                           sys.argv[2:] if len(sys.argv) > 2 else ["EFO:0009605", "EFO:0005741", "EFO:0004324"])
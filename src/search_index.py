@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import mmap
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+
+__version__ = "0.1.0"
+
+INDEX_FILE_MAGIC = b"OGSIDX01"
+ARRAY_ALIGNMENT = 64
+
+MAPPING_COLUMNS = ("SourceTermID", "SourceTerm", "MappedTermLabel", "MappedTermCURIE", "MappingScore")
+RESULT_COLUMNS = ("OpenGWASID", "OpenGWASTrait", "OntologyTerm", "OntologyTermID", "MappingConfidence")
+STRING_COLUMNS = MAPPING_COLUMNS[:4]
+
+
+class SearchIndex:
+    """
+    In-memory index of the mappings and of the asserted and entailed subClassOf edges of a search database, which
+    answers the same searches as query_database.SearchEngine with array operations instead of SQL queries.
+
+    Ontology terms (CURIEs) are integer-coded by their position in a sorted array of all terms. Each table of edges is
+    kept in CSR form in both directions: for each term, the (sorted) codes of its children and of its parents. The
+    distinct mapping rows are sorted by resource identifier, and each term has a posting list of the (sorted) rows of
+    the resources mapped to it. The subclasses of a term are then a slice of a CSR array, and its resources the union
+    of the posting lists of the term and its subclasses.
+
+    An index can be saved to a single file that is memory-mapped when loaded, so that loading takes no time and the
+    pages of the file are shared by all processes that load it.
+    """
+
+    def __init__(self, arrays, metadata):
+        self._arrays = arrays
+        self.metadata = metadata
+        self.terms = _StringArray(arrays, "terms")
+        self._columns = {column: _StringArray(arrays, column) for column in STRING_COLUMNS}
+        self._scores = arrays["MappingScore"]
+        self._score_nulls = arrays["MappingScore_nulls"]
+
+    @classmethod
+    def from_database(cls, connection, dataset_name="opengwas", ontology_name="efo"):
+        """
+        Build the index from the mappings and edges tables of a search database
+        """
+        mappings_df = pd.read_sql_query(f"SELECT DISTINCT {', '.join(MAPPING_COLUMNS)} FROM {dataset_name}_mappings "
+                                        "ORDER BY SourceTermID", connection)
+        edges = {}
+        for edges_type, table in (("edges", ontology_name + "_edges"),
+                                  ("entailed_edges", ontology_name + "_entailed_edges")):
+            edges[edges_type] = pd.read_sql_query(f"SELECT DISTINCT Subject, Object FROM {table}", connection).dropna()
+        terms = pd.Index(np.unique(pd.concat([mappings_df["MappedTermCURIE"].dropna().astype(str)] +
+                                             [edges_df[column].astype(str) for edges_df in edges.values()
+                                              for column in ("Subject", "Object")]).to_numpy(dtype=object)
+                                   .astype(str)))
+        arrays = _encode_strings("terms", terms.tolist())
+        for column in STRING_COLUMNS:
+            arrays.update(_encode_strings(column, mappings_df[column].tolist()))
+        scores = pd.to_numeric(mappings_df["MappingScore"], errors="coerce")
+        arrays["MappingScore"] = scores.fillna(0).to_numpy(dtype=np.float64)
+        arrays["MappingScore_nulls"] = scores.isna().to_numpy()
+        mapped_terms = terms.get_indexer(mappings_df["MappedTermCURIE"].astype(str))
+        mapped = mapped_terms >= 0
+        arrays["postings_indptr"], arrays["postings"] = _get_csr(mapped_terms[mapped],
+                                                                 np.flatnonzero(mapped), len(terms))
+        for edges_type, edges_df in edges.items():
+            subjects = terms.get_indexer(edges_df["Subject"].astype(str))
+            objects = terms.get_indexer(edges_df["Object"].astype(str))
+            arrays[edges_type + "_children_indptr"], arrays[edges_type + "_children"] = \
+                _get_csr(objects, subjects, len(terms))
+            arrays[edges_type + "_parents_indptr"], arrays[edges_type + "_parents"] = \
+                _get_csr(subjects, objects, len(terms))
+        metadata = {"version": __version__, "dataset_name": dataset_name, "ontology_name": ontology_name,
+                    "term_count": len(terms), "mapping_count": len(mappings_df)}
+        return cls(arrays, metadata)
+
+    @classmethod
+    def load(cls, index_file):
+        """
+        Load an index saved by save(), by memory-mapping the index file (read-only)
+        """
+        with open(index_file, "rb") as file_in:
+            buffer = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(INDEX_FILE_MAGIC)] != INDEX_FILE_MAGIC:
+            raise ValueError(f"{index_file} is not a search index file")
+        header_length = int.from_bytes(buffer[len(INDEX_FILE_MAGIC):len(INDEX_FILE_MAGIC) + 8], "little")
+        header_start = len(INDEX_FILE_MAGIC) + 8
+        header = json.loads(buffer[header_start:header_start + header_length].decode("utf-8"))
+        arrays = {name: np.frombuffer(buffer, dtype=np.dtype(dtype), count=int(np.prod(shape)), offset=offset)
+                  for name, (dtype, shape, offset) in header["arrays"].items()}
+        return cls(arrays, header["metadata"])
+
+    def save(self, index_file):
+        """
+        Save the index to a file: a header with the name, type, shape and offset of each array, followed by the
+        (aligned) contents of the arrays. The file is written to a temporary file first, and then renamed
+        """
+        header_arrays, offset = {}, 0
+        for name, array in self._arrays.items():
+            header_arrays[name] = [array.dtype.str, list(array.shape), offset]
+            offset = _align(offset + array.nbytes)
+        header = {"metadata": self.metadata, "arrays": header_arrays}
+        # The offsets depend on the header length, which depends on the offsets, so they are set in a second pass
+        header_length = len(json.dumps(header).encode("utf-8")) + 64
+        data_start = _align(len(INDEX_FILE_MAGIC) + 8 + header_length)
+        for entry in header_arrays.values():
+            entry[2] += data_start
+        header_bytes = json.dumps(header).encode("utf-8").ljust(header_length)
+        temporary_file = f"{index_file}.{os.getpid()}.tmp"
+        with open(temporary_file, "wb") as file_out:
+            file_out.write(INDEX_FILE_MAGIC + header_length.to_bytes(8, "little") + header_bytes)
+            for name, array in self._arrays.items():
+                file_out.write(b"\0" * (header_arrays[name][2] - file_out.tell()))
+                file_out.write(np.ascontiguousarray(array).tobytes())
+        os.replace(temporary_file, index_file)
+
+    def get_term_code(self, term):
+        """
+        Get the integer code of the given term (CURIE), or -1 if the term is not in the index
+        """
+        return self.terms.find(term)
+
+    def get_subclasses(self, term, direct_subclasses_only=False):
+        """
+        Get the CURIEs of the subclasses of the given term: its direct subclasses (in the asserted edges), or all of
+        its inferred subclasses (in the entailed edges)
+        """
+        return self.terms.take(self._get_neighbors(term, direct_subclasses_only, "children"))
+
+    def get_ancestors(self, term, direct_superclasses_only=False):
+        """
+        Get the CURIEs of the superclasses of the given term: its direct superclasses (in the asserted edges), or all
+        of its inferred superclasses (in the entailed edges)
+        """
+        return self.terms.take(self._get_neighbors(term, direct_superclasses_only, "parents"))
+
+    def _get_neighbors(self, term, direct_only, direction):
+        code = term if isinstance(term, (int, np.integer)) else self.get_term_code(term)
+        if code < 0:
+            return np.empty(0, dtype=np.int64)
+        edges_type = "edges" if direct_only else "entailed_edges"
+        indptr = self._arrays[f"{edges_type}_{direction}_indptr"]
+        return self._arrays[f"{edges_type}_{direction}"][indptr[code]:indptr[code + 1]]
+
+    def get_mapping_rows(self, search_term, include_subclasses=True, direct_subclasses_only=False):
+        """
+        Get the (sorted) positions of the mapping rows of the resources annotated with the given search term and,
+        optionally, with its subclasses
+        """
+        code = self.get_term_code(search_term)
+        if code < 0:
+            return np.empty(0, dtype=np.int64)
+        indptr, postings = self._arrays["postings_indptr"], self._arrays["postings"]
+        if not include_subclasses:
+            return postings[indptr[code]:indptr[code + 1]]
+        codes = np.append(self._get_neighbors(code, direct_subclasses_only, "children"), code)
+        starts, ends = indptr[codes], indptr[codes + 1]
+        if (ends - starts).sum() == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([postings[start:end] for start, end in zip(starts, ends) if end > start]))
+
+    def count_resources(self, search_term, include_subclasses=True, direct_subclasses_only=False):
+        """
+        Count the distinct resources annotated with the given search term and, optionally, with its subclasses
+        """
+        rows = self.get_mapping_rows(search_term, include_subclasses, direct_subclasses_only)
+        return len(set(self._columns["SourceTermID"].take(rows)))
+
+    def resources_annotated_with_term(self, search_term, include_subclasses=True, direct_subclasses_only=False):
+        """
+        Retrieve resources annotated with the given search term and (optionally) subclasses of that term, with the
+        same results as query_database.resources_annotated_with_term
+        """
+        return self._get_results_df(self.get_mapping_rows(search_term, include_subclasses, direct_subclasses_only))
+
+    def search_terms(self, search_terms, include_subclasses=True, direct_subclasses_only=False):
+        """
+        Retrieve the resources annotated with each of the given search terms, with the same results as
+        query_database.SearchEngine.search_terms
+        """
+        search_terms = list(dict.fromkeys(search_terms))
+        rows = [self.get_mapping_rows(search_term, include_subclasses, direct_subclasses_only)
+                for search_term in search_terms]
+        query_terms = [search_term for search_term, term_rows in zip(search_terms, rows) for _ in range(len(term_rows))]
+        return self._get_results_df(np.concatenate(rows) if len(rows) > 0 else np.empty(0, dtype=np.int64),
+                                    query_terms)
+
+    # Get the data frame of the given mapping rows (preceded by their query terms, if given). Mapping rows found for
+    #  several query terms are only decoded once
+    def _get_results_df(self, rows, query_terms=None):
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        columns = [self._columns[column].take(unique_rows) for column in STRING_COLUMNS]
+        scores = [None if null else score for score, null in zip(self._scores[unique_rows].tolist(),
+                                                                 self._score_nulls[unique_rows].tolist())]
+        records = list(zip(*columns, scores))
+        if query_terms is None:
+            return pd.DataFrame([records[index] for index in inverse.tolist()], columns=list(RESULT_COLUMNS))
+        return pd.DataFrame([(query_term,) + records[index]
+                             for query_term, index in zip(query_terms, inverse.tolist())],
+                            columns=["QueryTerm"] + list(RESULT_COLUMNS))
+
+
+class _StringArray:
+    """
+    Array of (optional) strings stored as their concatenated UTF-8 bytes, the offsets of each string in them, and a
+    mask of missing values
+    """
+
+    def __init__(self, arrays, name):
+        self._data = arrays[name + "_data"]
+        self._offsets = arrays[name + "_offsets"]
+        self._nulls = arrays[name + "_nulls"]
+        self._bytes = self._data.tobytes() if isinstance(self._data, np.ndarray) and self._data.base is None \
+            else memoryview(self._data)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if self._nulls[index]:
+            return None
+        return str(self._bytes[self._offsets[index]:self._offsets[index + 1]], "utf-8")
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        data = self._bytes
+        return [None if null else str(data[start:end], "utf-8")
+                for start, end, null in zip(self._offsets[indices].tolist(), self._offsets[indices + 1].tolist(),
+                                            self._nulls[indices].tolist())]
+
+    def find(self, value):
+        """
+        Find the position of the given value by binary search, for arrays of sorted strings without missing values
+        """
+        encoded = value.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self._bytes[self._offsets[middle]:self._offsets[middle + 1]]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and bytes(self._bytes[self._offsets[low]:self._offsets[low + 1]]) == encoded:
+            return low
+        return -1
+
+
+def _encode_strings(name, values):
+    nulls = np.array([value is None or (isinstance(value, float) and np.isnan(value)) for value in values],
+                     dtype=bool)
+    encoded = [b"" if null else str(value).encode("utf-8") for value, null in zip(values, nulls)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    return {name + "_data": np.frombuffer(b"".join(encoded), dtype=np.uint8).copy(), name + "_offsets": offsets,
+            name + "_nulls": nulls}
+
+
+# Get the CSR arrays (index pointers and sorted values of each row) of the given pairs of rows and values
+def _get_csr(rows, values, row_count):
+    rows, values = np.asarray(rows, dtype=np.int64), np.asarray(values, dtype=np.int64)
+    valid = (rows >= 0) & (values >= 0)
+    rows, values = rows[valid], values[valid]
+    order = np.lexsort((values, rows))
+    indptr = np.zeros(row_count + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=row_count))
+    return indptr, values[order]
+
+
+def _align(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+# Get the search index of the given database from the given index file, building the index (and saving it to that
+#  file) if the file does not exist or is older than the database
+def get_search_index(database_file, index_file, dataset_name="opengwas", ontology_name="efo"):
+    if not os.path.isfile(index_file) or os.path.getmtime(index_file) < os.path.getmtime(database_file):
+        connection = sqlite3.connect(database_file)
+        try:
+            SearchIndex.from_database(connection, dataset_name, ontology_name).save(index_file)
+        finally:
+            connection.close()
+    return SearchIndex.load(index_file)
+
+
+# Time building, saving and loading the search index of the given database, and the search of the given terms through
+#  the index versus through SQL queries, checking that both give the same results
+def benchmark_search_index(database_file, index_file, search_terms=("EFO:0009605", "EFO:0005741", "EFO:0004324"),
+                           repetitions=100):
+    from query_database import SearchEngine
+    connection = sqlite3.connect(database_file)
+    start = time.time()
+    index = SearchIndex.from_database(connection)
+    print(f"Built index of {index.metadata['term_count']} terms and {index.metadata['mapping_count']} mappings "
+          f"({time.time() - start:.2f} seconds)")
+    connection.close()
+    start = time.time()
+    index.save(index_file)
+    print(f"Saved index to {index_file} ({os.path.getsize(index_file) / 1e6:.1f} MB, "
+          f"{time.time() - start:.2f} seconds)")
+    start = time.time()
+    index = SearchIndex.load(index_file)
+    print(f"Loaded index ({(time.time() - start) * 1000:.2f} ms)")
+    with SearchEngine(database_file) as engine:
+        for include_subclasses, direct_subclasses_only in ((False, False), (True, True), (True, False)):
+            for search_term in search_terms:
+                start = time.time()
+                for _ in range(repetitions):
+                    sql_results = engine.resources_annotated_with_term(search_term, include_subclasses,
+                                                                       direct_subclasses_only)
+                sql_time = (time.time() - start) / repetitions
+                start = time.time()
+                for _ in range(repetitions):
+                    index_results = index.resources_annotated_with_term(search_term, include_subclasses,
+                                                                        direct_subclasses_only)
+                index_time = (time.time() - start) / repetitions
+                start = time.time()
+                for _ in range(repetitions):
+                    index.get_mapping_rows(search_term, include_subclasses, direct_subclasses_only)
+                lookup_time = (time.time() - start) / repetitions
+                print(f"\t{search_term} (include_subclasses={include_subclasses}, direct_subclasses_only="
+                      f"{direct_subclasses_only}): {len(index_results)} results, SQL {sql_time * 1000:.2f} ms, "
+                      f"index {index_time * 1000:.2f} ms (lookup {lookup_time * 1000:.3f} ms)"
+                      f"{'' if sql_results.equals(index_results) else ' MISMATCH'}")
+
+
+if __name__ == "__main__":
+    benchmark_search_index(database_file=sys.argv[1] if len(sys.argv) > 1 else "../opengwas_search.db",
+                           index_file=sys.argv[2] if len(sys.argv) > 2 else "../opengwas_search.idx")
@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import time
+import base64
+import queue
+import random
+import asyncio
+import argparse
+import numpy as np
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from query_database import SearchEngine
+
+__version__ = "0.1.0"
+
+DEFAULT_PORT = 8765
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_TERMS = 100
+MAX_REQUEST_LINE = 65536
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                500: "Internal Server Error"}
+
+
+class SearchEnginePool:
+    """
+    Pool of search engines (see query_database.SearchEngine) over the same database, each with its own read-only
+    connection, so that searches can run concurrently in as many threads as there are engines. Engines are taken
+    from the pool for the duration of a single search
+    """
+
+    def __init__(self, database_file, size=4, **engine_arguments):
+        self.size = size
+        self._engines = queue.Queue()
+        for _ in range(size):
+            self._engines.put(SearchEngine(database_file, **engine_arguments))
+
+    def run(self, method_name, *args, **kwargs):
+        """
+        Call the given search method of an engine of the pool (waiting for one to be free) with the given arguments
+        """
+        engine = self._engines.get()
+        try:
+            return getattr(engine, method_name)(*args, **kwargs)
+        finally:
+            self._engines.put(engine)
+
+    def close(self):
+        for _ in range(self.size):
+            self._engines.get().close()
+
+
+class SearchServer:
+    """
+    Local HTTP server of searches of a database built by build_database. Requests are handled by an asyncio event
+    loop, and the searches run on a thread pool, in engines taken from a SearchEnginePool of the same size. The JSON
+    response of a search is encoded in the thread pool too, right after the search, so that large responses do not
+    hold up the event loop. Identical requests that arrive while one of them is running are coalesced: they all wait
+    for, and get, the response of the request already running. Page sizes ('limit') must be between 1 and
+    MAX_PAGE_SIZE, and batches can have up to MAX_BATCH_TERMS terms. All endpoints take GET requests and return JSON:
+        /search?term=EFO:0009605[&include_subclasses=true&direct_subclasses_only=false&limit=100&cursor=...]
+            a page of the resources annotated with the term, and the cursor of the next page (null on the last page)
+        /batch?terms=EFO:0009605,EFO:0005741[&include_subclasses=...&direct_subclasses_only=...&limit=100&cursor=...]
+            a page of the resources annotated with each of the terms, tagged by term and ordered by term (in the given
+            order), OpenGWAS ID and ontology term ID, and the cursor of the next page (null on the last page)
+        /count?term=EFO:0009605[&include_subclasses=...&direct_subclasses_only=...]
+            the number of resources annotated with the term
+        /terms?text=pancreatitis[&limit=10]
+            the ontology terms that best match the free text
+        /stats
+            numbers of requests, searches run and searches coalesced
+    """
+
+    def __init__(self, database_file, host="127.0.0.1", port=DEFAULT_PORT, workers=4, **engine_arguments):
+        self.host = host
+        self.port = port
+        self.pool = SearchEnginePool(database_file, size=workers, **engine_arguments)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search")
+        self._in_flight = {}  # request key -> future of its (JSON-encoded) response body
+        self._stats = {"requests": 0, "searches": 0, "coalesced": 0, "errors": 0}
+        self._server = None
+        self._endpoints = {"/search": self._search, "/batch": self._batch, "/count": self._count,
+                           "/terms": self._terms, "/stats": self._get_stats}
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=MAX_REQUEST_LINE)
+        self.port = self._server.sockets[0].getsockname()[1]  # the port assigned by the system, if port=0
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        print(f"Serving searches of {self.pool.size} connections on http://{self.host}:{self.port}/")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = await _read_headers(reader)
+                try:
+                    method, target, version = request_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+                except ValueError:
+                    self._stats["requests"] += 1
+                    writer.write(_get_response(400, _encode_json({"error": "Malformed request line"}), False))
+                    await writer.drain()
+                    break
+                status, content = await self._handle_request(method, target)
+                keep_alive = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close")
+                writer.write(_get_response(status, content, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    # Handle a request for the given target, returning the status and (JSON-encoded) content of the response
+    async def _handle_request(self, method, target):
+        self._stats["requests"] += 1
+        if method != "GET":
+            return 405, _encode_json({"error": f"Method {method} not allowed"})
+        url = urlsplit(target)
+        endpoint = self._endpoints.get(url.path.rstrip("/") or url.path)
+        if endpoint is None:
+            return 404, _encode_json({"error": f"Unknown endpoint {url.path}"})
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            return 200, await endpoint(params)
+        except KeyError as error:
+            return 400, _encode_json({"error": f"Missing parameter: {error}"})
+        except ValueError as error:
+            return 400, _encode_json({"error": f"Invalid request: {error}"})
+        except Exception as error:
+            self._stats["errors"] += 1
+            return 500, _encode_json({"error": f"{type(error).__name__}: {error}"})
+
+    async def _search(self, params):
+        return await self._run(_get_page_body, (), "get_results_page", params["term"], *_get_search_options(params),
+                               limit=_get_limit(params, DEFAULT_PAGE_SIZE), cursor=params.get("cursor"))
+
+    async def _batch(self, params):
+        search_terms = tuple(dict.fromkeys(term for term in params["terms"].split(",") if term != ""))
+        if len(search_terms) > MAX_BATCH_TERMS:
+            raise ValueError(f"at most {MAX_BATCH_TERMS} terms can be searched at once, not {len(search_terms)}")
+        page = (search_terms, _get_limit(params, DEFAULT_PAGE_SIZE), _decode_batch_cursor(params.get("cursor")))
+        return await self._run(_get_batch_page_body, page, "search_terms", search_terms, *_get_search_options(params))
+
+    async def _count(self, params):
+        return await self._run(_get_count_body, (), "count_resources", params["term"], *_get_search_options(params))
+
+    async def _terms(self, params):
+        return await self._run(_get_records_body, (), "find_terms", params["text"], limit=_get_limit(params, 10))
+
+    async def _get_stats(self, params):
+        return _encode_json(dict(self._stats, in_flight=len(self._in_flight), workers=self.pool.size))
+
+    # Run the given search method in the thread pool, and get the JSON-encoded response body that the given function
+    #  (called with the results and the given body arguments) makes of its results, also in the thread pool. If an
+    #  identical request is already running, wait for the response of that request instead
+    async def _run(self, get_body, body_args, method_name, *args, **kwargs):
+        key = (method_name, args, tuple(sorted(kwargs.items())), get_body.__name__, body_args)
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._stats["coalesced"] += 1
+            return await asyncio.shield(future)
+        self._stats["searches"] += 1
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, lambda: _encode_json(get_body(self.pool.run(method_name, *args, **kwargs), *body_args)))
+        self._in_flight[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+
+def _get_page_body(results):
+    results_df, next_cursor = results
+    return {"results": results_df.to_dict(orient="records"), "next_cursor": next_cursor}
+
+
+def _get_records_body(results_df):
+    return {"results": results_df.to_dict(orient="records")}
+
+
+def _get_count_body(count):
+    return {"count": count}
+
+
+# Get the page of at most limit rows of the results of a batch search that come after the row with the given key
+#  (the position of its search term in the batch, its OpenGWAS ID and its ontology term ID), in the order of the keys
+def _get_batch_page_body(results_df, search_terms, limit, after_key):
+    positions = {search_term: position for position, search_term in enumerate(search_terms)}
+    key_columns = ["Position", "OpenGWASID", "OntologyTermID"]
+    results_df = results_df.assign(Position=results_df["QueryTerm"].map(positions)) \
+        .sort_values(key_columns, kind="stable").reset_index(drop=True)
+    start = 0
+    if after_key is not None:
+        position, resource_id, term_id = (results_df[column].to_numpy() for column in key_columns)
+        after = (position > after_key[0]) | ((position == after_key[0]) & (
+            (resource_id > after_key[1]) | ((resource_id == after_key[1]) & (term_id > after_key[2]))))
+        start = int(after.argmax()) if after.any() else len(results_df)
+    next_cursor = None
+    if start + limit < len(results_df):
+        next_cursor = _encode_batch_cursor(results_df.loc[start + limit - 1, key_columns])
+    page_df = results_df.iloc[start:start + limit].drop(columns="Position")
+    return {"results": page_df.to_dict(orient="records"), "next_cursor": next_cursor}
+
+
+# Cursors of batch result pages are opaque (URL-safe) strings that encode the key of the last row of the previous page
+def _encode_batch_cursor(key):
+    position, resource_id, term_id = key
+    return base64.urlsafe_b64encode(json.dumps([int(position), resource_id, term_id]).encode("utf-8")).decode("ascii")
+
+
+def _decode_batch_cursor(cursor):
+    if cursor is None:
+        return None
+    try:
+        position, resource_id, term_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return int(position), str(resource_id), str(term_id)
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid batch cursor: '{cursor}'")
+
+
+def _get_search_options(params):
+    return _get_bool(params, "include_subclasses", True), _get_bool(params, "direct_subclasses_only", False)
+
+
+# Get the 'limit' parameter (the number of results of a page), which must be an integer from 1 to MAX_PAGE_SIZE
+def _get_limit(params, default):
+    value = params.get("limit")
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError(f"'limit' must be an integer, not '{value}'")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"'limit' must be between 1 and {MAX_PAGE_SIZE}, not {limit}")
+    return limit
+
+
+def _get_bool(params, name, default):
+    value = params.get(name)
+    if value is None:
+        return default
+    if value.lower() in ("true", "1", "yes"):
+        return True
+    if value.lower() in ("false", "0", "no"):
+        return False
+    raise ValueError(f"'{name}' must be true or false, not '{value}'")
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+def _encode_json(body):
+    return json.dumps(body, default=_to_json).encode("utf-8")
+
+
+def _get_response(status, content, keep_alive):
+    return (f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(content)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1") + content
+
+
+# Convert the numpy values in search results (e.g. counts) to values that can be encoded as JSON
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Send GET requests for the given targets over a single (keep-alive) connection, and record the latency of each
+async def _run_client(host, port, targets, latencies):
+    reader, writer = await asyncio.open_connection(host, port, limit=MAX_REQUEST_LINE)
+    try:
+        for target in targets:
+            start = time.perf_counter()
+            writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1"))
+            await writer.drain()
+            status_line = await reader.readline()
+            headers = await _read_headers(reader)
+            await reader.readexactly(int(headers["content-length"]))
+            latencies.append(time.perf_counter() - start)
+            if b" 200 " not in status_line:
+                raise RuntimeError(f"Request {target} failed: {status_line.decode('latin-1').strip()}")
+    finally:
+        writer.close()
+
+
+# Get the targets of a mix of search requests (term searches, batch searches and counts) of the given terms, drawn
+#  at random such that popular terms are requested more often, as in a real workload
+def _get_benchmark_targets(search_terms, request_count, seed=0):
+    generator = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(search_terms))]
+    targets = []
+    for _ in range(request_count):
+        kind = generator.random()
+        term = generator.choices(search_terms, weights)[0]
+        if kind < 0.6:
+            targets.append(f"/search?term={term}&include_subclasses={generator.choice(['true', 'false'])}")
+        elif kind < 0.8:
+            targets.append(f"/count?term={term}")
+        else:
+            targets.append(f"/batch?terms={','.join(generator.sample(search_terms, 5))}")
+    return targets
+
+
+# Start a search server on the given database and measure its throughput and median and 99th percentile latencies
+#  with the given numbers of concurrent clients, each sending its requests one after another
+async def _benchmark_search_server(database_file, concurrency_levels, requests_per_level, workers, term_count):
+    with SearchEngine(database_file) as engine:
+        search_terms = [row[0] for row in engine.connection.execute(
+            f"SELECT Subject FROM {engine.ontology_name}_labels WHERE Direct + Inherited > 0 "
+            f"ORDER BY Direct + Inherited DESC, Subject LIMIT ?", (term_count,))]
+    server = await SearchServer(database_file, port=0, workers=workers).start()
+    print(f"Benchmarking search server with {workers} workers, {requests_per_level} requests per concurrency level:")
+    try:
+        for concurrency in concurrency_levels:
+            targets = _get_benchmark_targets(search_terms, requests_per_level, seed=concurrency)
+            latencies = []
+            stats_before = dict(server._stats)
+            start = time.perf_counter()
+            await asyncio.gather(*(_run_client(server.host, server.port, targets[client::concurrency], latencies)
+                                   for client in range(concurrency)))
+            elapsed = time.perf_counter() - start
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            coalesced = server._stats["coalesced"] - stats_before["coalesced"]
+            print(f"\tconcurrency {concurrency}: {len(latencies) / elapsed:.0f} requests/second, p50 {p50:.1f} ms, "
+                  f"p99 {p99:.1f} ms, {coalesced} requests coalesced")
+    finally:
+        await server.close()
+
+
+def benchmark_search_server(database_file, concurrency_levels=(1, 2, 4, 8, 16, 32, 64), requests_per_level=1000,
+                            workers=4, term_count=200):
+    asyncio.run(_benchmark_search_server(database_file, concurrency_levels, requests_per_level, workers, term_count))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Serve searches of a search database over HTTP")
+    parser.add_argument("database_file", nargs="?", default="../opengwas_search.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4,
+                        help="number of search threads (and read-only connections)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="run the load generator against a local server instead of serving requests")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    if arguments.benchmark:
+        benchmark_search_server(arguments.database_file, workers=arguments.workers)
+        sys.exit(0)
+    try:
+        asyncio.run(SearchServer(arguments.database_file, host=arguments.host, port=arguments.port,
+                                 workers=arguments.workers).serve_forever())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,205 @@
+import sys
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+
+__version__ = "0.1.0"
+
+SUBJECT_COL = "Subject"
+OBJECT_COL = "Object"
+
+
+class SubclassClosure:
+    """
+    Computes the reflexive transitive closure of the subClassOf edges of an ontology (each class with each of its
+    ancestors, and with itself), as the 'entailed_edge' table of a SemanticSQL database has it for rdfs:subClassOf,
+    but from the asserted edges alone, so that ontologies without a SemanticSQL build can be used.
+
+    Classes are integer-coded, and the classes in subClassOf cycles (e.g. equivalent classes) are merged into
+    strongly connected components, whose members have the same ancestors. The ancestors of each component are then
+    computed in topological order, parents first, as the union of the ancestors of its parents. Ancestors are kept as
+    arrays of class codes (rather than bitsets of all classes, whose size would grow with the square of the number of
+    classes), so memory grows with the size of the closure.
+
+    After edges are added or removed (see update), only the ancestors of the descendants of the classes whose parents
+    changed are computed again.
+    """
+
+    def __init__(self, edges_df, terms=(), subject_col=SUBJECT_COL, object_col=OBJECT_COL):
+        self.subject_col = subject_col
+        self.object_col = object_col
+        edges_df = edges_df[[subject_col, object_col]].dropna()
+        self._nodes = pd.Index(pd.unique(pd.concat([pd.Series(terms, dtype=object), edges_df[subject_col],
+                                                    edges_df[object_col]], ignore_index=True).dropna()))
+        self._parents = [set() for _ in range(len(self._nodes))]
+        self._children = [set() for _ in range(len(self._nodes))]
+        for child, parent in zip(self._nodes.get_indexer(edges_df[subject_col]),
+                                 self._nodes.get_indexer(edges_df[object_col])):
+            if child != parent:
+                self._parents[child].add(parent)
+                self._children[parent].add(child)
+        self._ancestors = [None] * len(self._nodes)
+        self._compute_ancestors(np.arange(len(self._nodes)))
+
+    def get_ancestors(self, term):
+        """
+        Get the ancestors of the given class (including the class itself), or an empty list if it is not in the edges
+        """
+        code = self._nodes.get_indexer([term])[0]
+        return [] if code < 0 else self._nodes[np.sort(self._ancestors[code])].tolist()
+
+    def get_entailed_edges(self):
+        """
+        Get the closure as a table of the entailed edges, with one row per (class, ancestor) pair, and columns named as
+        those of the edges table
+        """
+        lengths = np.fromiter((len(ancestors) for ancestors in self._ancestors), dtype=np.int64,
+                              count=len(self._ancestors))
+        subjects = np.repeat(np.arange(len(self._nodes)), lengths)
+        objects = np.concatenate(self._ancestors) if len(self._ancestors) > 0 else np.empty(0, dtype=np.int64)
+        return pd.DataFrame({self.subject_col: self._nodes.take(subjects),
+                             self.object_col: self._nodes.take(objects)})
+
+    def update(self, added_edges_df=None, removed_edges_df=None):
+        """
+        Add and remove the given edges (tables with the columns of the edges table), and update the closure. Only the
+        classes below the subjects of the changed edges have their ancestors computed again
+        :return: number of classes whose ancestors were computed again
+        """
+        empty_edges = pd.DataFrame(columns=[self.subject_col, self.object_col])
+        added_edges_df = (empty_edges if added_edges_df is None else added_edges_df).dropna()
+        removed_edges_df = (empty_edges if removed_edges_df is None else removed_edges_df).dropna()
+        new_terms = pd.unique(pd.concat([added_edges_df[self.subject_col], added_edges_df[self.object_col]],
+                                        ignore_index=True))
+        new_terms = [term for term in new_terms if term not in self._nodes]
+        if len(new_terms) > 0:
+            self._nodes = self._nodes.append(pd.Index(new_terms, dtype=object))
+            self._parents.extend(set() for _ in new_terms)
+            self._children.extend(set() for _ in new_terms)
+            self._ancestors.extend(np.array([code], dtype=np.int64)
+                                   for code in range(len(self._nodes) - len(new_terms), len(self._nodes)))
+        changed_children = set()
+        for edges_df, add in ((removed_edges_df, False), (added_edges_df, True)):
+            for child, parent in zip(self._nodes.get_indexer(edges_df[self.subject_col]),
+                                     self._nodes.get_indexer(edges_df[self.object_col])):
+                if child < 0 or parent < 0 or child == parent:
+                    continue
+                if add:
+                    self._parents[child].add(parent)
+                    self._children[parent].add(child)
+                else:
+                    self._parents[child].discard(parent)
+                    self._children[parent].discard(child)
+                changed_children.add(child)
+        # Only the classes below the changed classes can have different ancestors. A class that was below a changed
+        #  class only through a removed edge is still below the subject of that edge, which is a changed class too
+        affected = set(changed_children)
+        pending = list(changed_children)
+        while pending:
+            for child in self._children[pending.pop()]:
+                if child not in affected:
+                    affected.add(child)
+                    pending.append(child)
+        self._compute_ancestors(np.fromiter(affected, dtype=np.int64, count=len(affected)))
+        return len(affected)
+
+    # Compute the ancestors of the given classes, taking those of their parents outside of them as they are. The
+    #  subgraph of the given classes is condensed into its strongly connected components, which are then visited
+    #  parents first
+    def _compute_ancestors(self, codes):
+        if len(codes) == 0:
+            return
+        positions = np.full(len(self._nodes), -1, dtype=np.int64)
+        positions[codes] = np.arange(len(codes))
+        inner_children, inner_parents, outer_parents = [], [], [[] for _ in codes]
+        for position, code in enumerate(codes):
+            for parent in self._parents[code]:
+                if positions[parent] >= 0:
+                    inner_children.append(position)
+                    inner_parents.append(positions[parent])
+                else:
+                    outer_parents[position].append(parent)
+        graph = scipy.sparse.csr_matrix((np.ones(len(inner_children), dtype=np.int8),
+                                         (inner_children, inner_parents)), shape=(len(codes), len(codes)))
+        component_count, components = connected_components(graph, directed=True, connection="strong")
+        members = [[] for _ in range(component_count)]
+        for position, component in enumerate(components):
+            members[component].append(position)
+
+        # Order the components topologically, parents first
+        component_parents = [set() for _ in range(component_count)]
+        for child, parent in zip(components[inner_children], components[inner_parents]):
+            if child != parent:
+                component_parents[child].add(parent)
+        pending_parents = [len(parents) for parents in component_parents]
+        component_children = [[] for _ in range(component_count)]
+        for component, parents in enumerate(component_parents):
+            for parent in parents:
+                component_children[parent].append(component)
+        queue = [component for component, count in enumerate(pending_parents) if count == 0]
+        component_ancestors = [None] * component_count
+        while queue:
+            component = queue.pop()
+            component_codes = codes[members[component]]
+            parent_ancestors = [component_ancestors[parent] for parent in component_parents[component]]
+            parent_ancestors += [self._ancestors[parent] for position in members[component]
+                                 for parent in outer_parents[position]]
+            if len(component_codes) == 1 and len(parent_ancestors) == 1:  # (the ancestors of a class with one parent)
+                ancestors = np.append(parent_ancestors[0], component_codes)
+            else:
+                ancestors = np.unique(np.concatenate([component_codes] + parent_ancestors))
+            component_ancestors[component] = ancestors
+            for position in members[component]:
+                self._ancestors[codes[position]] = ancestors
+            for child in component_children[component]:
+                pending_parents[child] -= 1
+                if pending_parents[child] == 0:
+                    queue.append(child)
+
+
+# Compare the closure of the asserted subClassOf edges ('edge' table) of the given SemanticSQL database, computed by
+#  SubclassClosure, with its 'entailed_edge' table, and time the computation of the closure and of an update of a few
+#  edges. Edges to blank nodes are left out of both, as they are when the tables are generated
+def compare_with_semsql(semsql_db_file, updated_edge_count=10, seed=0):
+    connection = sqlite3.connect(semsql_db_file)
+    try:
+        edges_df = pd.read_sql_query("SELECT DISTINCT subject AS Subject, object AS Object FROM edge "
+                                     "WHERE predicate = 'rdfs:subClassOf' AND object NOT LIKE '\\_:%' ESCAPE '\\'",
+                                     connection)
+        semsql_df = pd.read_sql_query("SELECT DISTINCT subject AS Subject, object AS Object FROM entailed_edge "
+                                      "WHERE predicate = 'rdfs:subClassOf' AND object NOT LIKE '\\_:%' ESCAPE '\\'",
+                                      connection)
+    finally:
+        connection.close()
+    start = time.time()
+    closure = SubclassClosure(edges_df, terms=semsql_df[SUBJECT_COL])
+    closure_df = closure.get_entailed_edges()
+    closure_time = time.time() - start
+    comparison = closure_df.merge(semsql_df.drop_duplicates(), how="outer", indicator=True)
+    only_native = comparison[comparison["_merge"] == "left_only"]
+    only_semsql = comparison[comparison["_merge"] == "right_only"]
+    print(f"Closure of {len(edges_df)} subClassOf edges of {len(closure._nodes)} classes in {semsql_db_file}:")
+    print(f"\t{len(closure_df)} entailed edges in {closure_time:.1f} seconds ({len(semsql_df)} in entailed_edge)")
+    print(f"\t{len(only_native)} entailed edges only in the closure, {len(only_semsql)} only in entailed_edge")
+    for name, differences in (("only in the closure", only_native), ("only in entailed_edge", only_semsql)):
+        if len(differences) > 0:
+            print(f"\te.g. {name}:\n{differences.head(5)[[SUBJECT_COL, OBJECT_COL]].to_string(index=False)}")
+
+    # Remove a few edges and add them back, checking that the closure is the same as before
+    changed_edges_df = edges_df.sample(min(updated_edge_count, len(edges_df)), random_state=seed)
+    start = time.time()
+    removed_count = closure.update(removed_edges_df=changed_edges_df)
+    added_count = closure.update(added_edges_df=changed_edges_df)
+    update_time = time.time() - start
+    same_closure = closure.get_entailed_edges().sort_values([SUBJECT_COL, OBJECT_COL], ignore_index=True).equals(
+        closure_df.sort_values([SUBJECT_COL, OBJECT_COL], ignore_index=True))
+    print(f"\tremoving and adding back {len(changed_edges_df)} edges: {update_time:.2f} seconds "
+          f"({removed_count} and {added_count} classes updated), closure {'unchanged' if same_closure else 'CHANGED'}")
+    return len(only_native) + len(only_semsql)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if compare_with_semsql(sys.argv[1] if len(sys.argv) > 1 else "../resources/efo.db") == 0 else 1)
@@ -0,0 +1,148 @@
+import re
+import sys
+import time
+import numpy as np
+
+__version__ = "0.1.0"
+
+# Tokenizer of the full-text tables: words are case- and accent-insensitive and reduced to their stems (so that, e.g.,
+#  'diseases' matches 'disease'), and prefixes of 2 and 3 characters are indexed to speed up prefix queries
+FTS_TOKENIZER = "porter unicode61 remove_diacritics 2"
+FTS_PREFIXES = "2 3"
+
+# Weights of the columns of the metadata full-text table (Trait, Title) in the ranking of the records found
+METADATA_FTS_WEIGHTS = (2.0, 1.0)
+
+
+def get_terms_fts_table(ontology_name):
+    return ontology_name + "_terms_fts"
+
+
+def get_metadata_fts_table(dataset_name):
+    return dataset_name + "_metadata_fts"
+
+
+# Build the full-text tables of the given database (after the ontology, metadata and references tables are added):
+# 1) '<ontology>_terms_fts', with the labels and exact synonyms of the ontology terms. Each row also holds the label of
+#     its term and the number of records mapped to the term (or its subclasses), so that matches need no joins
+# 2) '<dataset>_metadata_fts', with the trait of each metadata record and the title of its PubMed reference (if any)
+# Tables that the full-text tables are built from but are missing from the database are skipped
+def build_text_search_tables(connection, dataset_name, ontology_name, resource_col="trait", resource_id_col="id",
+                             pmid_col=""):
+    start = time.time()
+    existing_tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    terms_fts_table = get_terms_fts_table(ontology_name)
+    metadata_fts_table = get_metadata_fts_table(dataset_name)
+    with connection:
+        connection.execute(f"DROP TABLE IF EXISTS {terms_fts_table}")
+        connection.execute(f"CREATE VIRTUAL TABLE {terms_fts_table} USING fts5(Text, Subject UNINDEXED, "
+                           f"Label UNINDEXED, Source UNINDEXED, Records UNINDEXED, tokenize='{FTS_TOKENIZER}', "
+                           f"prefix='{FTS_PREFIXES}')")
+        labels_table, synonyms_table = ontology_name + "_labels", ontology_name + "_synonyms"
+        insert = f"INSERT INTO {terms_fts_table} (Text, Subject, Label, Source, Records)"
+        records = "COALESCE(l.Direct, 0) + COALESCE(l.Inherited, 0)"
+        if labels_table in existing_tables:
+            connection.execute(f"{insert} SELECT l.Object, l.Subject, l.Object, 'label', {records} "
+                               f"FROM {labels_table} l WHERE l.Object IS NOT NULL")
+            if synonyms_table in existing_tables:
+                connection.execute(f"{insert} SELECT s.Object, s.Subject, l.Object, 'synonym', {records} "
+                                   f"FROM {synonyms_table} s LEFT JOIN {labels_table} l ON l.Subject = s.Subject "
+                                   f"WHERE s.Object IS NOT NULL")
+        connection.execute(f"INSERT INTO {terms_fts_table} ({terms_fts_table}) VALUES ('optimize')")
+
+        connection.execute(f"DROP TABLE IF EXISTS {metadata_fts_table}")
+        connection.execute(f"CREATE VIRTUAL TABLE {metadata_fts_table} USING fts5(ResourceID UNINDEXED, Trait, "
+                           f"Title, tokenize='{FTS_TOKENIZER}', prefix='{FTS_PREFIXES}')")
+        references_table = dataset_name + "_references"
+        if pmid_col != "" and references_table in existing_tables:
+            title = "r.Title"
+            references_join = (f"LEFT JOIN (SELECT CAST({pmid_col} AS TEXT) AS pmid, MIN(Title) AS Title "
+                               f"FROM {references_table} GROUP BY 1) r ON r.pmid = CAST(m.{pmid_col} AS TEXT)")
+        else:
+            title, references_join = "NULL", ""
+        connection.execute(f"INSERT INTO {metadata_fts_table} (ResourceID, Trait, Title) "
+                           f"SELECT m.{resource_id_col}, m.{resource_col}, {title} "
+                           f"FROM {dataset_name}_metadata m {references_join}")
+        connection.execute(f"INSERT INTO {metadata_fts_table} ({metadata_fts_table}) VALUES ('optimize')")
+    print(f"Built full-text search tables ({time.time() - start:.1f} seconds)")
+
+
+def get_match_expression(text):
+    """
+    Get the FTS5 query that matches the words of the given free text (all of them, in any order), such that the last
+    word also matches as a prefix (so 'pancrea' finds 'pancreas'). Punctuation and FTS5 operators in the text are
+    ignored. Returns an empty string if the text has no words
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) == 0:
+        return ""
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+# Get the query that finds the ontology terms whose labels or synonyms match the :match parameter (an FTS5 query),
+#  ranked first by whether a label or synonym is the whole of the :text parameter (ignoring case), then by BM25 rank,
+#  and then by number of records mapped to the terms. Each term is listed once, with its best-matching text
+def get_terms_query(ontology_name):
+    return f"""WITH matches AS (
+                    SELECT f.Subject, f.Label, f.Text, f.Source, f.Records,
+                        bm25({get_terms_fts_table(ontology_name)}) AS Rank, lower(f.Text) = lower(:text) AS ExactMatch
+                    FROM {get_terms_fts_table(ontology_name)} f
+                    WHERE f.Text MATCH :match),
+                best_matches AS (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY Subject ORDER BY ExactMatch DESC, Rank) AS MatchNumber
+                    FROM matches)
+                SELECT
+                    b.Subject AS 'OntologyTermID',
+                    b.Label AS 'OntologyTerm',
+                    b.Text AS 'MatchedText',
+                    b.Source AS 'MatchedField',
+                    -b.Rank AS 'Score',
+                    b.Records AS 'Records'
+                FROM best_matches b
+                WHERE b.MatchNumber = 1
+                ORDER BY b.ExactMatch DESC, b.Rank, b.Records DESC, b.Subject
+                LIMIT :limit"""
+
+
+# Get the query that finds the metadata records whose trait or reference title match the :match parameter, ranked by
+#  BM25 (with matches in traits weighing more than matches in titles)
+def get_metadata_query(dataset_name):
+    fts_table = get_metadata_fts_table(dataset_name)
+    weights = ", ".join(str(weight) for weight in METADATA_FTS_WEIGHTS)
+    return f"""SELECT
+                    f.ResourceID AS 'OpenGWASID',
+                    f.Trait AS 'OpenGWASTrait',
+                    f.Title AS 'Title',
+                    -bm25({fts_table}, 0.0, {weights}) AS 'Score'
+                FROM {fts_table} f
+                WHERE {fts_table} MATCH :match
+                ORDER BY bm25({fts_table}, 0.0, {weights}), f.ResourceID
+                LIMIT :limit"""
+
+
+# Time free-text searches of the given texts (resolving each to terms, to records via terms, and to records by their
+#  traits and titles) and report the median and 95th percentile latencies of each kind of search
+def benchmark_text_search(database_file, texts=("pancreatitis", "BMI", "body mass index", "type 2 diabetes",
+                                                 "infectious disease", "asthma", "schizophrenia", "pancrea",
+                                                 "LDL cholesterol", "coronary artery disease"),
+                          repetitions=20):
+    from query_database import SearchEngine
+    with SearchEngine(database_file) as engine:
+        searches = {"terms": engine.find_terms, "records via terms": engine.search_text,
+                    "records by trait/title": engine.search_metadata_text}
+        print(f"Free-text searches of {len(texts)} texts in {database_file}:")
+        for search_name, search in searches.items():
+            latencies = []
+            for _ in range(repetitions):
+                for text in texts:
+                    start = time.perf_counter()
+                    search(text)
+                    latencies.append(time.perf_counter() - start)
+            p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+            print(f"\t{search_name}: p50 {p50:.2f} ms, p95 {p95:.2f} ms")
+        for text in texts[:3]:
+            print(f"\n'{text}':\n{engine.find_terms(text, limit=3).to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    benchmark_text_search(sys.argv[1] if len(sys.argv) > 1 else "../opengwas_search.db")
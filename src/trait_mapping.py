@@ -0,0 +1,343 @@
+import os
+import sys
+import time
+import json
+import sqlite3
+import hashlib
+import datetime
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import sparse_dot_topn as ct
+from collections import Counter
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+from text2term import onto_utils, Mapper
+from text2term.config import VERSION as TEXT2TERM_VERSION
+from text2term.term_mapping import TermMapping
+from text2term.term_collector import OntologyTermCollector
+from text2term.tfidf_mapper import TFIDFMapper
+
+__version__ = "0.2.0"
+
+# TF-IDF settings of text2term's TFIDFMapper: character 3-grams within word boundaries, and up to 50 candidate
+#  labels/synonyms per source term
+ANALYZER = "char_wb"
+NGRAM_RANGE = (3, 3)
+CANDIDATES_PER_TERM = 50
+
+# Number of traits looked up in the mapping cache per query
+CACHE_QUERY_SIZE = 500
+
+# Number of shards of source terms per worker process when mapping in parallel. Using more shards than workers
+#  balances the load between workers whose shards take longer than others
+SHARDS_PER_WORKER = 4
+
+TAGS_COL = "Tags"
+NO_TAGS = "None"  # tags that text2term gives to source terms that are not tagged
+
+
+class TraitMappingCache:
+    """
+    Persistent cache of the mappings of (normalized) trait text to ontology terms, stored in a SQLite database. Each
+    cached trait has the ranked mappings found for it, or a single row without an IRI if it could not be mapped, and
+    is keyed by the trait and a 'context' that identifies the target ontology version and mapping parameters (see
+    TraitMapper.get_context). Mappings of a trait are thus reused by any later build that maps the same trait
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._connection = sqlite3.connect(cache_file)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS trait_mappings (context TEXT, trait TEXT, rank INTEGER, "
+                                 "label TEXT, iri TEXT, score REAL, PRIMARY KEY (context, trait, rank))")
+
+    def get(self, context, traits):
+        """
+        Get the cached mappings of the given traits in the given context
+        :return: dictionary of each cached trait to a list of (label, IRI, score) tuples in order of rank
+        """
+        traits = list(dict.fromkeys(traits))
+        cached = {}
+        for start in range(0, len(traits), CACHE_QUERY_SIZE):
+            batch = traits[start:start + CACHE_QUERY_SIZE]
+            query = f"SELECT trait, label, iri, score FROM trait_mappings WHERE context=? AND trait IN " \
+                    f"({','.join('?' * len(batch))}) ORDER BY trait, rank"
+            for trait, label, iri, score in self._connection.execute(query, [context] + batch):
+                trait_mappings = cached.setdefault(trait, [])
+                if iri is not None:
+                    trait_mappings.append((label, iri, score))
+        return cached
+
+    def put(self, context, trait_mappings):
+        rows = []
+        for trait, mappings in trait_mappings.items():
+            if len(mappings) == 0:
+                rows.append((context, trait, 0, None, None, None))
+            for rank, (label, iri, score) in enumerate(mappings):
+                rows.append((context, trait, rank, label, iri, score))
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO trait_mappings VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        self._connection.close()
+
+
+class TraitMapper:
+    """
+    Maps source terms (e.g., trait descriptions) to ontology terms with text2term's TF-IDF mapper, such that each
+    distinct normalized term is mapped only once (or not at all, if its mappings are cached) and the mappings are then
+    fanned back out to all source terms. The result is a data frame in the format that text2term.map_terms returns.
+
+    Unlike text2term, which fits its TF-IDF weights on the source terms together with the target labels, the inverse
+    document frequencies are fitted on the target labels only. Character n-grams of a source term that no target label
+    has cannot match any label, but they still count towards the norm of the term's vector, weighted as n-grams that
+    occur in no label. The score of a mapping thus depends only on the trait and the target ontology, and not on the
+    other traits being mapped, so that the mappings of a trait can be cached and reused by later builds whatever traits
+    they map. Scores can differ slightly from text2term's, which change whenever the list of source terms changes.
+
+    With workers > 1, the source terms are split into shards that are matched against the target ontology labels in a
+    pool of worker processes. The ontology is loaded once, and its TF-IDF matrix is sent once to each worker. Each
+    source term is matched independently of the others, so the results are the same as those of a serial run.
+
+    Given an OntologySnapshotStore, the terms collected from each version of the target ontology are saved in the
+    store, so that the ontology is only parsed by the first build that uses that version.
+    """
+
+    def __init__(self, target_ontology, base_iris=(), min_score=0.3, max_mappings=3, excl_deprecated=False,
+                 cache=None, workers=1, snapshot_store=None, ontology_version=""):
+        self.target_ontology = target_ontology
+        self.base_iris = tuple(base_iris)
+        self.min_score = min_score
+        self.max_mappings = max_mappings
+        self.excl_deprecated = excl_deprecated
+        self.cache = cache
+        self.workers = workers
+        self.snapshot_store = snapshot_store
+        self.ontology_version = ontology_version
+        self._target_labels = None
+        self._target_terms = None
+        self._vectorizer = None
+        self._target_matrix = None
+        self._curies = {}
+
+    def get_context(self):
+        """
+        Get a hash of everything other than a source term itself that its mappings depend on: the target ontology and
+        its version, the mapping parameters and the text2term version (which collects the target labels)
+        """
+        context = {"target_ontology": self.target_ontology, "ontology_version": self.ontology_version,
+                   "base_iris": list(self.base_iris),
+                   "min_score": self.min_score, "max_mappings": self.max_mappings,
+                   "excl_deprecated": self.excl_deprecated, "text2term": TEXT2TERM_VERSION, "idf": "target_labels"}
+        return hashlib.sha256(json.dumps(context, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def map_terms(self, source_terms, source_term_ids=(), output_file=""):
+        """
+        Map the given source terms to the target ontology
+        :param source_terms: list of source terms
+        :param source_term_ids: list of identifiers of the source terms. If not given, identifiers are generated
+        :param output_file: if given, the mappings are saved to this CSV file (replacing any existing file) in the
+            same format as text2term's
+        :return: data frame of mappings, as returned by text2term.map_terms
+        """
+        source_terms = list(source_terms)
+        source_term_ids = list(source_term_ids)
+        if len(source_term_ids) != len(source_terms):
+            source_term_ids = onto_utils.generate_iris(len(source_terms))
+        normalized_terms = onto_utils.normalize_list(source_terms)
+        unique_terms = list(dict.fromkeys(normalized_terms))
+        context = self.get_context()
+        trait_mappings = self.cache.get(context, unique_terms) if self.cache is not None else {}
+        terms_to_map = [term for term in unique_terms if term not in trait_mappings]
+        print(f"...{len(source_terms)} source terms, {len(unique_terms)} unique after normalization, "
+              f"{len(unique_terms) - len(terms_to_map)} found in mapping cache "
+              f"({(len(unique_terms) - len(terms_to_map)) / max(len(unique_terms), 1):.1%} hit rate), "
+              f"{len(terms_to_map)} to map")
+        if len(terms_to_map) > 0:
+            new_mappings = self._map_unique_terms(terms_to_map)
+            if self.cache is not None:
+                self.cache.put(context, new_mappings)
+            trait_mappings.update(new_mappings)
+        mappings_df = self._get_mappings_df(source_terms, source_term_ids, normalized_terms, trait_mappings)
+        if output_file != "":
+            self._save_mappings(mappings_df, output_file, source_terms)
+        return mappings_df
+
+    # Get the top mappings of each of the given (normalized) terms
+    def _map_unique_terms(self, terms_to_map):
+        target_terms = self._load_target_terms()[1]
+        target_matrix = self._get_target_matrix()
+        start = time.time()
+        source_matrix = self._get_source_matrix(terms_to_map)
+        results = self._get_top_candidates(source_matrix, target_matrix)
+        trait_mappings = {}
+        for row, term in enumerate(terms_to_map):
+            mappings, iris = [], set()
+            for column, score in zip(results.indices[results.indptr[row]:results.indptr[row + 1]],
+                                     results.data[results.indptr[row]:results.indptr[row + 1]]):
+                if len(mappings) == self.max_mappings:
+                    break
+                target_term = target_terms[column]
+                if target_term.iri not in iris:
+                    mappings.append((target_term.label, target_term.iri, float(score)))
+                    iris.add(target_term.iri)
+            trait_mappings[term] = mappings
+        print(f"...mapped {len(terms_to_map)} terms ({time.time() - start:.1f} seconds"
+              f"{f', {self.workers} workers' if self.workers > 1 else ''})")
+        return trait_mappings
+
+    # Get the labels/synonyms of the target ontology terms and the terms they belong to. The ontology is loaded once,
+    #  or, with a snapshot store, once per ontology version
+    def _load_target_terms(self):
+        if self._target_labels is None:
+            if self.snapshot_store is None:
+                ontology_terms = self._collect_target_terms()
+            else:
+                parameters = json.dumps([TEXT2TERM_VERSION, list(self.base_iris), self.excl_deprecated])
+                artifact_name = "text2term_terms-" + hashlib.sha256(parameters.encode("utf-8")).hexdigest()[:16]
+                ontology_terms = self.snapshot_store.get_artifact(self.target_ontology, self.ontology_version,
+                                                                  artifact_name, self._collect_target_terms)
+            if len(ontology_terms) == 0:
+                raise RuntimeError("Could not find any terms in the given ontology.")
+            tfidf_mapper = TFIDFMapper(ontology_terms)
+            self._target_labels, self._target_terms = tfidf_mapper.target_labels, tfidf_mapper.target_terms
+        return self._target_labels, self._target_terms
+
+    # Get the TF-IDF vectors of the target labels, as the (normalized) columns of a sparse matrix. The vectorizer that
+    #  computes them is kept to compute the vectors of source terms with the same inverse document frequencies
+    def _get_target_matrix(self):
+        if self._target_matrix is None:
+            target_labels = self._load_target_terms()[0]
+            self._vectorizer = TfidfVectorizer(analyzer=ANALYZER, ngram_range=NGRAM_RANGE, norm=None)
+            target_matrix = normalize(self._vectorizer.fit_transform(target_labels))
+            self._target_matrix = target_matrix.transpose().tocsr()
+        return self._target_matrix
+
+    # Get the TF-IDF vectors of the given source terms, as the rows of a sparse matrix. N-grams that no target label
+    #  has are not in the vectorizer's vocabulary, so they are added to the norm of each vector separately, with the
+    #  inverse document frequency of an n-gram that occurs in no label (as computed by TfidfVectorizer)
+    def _get_source_matrix(self, terms):
+        source_matrix = self._vectorizer.transform(terms).tocsr()
+        vocabulary = self._vectorizer.vocabulary_
+        analyzer = self._vectorizer.build_analyzer()
+        unseen_idf = np.log(1 + self._target_matrix.shape[1]) + 1
+        unseen_squares = [sum(count ** 2 for ngram, count in Counter(analyzer(term)).items() if ngram not in vocabulary)
+                          for term in terms]
+        squares = np.asarray(source_matrix.multiply(source_matrix).sum(axis=1)).ravel()
+        norms = np.sqrt(squares + np.array(unseen_squares, dtype=float) * unseen_idf ** 2)
+        norms[norms == 0] = 1
+        return scipy.sparse.diags(1 / norms).dot(source_matrix).tocsr()
+
+    # Save the given mappings to a CSV file in text2term's format, with the same header comment lines
+    def _save_mappings(self, mappings_df, output_file, source_terms):
+        if os.path.dirname(output_file):
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with open(output_file, "w") as file_out:
+            file_out.write(f"# Date and time run: {datetime.datetime.now()}\n")
+            file_out.write(f"# Target Ontology: {self.target_ontology}\n")
+            file_out.write(f"# Text2term version: {TEXT2TERM_VERSION}\n")
+            file_out.write(f"# Minimum Score: {self.min_score:.2f}\n")
+            file_out.write(f"# Mapper: {Mapper.TFIDF.value}\n")
+            file_out.write(f"# Base IRIs: {self.base_iris}\n")
+            file_out.write(f"# Max Mappings: {self.max_mappings}\n")
+            file_out.write("# Term Type: classes\n")
+            file_out.write(f"# Deprecated Terms {'Excluded' if self.excl_deprecated else 'Included'}\n")
+            file_out.write("# Unmapped Terms Excluded\n")
+            file_out.write(f"# Of {len(source_terms)} entries, {mappings_df[TermMapping.SRC_TERM_ID].nunique()} were "
+                           f"successfully mapped to {mappings_df[TermMapping.TGT_TERM_IRI].nunique()} unique terms\n")
+            mappings_df.to_csv(file_out, index=False)
+
+    def _collect_target_terms(self):
+        return OntologyTermCollector().get_ontology_terms(self.target_ontology, base_iris=self.base_iris,
+                                                          exclude_deprecated=self.excl_deprecated,
+                                                          term_type="classes")
+
+    # Get the (up to CANDIDATES_PER_TERM) most similar target labels of each source term, as a sparse matrix of
+    #  similarity scores with a row per source term and a column per target label
+    def _get_top_candidates(self, source_matrix, target_matrix):
+        row_count = source_matrix.shape[0]
+        if self.workers <= 1 or row_count < 2:
+            return _get_top_candidates(source_matrix, target_matrix, self.min_score)
+        shard_size = -(-row_count // (self.workers * SHARDS_PER_WORKER))
+        shards = [source_matrix[shard_start:shard_start + shard_size]
+                  for shard_start in range(0, row_count, shard_size)]
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_set_worker_target_matrix,
+                                 initargs=(target_matrix,)) as executor:
+            shard_results = list(executor.map(_get_worker_top_candidates, shards, repeat(self.min_score)))
+        return scipy.sparse.vstack(shard_results, format="csr")
+
+    # Fan the mappings of each normalized term out to all the source terms (and IDs) it was normalized from. Unlike
+    #  text2term, which skips consecutive repetitions of a source term, every source term ID gets its mappings
+    def _get_mappings_df(self, source_terms, source_term_ids, normalized_terms, trait_mappings):
+        rows = []
+        for source_term, source_term_id, normalized_term in zip(source_terms, source_term_ids, normalized_terms):
+            for label, iri, score in trait_mappings[normalized_term]:
+                rows.append((source_term_id, source_term, label, self._get_curie(iri), iri, score))
+        mappings_df = pd.DataFrame(rows, columns=[TermMapping.SRC_TERM_ID, TermMapping.SRC_TERM,
+                                                  TermMapping.TGT_TERM_LBL, TermMapping.TGT_TERM_CURIE,
+                                                  TermMapping.TGT_TERM_IRI, TermMapping.MAPPING_SCORE])
+        mappings_df[TermMapping.MAPPING_SCORE] = mappings_df[TermMapping.MAPPING_SCORE].astype(float).round(decimals=3)
+        mappings_df[TAGS_COL] = NO_TAGS
+        return mappings_df
+
+    def _get_curie(self, iri):
+        if iri not in self._curies:
+            self._curies[iri] = onto_utils.curie_from_iri(iri)
+        return self._curies[iri]
+
+
+def _get_top_candidates(source_matrix, target_matrix, min_score):
+    return ct.awesome_cossim_topn(source_matrix, target_matrix, ntop=CANDIDATES_PER_TERM,
+                                  lower_bound=min_score).tocsr()
+
+
+# Target ontology label matrix of the current worker process, set once when the worker starts
+_worker_target_matrix = None
+
+
+def _set_worker_target_matrix(target_matrix):
+    global _worker_target_matrix
+    _worker_target_matrix = target_matrix
+
+
+def _get_worker_top_candidates(source_matrix, min_score):
+    return _get_top_candidates(source_matrix, _worker_target_matrix, min_score)
+
+
+# Time the matching of the given source terms against the given target ontology with each of the given numbers of
+#  worker processes, and check that the mappings are the same as those of the serial run. The ontology is loaded and
+#  its labels vectorized once, before timing
+def benchmark_trait_mapping(target_ontology, source_terms, worker_counts=(1, 2, 4, 8), **mapper_arguments):
+    mapper = TraitMapper(target_ontology, **mapper_arguments)
+    start = time.time()
+    mapper._get_target_matrix()
+    print(f"Loaded {target_ontology} ({time.time() - start:.1f} seconds)")
+    normalized_terms = onto_utils.normalize_list(source_terms)
+    unique_terms = list(dict.fromkeys(normalized_terms))
+    timings = {}
+    serial_mappings = None
+    for workers in worker_counts:
+        mapper.workers = workers
+        start = time.time()
+        trait_mappings = mapper._map_unique_terms(unique_terms)
+        timings[workers] = time.time() - start
+        if serial_mappings is None:
+            serial_mappings = trait_mappings
+        matches = trait_mappings == serial_mappings
+        print(f"\t{workers} worker(s): {timings[workers]:.1f} seconds for {len(unique_terms)} unique terms "
+              f"({timings[worker_counts[0]] / max(timings[workers], 1e-9):.1f}x), "
+              f"{'same' if matches else 'DIFFERENT'} mappings")
+    return timings
+
+
+if __name__ == "__main__":
+    metadata = pd.read_csv(sys.argv[2] if len(sys.argv) > 2 else "../resources/opengwas_metadata.tsv", sep="\t")
+    benchmark_trait_mapping(target_ontology=sys.argv[1] if len(sys.argv) > 1 else
+                            "http://www.ebi.ac.uk/efo/releases/v3.57.0/efo.owl",
+                            source_terms=metadata["trait"].dropna().tolist(),
+                            base_iris=("http://www.ebi.ac.uk/efo/", "http://purl.obolibrary.org/obo/MONDO",
+                                       "http://purl.obolibrary.org/obo/HP", "http://www.orpha.net/ORDO",
+                                       "http://purl.obolibrary.org/obo/DOID"),
+                            min_score=0.6, max_mappings=1, excl_deprecated=True)
@@ -0,0 +1,55 @@
+import os
+import sys
+import sqlite3
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import generate_ontology_tables
+from benchmark_suite import generate_semsql_database, generate_opengwas_tables
+from generate_ontology_tables import get_semsql_tables_for_ontology
+from build_database import import_df_to_db, configure_build_connection, finalize_database
+from metadata_facets import get_typed_metadata_table
+from generate_mapping_report import get_term_resources_from_edges, get_mapping_counts_from_term_resources
+
+INDEXED_COLUMNS = {"opengwas_mappings": ["MappedTermCURIE", "SourceTermID"],
+                   "efo_edges": ["Subject", ("Object", "Subject")],
+                   "efo_entailed_edges": ["Subject", ("Object", "Subject")]}
+
+
+def build_synthetic_search_database(folder, term_count=300, record_count=3000, seed=0):
+    """
+    Build a search database, as benchmark_suite.run_benchmarks does, from a synthetic SemanticSQL ontology database
+    and synthetic OpenGWAS metadata and mappings. The metadata have an 'ncase' column that is only given for the
+    records of about a third of the traits, and is null for all of the first records (by ID)
+    :return: path to the search database, and the metadata, mappings and labels data frames it was built from
+    """
+    semsql_db_file = os.path.join(folder, "synthetic.db")
+    search_db_file = os.path.join(folder, "synthetic_search.db")
+    generate_semsql_database(semsql_db_file, term_count, seed=seed)
+    generate_ontology_tables._curie_normalizer = None
+    edges_df, entailed_edges_df, labels_df, _, synonyms_df, _ = get_semsql_tables_for_ontology(
+        ontology_url=Path(semsql_db_file).resolve().as_uri(), ontology_name="SYNTHETIC", db_output_folder=folder,
+        cache_folder=os.path.join(folder, "semsql_cache"))
+    metadata_df, mappings_df = generate_opengwas_tables(labels_df, record_count, seed=seed)
+    ncase = np.random.default_rng(seed).integers(100, 10000, size=record_count)
+    metadata_df["ncase"] = np.where(metadata_df["trait"].str.len() % 3 == 0, ncase, None)
+    metadata_df.loc[metadata_df["id"] < sorted(metadata_df["id"])[record_count // 10], "ncase"] = None
+    metadata_df = get_typed_metadata_table(metadata_df)
+    _, term_resources_df = get_term_resources_from_edges(mappings_df=mappings_df, terms_df=labels_df,
+                                                         edges_df=edges_df, source_term_id_col="SourceTermID",
+                                                         mapped_term_iri_col="MappedTermIRI",
+                                                         resources=metadata_df["id"])
+    counts_df = get_mapping_counts_from_term_resources(term_resources_df)
+    connection = sqlite3.connect(search_db_file)
+    configure_build_connection(connection)
+    tables = {"opengwas_metadata": metadata_df, "opengwas_mappings": mappings_df, "efo_edges": edges_df,
+              "efo_entailed_edges": entailed_edges_df, "efo_synonyms": synonyms_df,
+              "efo_labels": pd.merge(labels_df, counts_df, on="IRI")}
+    for table_name, table_df in tables.items():
+        import_df_to_db(connection, data_frame=table_df, table_name=table_name)
+    finalize_database(connection, indexed_columns=INDEXED_COLUMNS)
+    connection.close()
+    return search_db_file, metadata_df, mappings_df, labels_df
@@ -0,0 +1,83 @@
+import os
+import sys
+import sqlite3
+import unittest
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from build_database import import_df_to_db
+from compact_schema import compact_database, drop_compact_table, get_encoded_table_name, TERMS_TABLE
+
+EDGES_DF = pd.DataFrame({"Subject": ["EFO:0000002", "EFO:0000003", "EFO:0000003"],
+                         "Object": ["EFO:0000001", "EFO:0000001", "EFO:0000002"]})
+LABELS_DF = pd.DataFrame({"Subject": ["EFO:0000001", "EFO:0000002", "EFO:0000003"],
+                          "Object": ["disease", "cancer", "lung cancer"],
+                          "IRI": [f"http://www.ebi.ac.uk/efo/EFO_000000{index}" for index in (1, 2, 3)]})
+MAPPINGS_DF = pd.DataFrame({"SourceTermID": ["ukb-a-1", "ukb-a-2"], "SourceTerm": ["Lung cancer", "Cancer"],
+                            "MappedTermLabel": ["lung cancer", "cancer"],
+                            "MappedTermCURIE": ["EFO:0000003", "EFO:0000002"],
+                            "MappedTermIRI": ["http://www.ebi.ac.uk/efo/EFO_0000003",
+                                              "http://www.ebi.ac.uk/efo/EFO_0000002"],
+                            "MappingScore": [1.0, 1.0]})
+
+
+class CompactSchemaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+
+    def tearDown(self):
+        self.connection.close()
+
+    def _get_objects(self):
+        return dict(self.connection.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view')"))
+
+    def _read(self, table_name):
+        return pd.read_sql(f"SELECT * FROM {table_name} ORDER BY 1, 2", self.connection)
+
+    def _import_tables(self):
+        import_df_to_db(self.connection, EDGES_DF, "efo_edges")
+        import_df_to_db(self.connection, LABELS_DF, "efo_labels")
+        import_df_to_db(self.connection, MAPPINGS_DF, "opengwas_mappings")
+
+    def test_import_table_again(self):
+        import_df_to_db(self.connection, EDGES_DF, "efo_edges")
+        import_df_to_db(self.connection, EDGES_DF.head(1), "efo_edges")
+        self.assertEqual(self._get_objects(), {"efo_edges": "table"})
+        self.assertEqual(len(self._read("efo_edges")), 1)
+
+    def test_drop_compact_table_leaves_tables(self):
+        self.connection.execute(f"CREATE TABLE {TERMS_TABLE} (id INTEGER)")
+        import_df_to_db(self.connection, EDGES_DF, "efo_edges")
+        drop_compact_table(self.connection, "efo_edges")
+        drop_compact_table(self.connection, "missing_table")
+        self.assertEqual(self._get_objects(), {TERMS_TABLE: "table", "efo_edges": "table"})
+
+    def test_import_tables_again_into_compact_database(self):
+        self._import_tables()
+        compact_database(self.connection, "opengwas", ["efo"])
+        objects = self._get_objects()
+        self.assertEqual(objects["efo_edges"], "view")
+        self.assertEqual(objects[get_encoded_table_name("opengwas_mappings")], "table")
+        pd.testing.assert_frame_equal(self._read("efo_edges"), EDGES_DF)
+
+        # The terms dictionary is kept while other tables are encoded, and dropped with the last encoded table
+        import_df_to_db(self.connection, MAPPINGS_DF, "opengwas_mappings")
+        objects = self._get_objects()
+        self.assertEqual(objects["opengwas_mappings"], "table")
+        self.assertNotIn(get_encoded_table_name("opengwas_mappings"), objects)
+        self.assertIn(TERMS_TABLE, objects)
+        pd.testing.assert_frame_equal(self._read("efo_labels"), LABELS_DF)
+        self._import_tables()
+        self.assertEqual(self._get_objects(), {"efo_edges": "table", "efo_labels": "table",
+                                               "opengwas_mappings": "table"})
+
+        # A database built again is compacted again, with the same rows
+        compact_database(self.connection, "opengwas", ["efo"])
+        self.assertEqual(self._get_objects()["opengwas_mappings"], "view")
+        pd.testing.assert_frame_equal(self._read("opengwas_mappings"), MAPPINGS_DF)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import os
+import sys
+import gzip
+import hashlib
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from download_cache import DownloadCache
+
+
+class _FileServer:
+    """
+    Local HTTP stand-in for a file server such as the SemanticSQL S3 bucket. It serves a single file with an ETag, and
+    honors If-None-Match, Range and If-Range headers. The first interrupt_after bytes of the next full response are
+    sent before the connection is closed, as in an interrupted download
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.interrupt_after = None
+        self.requests = []  # (status, request headers) of each request
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/ontology.db.gz"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def etag(self):
+        return '"' + hashlib.sha256(self.content).hexdigest()[:16] + '"'
+
+    def set_content(self, content):
+        self.content = content
+
+    def handle(self, handler):
+        headers = dict(handler.headers)
+        if handler.headers.get("If-None-Match") == self.etag:
+            self.requests.append((304, headers))
+            handler.send_response(304)
+            handler.end_headers()
+            return
+        start = 0
+        range_header = handler.headers.get("Range")
+        if range_header is not None and handler.headers.get("If-Range") in (None, self.etag):
+            start = int(range_header.split("=")[1].rstrip("-"))
+        status = 206 if start > 0 else 200
+        self.requests.append((status, headers))
+        handler.send_response(status)
+        handler.send_header("ETag", self.etag)
+        handler.send_header("Content-Length", str(len(self.content) - start))
+        if status == 206:
+            handler.send_header("Content-Range", f"bytes {start}-{len(self.content) - 1}/{len(self.content)}")
+        handler.end_headers()
+        if status == 200 and self.interrupt_after is not None:
+            handler.wfile.write(self.content[:self.interrupt_after])
+            handler.wfile.flush()
+            handler.close_connection = True
+            self.interrupt_after = None
+            return
+        handler.wfile.write(self.content[start:])
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class DownloadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.content = os.urandom(200000)
+        self.server = _FileServer(gzip.compress(self.content))
+
+    def tearDown(self):
+        self.server.close()
+        self.folder.cleanup()
+
+    def _read(self, file):
+        with open(file, "rb") as file_in:
+            return file_in.read()
+
+    def test_conditional_refetch(self):
+        cache = DownloadCache(self.folder.name)
+        cached_file = cache.get(self.server.url)
+        self.assertEqual(self._read(cached_file), self.content)
+        self.assertEqual(cache.get(self.server.url), cached_file)
+        self.assertEqual([status for status, _ in self.server.requests], [200, 304])
+        self.assertEqual(self.server.requests[1][1].get("If-None-Match"), self.server.etag)
+
+        # A changed file is downloaded again, into a new object named after its checksum
+        new_content = os.urandom(1000)
+        self.server.set_content(gzip.compress(new_content))
+        new_file = cache.get(self.server.url)
+        self.assertNotEqual(new_file, cached_file)
+        self.assertEqual(self._read(new_file), new_content)
+        self.assertEqual([status for status, _ in self.server.requests], [200, 304, 200])
+
+    def test_resume_partial_download(self):
+        cache = DownloadCache(self.folder.name, chunk_size=4096)
+        self.server.interrupt_after = len(self.server.content) // 2
+        with self.assertRaises(Exception):
+            cache.get(self.server.url)
+        partial_files = os.listdir(os.path.join(self.folder.name, "partial"))
+        self.assertEqual(len(partial_files), 1)
+
+        cached_file = cache.get(self.server.url)
+        self.assertEqual(self._read(cached_file), self.content)
+        status, headers = self.server.requests[-1]
+        self.assertEqual(status, 206)
+        self.assertEqual(headers.get("If-Range"), self.server.etag)
+        self.assertGreater(int(headers["Range"].split("=")[1].rstrip("-")), 0)
+        self.assertEqual(os.listdir(os.path.join(self.folder.name, "partial")), [])
+        self.assertEqual(Path(cached_file).name, hashlib.sha256(self.server.content).hexdigest())
+
+    def test_caches_sharing_folder(self):
+        caches = [DownloadCache(self.folder.name) for _ in range(2)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            cached_files = list(executor.map(lambda index: caches[index % 2].get(self.server.url), range(4)))
+        self.assertEqual(len(set(cached_files)), 1)
+        self.assertEqual(self._read(cached_files[0]), self.content)
+        statuses = [status for status, _ in self.server.requests]
+        self.assertEqual(statuses.count(200), 1)  # the other requests wait for the download, and are then conditional
+        self.assertEqual(statuses.count(304), 3)
+        self.assertEqual(os.listdir(os.path.join(self.folder.name, "objects")), [Path(cached_files[0]).name])
+
+
+class CachedSemanticSqlDatabaseTest(unittest.TestCase):
+
+    def test_tables_are_read_without_changing_cached_file(self):
+        from benchmark_suite import generate_semsql_database
+        from generate_ontology_tables import get_semsql_tables_for_ontology, get_semsql_labels_for_ontology
+        with tempfile.TemporaryDirectory() as folder:
+            semsql_db_file = os.path.join(folder, "synthetic.db")
+            generate_semsql_database(semsql_db_file, 500)
+            cache_folder = os.path.join(folder, "cache")
+            tables = get_semsql_tables_for_ontology(Path(semsql_db_file).as_uri(), "SYNTHETIC", db_output_folder=folder,
+                                                    cache_folder=cache_folder, include_disease_locations=True)
+            self.assertGreater(tables[2]["DiseaseLocation"].notna().sum(), 0)
+            cached_file = DownloadCache(cache_folder).get(Path(semsql_db_file).as_uri())
+            get_semsql_labels_for_ontology(cached_file, include_disease_locations=True)
+            with open(cached_file, "rb") as file_in:
+                self.assertEqual(hashlib.sha256(file_in.read()).hexdigest(), Path(cached_file).name)
+
+
+if __name__ == "__main__":
+    unittest.main()
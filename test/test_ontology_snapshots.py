@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from ontology_snapshots import OntologySnapshotStore, _read_metadata, _write_metadata
+
+ONTOLOGY_XML = """<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#"
+         xmlns:owl="http://www.w3.org/2002/07/owl#" xml:base="http://example.org/test.owl">
+  <owl:Ontology rdf:about="http://example.org/test.owl"/>
+  <owl:Class rdf:about="http://example.org/test.owl#Disease"/>
+  <owl:Class rdf:about="http://example.org/test.owl#Pancreatitis">
+    <rdfs:subClassOf rdf:resource="http://example.org/test.owl#Disease"/>
+  </owl:Class>
+</rdf:RDF>
+"""
+
+
+class OntologySnapshotStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.ontology_file = os.path.join(self.folder.name, "test.owl")
+        with open(self.ontology_file, "w") as file_out:
+            file_out.write(ONTOLOGY_XML)
+        self.store = OntologySnapshotStore(os.path.join(self.folder.name, "snapshots"))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_open_snapshot(self):
+        for _ in range(2):  # the snapshot is created, then reused
+            world, ontology = self.store.open(self.ontology_file, "v1")
+            self.assertEqual(sorted(owl_class.name for owl_class in ontology.classes()), ["Disease", "Pancreatitis"])
+            world.close()
+        metadata = _read_metadata(self.store.get_snapshot_folder(self.ontology_file, "v1"))
+        self.assertEqual(metadata["base_iri"], "http://example.org/test.owl#")
+
+    def test_other_versions_are_deleted_under_lock(self):
+        first_folder = self.store.get_snapshot_folder(self.ontology_file, "v1")
+        activated = threading.Event()
+
+        def activate_other_version():
+            self.store.get_snapshot_folder(self.ontology_file, "v2")
+            activated.set()
+        # While another build holds the lock (e.g. to write the metadata of v1), v2 waits to delete v1
+        with self.store._lock("test"):
+            thread = threading.Thread(target=activate_other_version)
+            thread.start()
+            self.assertFalse(activated.wait(0.5))
+            self.assertTrue(os.path.isdir(first_folder))
+        thread.join(timeout=10)
+        self.assertTrue(activated.is_set())
+        self.assertFalse(os.path.isdir(first_folder))
+
+    def test_metadata_written_by_other_build_are_kept(self):
+        snapshot_folder = self.store.get_snapshot_folder(self.ontology_file, "v1")
+        metadata = _read_metadata(snapshot_folder)
+        # Another build created the same snapshot after this one read its metadata
+        _write_metadata(snapshot_folder, dict(metadata, base_iri="http://example.org/test.owl#", parse_seconds=1.5))
+        self.store._create_quadstore(snapshot_folder, metadata, "test")
+        self.assertEqual(_read_metadata(snapshot_folder)["parse_seconds"], 1.5)
+        # Activating the same version again does not rewrite the metadata
+        self.store.get_snapshot_folder(self.ontology_file, "v1")
+        self.assertEqual(_read_metadata(snapshot_folder)["base_iri"], "http://example.org/test.owl#")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from pubmed_references import PubMedReferenceFetcher, update_references_table, get_not_found_file
+
+ARTICLE_XML = "<PubmedArticle><MedlineCitation><PMID>{pmid}</PMID><Article><Journal><JournalIssue><PubDate>" \
+              "<Year>2020</Year></PubDate></JournalIssue><Title>Journal {pmid}</Title></Journal>" \
+              "<ArticleTitle>Title {pmid}</ArticleTitle><Abstract><AbstractText>Abstract {pmid}</AbstractText>" \
+              "</Abstract></Article></MedlineCitation></PubmedArticle>"
+
+
+class _EfetchServer:
+    """
+    Local stand-in for the E-utilities efetch endpoint. It returns the articles of the requested PMIDs that it knows
+    (leaving out the others, as PubMed does), fails the first failures_left requests with 503, and fails any request
+    for a PMID in rejected_pmids with 400. Successful responses are sent after delay seconds
+    """
+
+    def __init__(self, pmids):
+        self.pmids = set(pmids)
+        self.failures_left = 0
+        self.rejected_pmids = set()
+        self.delay = 0
+        self.requests = []  # (status, requested PMIDs) of each request
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/entrez/eutils/efetch.fcgi"
+        self._lock = threading.Lock()
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def handle(self, handler):
+        parameters = urllib.parse.parse_qs(handler.rfile.read(int(handler.headers["Content-Length"])).decode())
+        pmids = parameters["id"][0].split(",")
+        with self._lock:
+            if self.failures_left > 0:
+                self.failures_left -= 1
+                status = 503
+            else:
+                status = 400 if self.rejected_pmids.intersection(pmids) else 200
+            self.requests.append((status, pmids))
+        body = b""
+        if status == 200:
+            time.sleep(self.delay)
+            articles = "".join(ARTICLE_XML.format(pmid=pmid) for pmid in pmids if pmid in self.pmids)
+            body = f"<PubmedArticleSet>{articles}</PubmedArticleSet>".encode()
+        handler.send_response(status)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class PubMedReferencesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.references_file = os.path.join(self.folder.name, "references.tsv")
+        self.pmids = [str(pmid) for pmid in range(1001, 1008)]
+        self.server = _EfetchServer(self.pmids)
+
+    def tearDown(self):
+        self.server.close()
+        self.folder.cleanup()
+
+    def _get_fetcher(self, workers=2):
+        return PubMedReferenceFetcher(api_key="test", efetch_url=self.server.url, batch_size=3, workers=workers,
+                                      max_retries=3, retry_backoff=0.01, timeout=10)
+
+    def _update(self, pmids, workers=2):
+        return update_references_table(self.references_file, pmids, "pmid", fetcher=self._get_fetcher(workers))
+
+    def test_batches_and_not_found_pmids(self):
+        references_df = self._update(self.pmids + ["9999", "0"])
+        self.assertEqual(sorted(references_df["pmid"].astype(str)), self.pmids)
+        self.assertEqual(references_df.set_index("pmid").loc[1003, "Title"], "Title 1003")
+        self.assertEqual(sorted(len(pmids) for _, pmids in self.server.requests), [2, 3, 3])
+        with open(get_not_found_file(self.references_file)) as file_in:
+            self.assertEqual(file_in.read().split(), ["9999"])
+
+        # Neither the fetched nor the not found PMIDs are requested again
+        self.assertEqual(len(self._update(self.pmids + ["9999"])), len(self.pmids))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retry_with_backoff(self):
+        self.server.failures_left = 2
+        articles = self._get_fetcher().fetch_batch(["1001", "1002"])
+        self.assertEqual(articles[0][:3], ("1001", "Journal 1001", "Title 1001"))
+        self.assertEqual([status for status, _ in self.server.requests], [503, 503, 200])
+
+        self.server.failures_left = 5  # more than max_retries
+        with self.assertRaises(urllib.error.HTTPError):
+            self._get_fetcher().fetch_batch(["1001"])
+
+        self.server.failures_left = 0
+        self.server.rejected_pmids = {"1001"}  # errors other than rate limits and server errors are not retried
+        request_count = len(self.server.requests)
+        with self.assertRaises(urllib.error.HTTPError):
+            self._get_fetcher().fetch_batch(["1001"])
+        self.assertEqual(len(self.server.requests), request_count + 1)
+
+    def test_resume_interrupted_update(self):
+        self.server.rejected_pmids = {"1004"}  # the second batch fails
+        with self.assertRaises(urllib.error.HTTPError):
+            self._update(self.pmids, workers=1)
+        self.server.rejected_pmids = set()
+        request_count = len(self.server.requests)
+        references_df = self._update(self.pmids, workers=1)
+        self.assertEqual(sorted(references_df["pmid"].astype(str)), self.pmids)
+        resumed_pmids = sorted(pmid for _, pmids in self.server.requests[request_count:] for pmid in pmids)
+        self.assertNotIn("1001", resumed_pmids)
+        self.assertIn("1004", resumed_pmids)
+        self.assertFalse(os.path.isfile(get_not_found_file(self.references_file)) and
+                         os.path.getsize(get_not_found_file(self.references_file)) > 0)
+
+    def test_completed_batches_are_saved_when_a_batch_fails(self):
+        # The first batch fails while the other two are still being fetched
+        self.server.rejected_pmids = {"1001"}
+        self.server.delay = 0.2
+        with self.assertRaises(urllib.error.HTTPError):
+            self._update(self.pmids, workers=3)
+        self.server.rejected_pmids = set()
+        request_count = len(self.server.requests)
+        references_df = self._update(self.pmids, workers=3)
+        self.assertEqual(sorted(references_df["pmid"].astype(str)), self.pmids)
+        resumed_pmids = sorted(pmid for _, pmids in self.server.requests[request_count:] for pmid in pmids)
+        self.assertEqual(resumed_pmids, ["1001", "1002", "1003"])
+
+
+if __name__ == "__main__":
+    unittest.main()
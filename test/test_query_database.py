@@ -0,0 +1,114 @@
+import os
+import sys
+import tempfile
+import unittest
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # Arrow export is optional
+    pyarrow = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_search_database import build_synthetic_search_database
+from query_database import SearchEngine, get_result_columns
+
+METADATA_COLUMNS = ["population", "ncase"]
+
+
+class SearchEngineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.database_file, cls.metadata_df, _, _ = build_synthetic_search_database(cls.folder.name)
+        cls.engine = SearchEngine(cls.database_file)
+        # The terms with the most resources (with their subclasses)
+        cls.search_terms = [row[0] for row in cls.engine.connection.execute(
+            "SELECT Subject FROM efo_labels ORDER BY Direct + Inherited DESC, Subject LIMIT 3")]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.close()
+        cls.folder.cleanup()
+
+    def _get_all_results(self, search_term, include_subclasses, metadata_columns=()):
+        rows = [row for batch in self.engine.iter_resources_annotated_with_term(
+            search_term, include_subclasses, batch_size=10 ** 6, metadata_columns=metadata_columns) for row in batch]
+        return pd.DataFrame(rows, columns=get_result_columns(metadata_columns))
+
+    def test_keyset_pages_make_up_all_results(self):
+        for search_term in self.search_terms + ["EFO:9999999"]:
+            for include_subclasses in (False, True):
+                results_df = self.engine.resources_annotated_with_term(search_term, include_subclasses)
+                all_results_df = self._get_all_results(search_term, include_subclasses, METADATA_COLUMNS)
+                pd.testing.assert_frame_equal(all_results_df[results_df.columns].sort_values(["OpenGWASID",
+                                                                                             "OntologyTermID"])
+                                              .reset_index(drop=True),
+                                              results_df.sort_values(["OpenGWASID", "OntologyTermID"])
+                                              .reset_index(drop=True), check_dtype=False)
+                for limit in (13, 100):
+                    pages, cursor = [], None
+                    while True:
+                        page_df, cursor = self.engine.get_results_page(search_term, include_subclasses, limit=limit,
+                                                                       cursor=cursor, metadata_columns=METADATA_COLUMNS)
+                        self.assertLessEqual(len(page_df), limit)
+                        pages.append(page_df)
+                        if cursor is None:
+                            break
+                    pd.testing.assert_frame_equal(pd.concat(pages, ignore_index=True), all_results_df,
+                                                  check_dtype=False)
+        self.assertGreater(len(self.engine.resources_annotated_with_term(self.search_terms[0])), 100)
+
+    def test_results_page_limit(self):
+        for limit in (0, -1):
+            with self.assertRaises(ValueError):
+                self.engine.get_results_page(self.search_terms[0], limit=limit)
+        with self.assertRaises(ValueError):
+            self.engine.get_results_page(self.search_terms[0], cursor="not a cursor")
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_export_arrow_with_schema_of_column_types(self):
+        search_term = self.search_terms[0]
+        all_results_df = self._get_all_results(search_term, True, METADATA_COLUMNS)
+        # The first batch of rows has no values of ncase, and later ones do
+        batch_size = 20
+        self.assertTrue(all_results_df["ncase"][:batch_size].isna().all())
+        self.assertTrue(all_results_df["ncase"][batch_size:].notna().any())
+        output_file = os.path.join(self.folder.name, "results.arrow")
+        row_count = self.engine.export_resources_annotated_with_term(output_file, search_term, file_format="arrow",
+                                                                     batch_size=batch_size,
+                                                                     metadata_columns=METADATA_COLUMNS)
+        self.assertEqual(row_count, len(all_results_df))
+        with pyarrow.ipc.open_file(output_file) as reader:
+            table = reader.read_all()
+            self.assertGreater(reader.num_record_batches, 1)
+        expected_types = {"OpenGWASID": pyarrow.string(), "MappingConfidence": pyarrow.float64(),
+                          "population": pyarrow.string(), "ncase": pyarrow.int64()}
+        for column, arrow_type in expected_types.items():
+            self.assertEqual(table.schema.field(column).type, arrow_type)
+        pd.testing.assert_frame_equal(table.to_pandas(), all_results_df, check_dtype=False)
+
+        # An empty result has the same schema
+        empty_file = os.path.join(self.folder.name, "empty.arrow")
+        row_count = self.engine.export_resources_annotated_with_term(empty_file, "EFO:9999999", file_format="arrow",
+                                                                     metadata_columns=METADATA_COLUMNS)
+        self.assertEqual(row_count, 0)
+        with pyarrow.ipc.open_file(empty_file) as reader:
+            self.assertEqual(reader.schema, table.schema)
+
+    def test_export_tsv(self):
+        search_term = self.search_terms[1]
+        output_file = os.path.join(self.folder.name, "results.tsv")
+        row_count = self.engine.export_resources_annotated_with_term(output_file, search_term, batch_size=7,
+                                                                     metadata_columns=METADATA_COLUMNS)
+        exported_df = pd.read_csv(output_file, sep="\t")
+        self.assertEqual(row_count, len(exported_df))
+        pd.testing.assert_frame_equal(exported_df, self._get_all_results(search_term, True, METADATA_COLUMNS),
+                                      check_dtype=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import sys
+import pickle
+import tempfile
+import unittest
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from result_cache import SearchResultCache
+
+
+def _get_result(row_count, term="EFO:0000001"):
+    return pd.DataFrame({"OpenGWASID": [f"ukb-a-{index}" for index in range(row_count)],
+                         "OntologyTermID": [term] * row_count,
+                         "MappingConfidence": [0.9 if index % 2 else None for index in range(row_count)],
+                         "Records": pd.array(range(row_count), dtype="Int64")})
+
+
+def _get_key(version, term):
+    return version, "resources_annotated_with_term", (term,), True, False, ()
+
+
+class SearchResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.folder.name, "search.cache")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = SearchResultCache(max_entries=2)
+        cache.set_version("v1")
+        for term in ("EFO:1", "EFO:2"):
+            cache.get_or_compute(_get_key("v1", term), lambda: _get_result(3, term))
+        cache.get_or_compute(_get_key("v1", "EFO:1"), lambda: self.fail("EFO:1 should be cached"))
+        cache.get_or_compute(_get_key("v1", "EFO:3"), lambda: _get_result(3))
+        self.assertEqual(set(key[2] for key in cache._entries), {("EFO:1",), ("EFO:3",)})
+        self.assertEqual(cache.get_metrics()["evictions"], 1)
+
+        # Results larger than the memory bound are not cached
+        small_cache = SearchResultCache(max_bytes=int(_get_result(10).memory_usage(deep=True).sum()))
+        small_cache.get_or_compute(_get_key(None, "EFO:1"), lambda: _get_result(100))
+        self.assertEqual(len(small_cache), 0)
+
+    def test_entries_of_other_versions_are_dropped(self):
+        cache = SearchResultCache()
+        cache.set_version("v1")
+        result = cache.get_or_compute(_get_key("v1", "EFO:1"), lambda: _get_result(5))
+        result.loc[0, "OpenGWASID"] = "changed"  # results are copies of the cached ones
+        pd.testing.assert_frame_equal(cache.get_or_compute(_get_key("v1", "EFO:1"), None), _get_result(5))
+        cache.set_version("v2")
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get_metrics()["invalidations"], 1)
+        cache.put(_get_key("v1", "EFO:1"), _get_result(5))
+        self.assertEqual(len(cache), 0)
+
+    def test_result_computed_during_version_change_is_not_cached(self):
+        cache = SearchResultCache()
+        cache.set_version("v1")
+
+        def compute():
+            cache.set_version("v2")  # e.g. the database was rebuilt while the search ran
+            return _get_result(5)
+        self.assertEqual(len(cache.get_or_compute(_get_key("v1", "EFO:1"), compute)), 5)
+        self.assertEqual(len(cache), 0)
+        cache.get_or_compute(_get_key("v2", "EFO:1"), lambda: _get_result(5))
+        self.assertEqual(len(cache), 1)
+
+    def test_save_and_load(self):
+        cache = SearchResultCache(cache_file=self.cache_file)
+        cache.set_version("v1")
+        results = {term: _get_result(index + 1, term) for index, term in enumerate(["EFO:1", "EFO:2"])}
+        filters = (("any_of", ("EFO:1", "EFO:2")), ("all_of", ()), ("none_of", ("EFO:3",)))
+        results_key = ("v1", "combine_searches", (), True, False, filters)
+        for term, result in results.items():
+            cache.get_or_compute(_get_key("v1", term), lambda: result)
+        cache.get_or_compute(results_key, lambda: _get_result(0))
+        cache.save()
+        self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o600)
+
+        loaded_cache = SearchResultCache(cache_file=self.cache_file)
+        loaded_cache.set_version("v1")
+        self.assertEqual(len(loaded_cache), 3)
+        for term, result in results.items():
+            pd.testing.assert_frame_equal(loaded_cache.get_or_compute(_get_key("v1", term), None), result)
+        pd.testing.assert_frame_equal(loaded_cache.get_or_compute(results_key, None), _get_result(0))
+
+    def test_cache_files_that_are_not_json_are_ignored(self):
+        with open(self.cache_file, "wb") as file_out:
+            pickle.dump({"version": "0.1.0", "entries": [(_get_key("v1", "EFO:1"), _get_result(1))]}, file_out)
+        self.assertEqual(len(SearchResultCache(cache_file=self.cache_file)), 0)
+
+    @unittest.skipUnless(hasattr(os, "getuid") and os.getuid() == 0, "changing the owner of a file requires root")
+    def test_cache_files_of_other_users_are_ignored(self):
+        cache = SearchResultCache(cache_file=self.cache_file)
+        cache.get_or_compute(_get_key(None, "EFO:1"), lambda: _get_result(1))
+        cache.save()
+        self.assertEqual(len(SearchResultCache(cache_file=self.cache_file)), 1)
+        os.chown(self.cache_file, 1, 1)
+        self.assertEqual(len(SearchResultCache(cache_file=self.cache_file)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
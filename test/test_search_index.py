@@ -0,0 +1,87 @@
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_search_database import build_synthetic_search_database
+from query_database import SearchEngine
+from search_index import SearchIndex
+from compact_schema import compact_database
+
+SEARCH_MODES = [(False, False), (True, False), (True, True)]
+
+
+# Sort the rows of a search result, whose order is only defined up to ties, and make its values comparable
+def _sort_results(results_df):
+    results_df = results_df.astype(object).where(results_df.notna(), None)
+    return results_df.sort_values(list(results_df.columns), key=lambda column: column.astype(str)) \
+        .reset_index(drop=True)
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.database_file = build_synthetic_search_database(cls.folder.name)[0]
+        cls.engine = SearchEngine(cls.database_file)
+        with sqlite3.connect(cls.database_file) as connection:
+            cls.search_index = SearchIndex.from_database(connection)
+        # Terms with many, few and no resources, and a term that is not in the database
+        terms = [row[0] for row in cls.engine.connection.execute(
+            "SELECT Subject FROM efo_labels ORDER BY Direct + Inherited DESC, Subject")]
+        cls.search_terms = terms[:3] + terms[len(terms) // 2:len(terms) // 2 + 3] + terms[-2:] + ["EFO:9999999"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.close()
+        cls.folder.cleanup()
+
+    def _assert_same_searches(self, engine):
+        for include_subclasses, direct_subclasses_only in SEARCH_MODES:
+            for search_term in self.search_terms:
+                expected_df = self.engine.resources_annotated_with_term(search_term, include_subclasses,
+                                                                        direct_subclasses_only)
+                results_df = engine.resources_annotated_with_term(search_term, include_subclasses,
+                                                                  direct_subclasses_only)
+                self.assertEqual(list(results_df.columns), list(expected_df.columns))
+                pd.testing.assert_frame_equal(_sort_results(results_df), _sort_results(expected_df))
+                self.assertEqual(engine.count_resources(search_term, include_subclasses, direct_subclasses_only),
+                                 self.engine.count_resources(search_term, include_subclasses, direct_subclasses_only))
+            expected_df = self.engine.search_terms(self.search_terms, include_subclasses, direct_subclasses_only)
+            results_df = engine.search_terms(self.search_terms, include_subclasses, direct_subclasses_only)
+            self.assertEqual(list(results_df.columns), list(expected_df.columns))
+            pd.testing.assert_frame_equal(_sort_results(results_df), _sort_results(expected_df))
+            # Rows are in the order of the search terms
+            self.assertEqual(list(dict.fromkeys(results_df["QueryTerm"])),
+                             list(dict.fromkeys(expected_df["QueryTerm"])))
+
+    def test_index_searches_are_same_as_sql(self):
+        self.assertGreater(len(self.engine.resources_annotated_with_term(self.search_terms[0])), 100)
+        with SearchEngine(self.database_file, search_index=self.search_index) as engine:
+            self._assert_same_searches(engine)
+
+    def test_saved_index_searches_are_same_as_sql(self):
+        index_file = os.path.join(self.folder.name, "search.idx")
+        self.search_index.save(index_file)
+        loaded_index = SearchIndex.load(index_file)
+        self.assertEqual(loaded_index.metadata, self.search_index.metadata)
+        with SearchEngine(self.database_file, search_index=loaded_index) as engine:
+            self._assert_same_searches(engine)
+
+    def test_compact_database_searches_are_same_as_sql(self):
+        compact_file = os.path.join(self.folder.name, "compact.db")
+        shutil.copyfile(self.database_file, compact_file)
+        with sqlite3.connect(compact_file) as connection:
+            compact_database(connection, "opengwas", ["efo"])
+        with SearchEngine(compact_file) as engine:
+            self._assert_same_searches(engine)
+
+
+if __name__ == "__main__":
+    unittest.main()
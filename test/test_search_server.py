@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import threading
+import unittest
+import pandas as pd
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_search_database import build_synthetic_search_database
+from query_database import SearchEngine
+from search_server import SearchServer, _read_headers, MAX_BATCH_TERMS, MAX_PAGE_SIZE
+
+
+class SearchServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.database_file = build_synthetic_search_database(cls.folder.name)[0]
+        cls.engine = SearchEngine(cls.database_file)
+        cls.search_terms = [row[0] for row in cls.engine.connection.execute(
+            "SELECT Subject FROM efo_labels ORDER BY Direct + Inherited DESC, Subject LIMIT 5")]
+        # The server runs on an event loop of its own thread
+        cls.loop = asyncio.new_event_loop()
+        threading.Thread(target=cls.loop.run_forever, daemon=True).start()
+        cls.server = cls._run_coroutine(SearchServer(cls.database_file, port=0, workers=2).start())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._run_coroutine(cls.server.close())
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.engine.close()
+        cls.folder.cleanup()
+
+    @classmethod
+    def _run_coroutine(cls, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, cls.loop).result(timeout=60)
+
+    # Send the given raw requests to the server, over one connection each, and get the status and JSON body of each
+    #  response
+    def _request(self, *requests):
+        async def send(request):
+            reader, writer = await asyncio.open_connection(self.server.host, self.server.port)
+            try:
+                writer.write(request.encode("latin-1"))
+                await writer.drain()
+                status = int((await reader.readline()).split(b" ")[1])
+                headers = await _read_headers(reader)
+                return status, json.loads(await reader.readexactly(int(headers["content-length"])))
+            finally:
+                writer.close()
+
+        async def send_all():
+            return await asyncio.gather(*(send(request) for request in requests))
+        return self._run_coroutine(send_all())
+
+    def _get(self, *targets):
+        return self._request(*(f"GET {target} HTTP/1.1\r\nConnection: close\r\n\r\n" for target in targets))
+
+    # Get all the pages of results of the given target, following the cursor of each page
+    def _get_all_pages(self, target):
+        rows, cursor = [], None
+        while True:
+            [(status, body)] = self._get(target + (f"&cursor={quote(cursor)}" if cursor else ""))
+            self.assertEqual(status, 200, body)
+            rows += body["results"]
+            cursor = body["next_cursor"]
+            if cursor is None:
+                return pd.DataFrame(rows)
+
+    def test_malformed_request_line(self):
+        [(status, body)] = self._request("GARBAGE\r\n\r\n")
+        self.assertEqual(status, 400)
+        self.assertIn("error", body)
+
+    def test_search_pages(self):
+        results_df = self._get_all_pages(f"/search?term={self.search_terms[0]}&limit=17")
+        expected_df = self.engine.resources_annotated_with_term(self.search_terms[0])
+        self.assertEqual(len(results_df), len(expected_df))
+        self.assertEqual(set(zip(results_df["OpenGWASID"], results_df["OntologyTermID"])),
+                         set(zip(expected_df["OpenGWASID"], expected_df["OntologyTermID"])))
+
+    def test_batch_pages(self):
+        terms = ",".join(self.search_terms)
+        results_df = self._get_all_pages(f"/batch?terms={terms}&limit=500")
+        expected_df = self.engine.search_terms(self.search_terms)
+        self.assertGreater(len(expected_df), 1000)
+        self.assertEqual(len(results_df), len(expected_df))
+        self.assertEqual(sorted(map(tuple, results_df[expected_df.columns].astype(str).values)),
+                         sorted(map(tuple, expected_df.astype(str).values)))
+        # Rows are in the order of the search terms
+        positions = results_df["QueryTerm"].map({term: index for index, term in enumerate(self.search_terms)})
+        self.assertTrue(positions.is_monotonic_increasing)
+
+        [(status, body)] = self._get(f"/batch?terms={terms}")
+        self.assertEqual(len(body["results"]), 100)
+        self.assertIsNotNone(body["next_cursor"])
+
+    def test_invalid_parameters(self):
+        too_many_terms = ",".join(f"EFO:{index:07d}" for index in range(MAX_BATCH_TERMS + 1))
+        responses = self._get(f"/batch?terms={too_many_terms}", "/batch?terms=EFO:0000001&cursor=invalid",
+                              f"/batch?terms=EFO:0000001&limit={MAX_PAGE_SIZE + 1}",
+                              "/search?term=EFO:0000001&limit=0", "/search", "/unknown")
+        self.assertEqual([status for status, _ in responses], [400, 400, 400, 400, 400, 404])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import random
+import tempfile
+import unittest
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from subclass_closure import SubclassClosure, compare_with_semsql
+
+
+def _get_edges_df(edges):
+    return pd.DataFrame(list(edges), columns=["Subject", "Object"], dtype=object)
+
+
+# Get the reflexive transitive closure of the given edges (and terms) by a search from each class
+def _get_reference_closure(edges, terms=()):
+    parents = {}
+    for child, parent in edges:
+        parents.setdefault(child, set()).add(parent)
+    closure = set()
+    for term in set(terms) | {term for edge in edges for term in edge}:
+        ancestors, pending = {term}, [term]
+        while pending:
+            for parent in parents.get(pending.pop(), ()):
+                if parent not in ancestors:
+                    ancestors.add(parent)
+                    pending.append(parent)
+        closure.update((term, ancestor) for ancestor in ancestors)
+    return closure
+
+
+def _get_closure_edges(closure):
+    return set(closure.get_entailed_edges().itertuples(index=False, name=None))
+
+
+class SubclassClosureTest(unittest.TestCase):
+
+    # A and B are equivalent (a cycle), C, D and E make another cycle below B, and G is below F and D
+    EDGES = {("B", "A"), ("A", "B"), ("C", "B"), ("D", "C"), ("E", "D"), ("C", "E"), ("G", "F"), ("G", "D")}
+
+    def test_closure_of_cyclic_graph(self):
+        closure = SubclassClosure(_get_edges_df(self.EDGES), terms=["F", "H"])
+        self.assertEqual(_get_closure_edges(closure), _get_reference_closure(self.EDGES, terms=["H"]))
+        self.assertEqual(sorted(closure.get_ancestors("E")), ["A", "B", "C", "D", "E"])
+        self.assertEqual(sorted(closure.get_ancestors("A")), ["A", "B"])
+        self.assertEqual(closure.get_ancestors("H"), ["H"])
+        self.assertEqual(closure.get_ancestors("unknown"), [])
+
+    def test_update_is_same_as_rebuild(self):
+        closure = SubclassClosure(_get_edges_df(self.EDGES))
+        # Break the cycle of A and B, add a new class below E, and make F a parent of A (through a new cycle)
+        removed, added = {("A", "B")}, {("I", "E"), ("A", "F"), ("F", "G")}
+        closure.update(added_edges_df=_get_edges_df(added), removed_edges_df=_get_edges_df(removed))
+        edges = (self.EDGES - removed) | added
+        self.assertEqual(_get_closure_edges(closure), _get_reference_closure(edges))
+        self.assertEqual(_get_closure_edges(closure), _get_closure_edges(SubclassClosure(_get_edges_df(edges))))
+
+    def test_random_updates_are_same_as_rebuilds(self):
+        generator = random.Random(0)
+        terms = [f"T{index}" for index in range(40)]
+        # Mostly edges from later to earlier terms (a DAG), with a few that go back up and make cycles
+        edges = {(terms[child], terms[generator.randrange(child)]) for child in range(1, len(terms))}
+        edges |= {(terms[generator.randrange(10)], terms[generator.randrange(20, 40)]) for _ in range(3)}
+        closure = SubclassClosure(_get_edges_df(edges))
+        known_terms = set(terms)  # classes stay in the closure when their last edge is removed
+        for _ in range(30):
+            removed = set(generator.sample(sorted(edges), 2))
+            added = {(generator.choice(terms + ["N1", "N2"]), generator.choice(terms)) for _ in range(2)}
+            closure.update(added_edges_df=_get_edges_df(added), removed_edges_df=_get_edges_df(removed))
+            edges = (edges - removed) | added
+            known_terms.update(term for edge in added for term in edge)
+            self.assertEqual(_get_closure_edges(closure), _get_reference_closure(edges, terms=known_terms))
+
+    def test_closure_is_same_as_semsql_entailed_edges(self):
+        from benchmark_suite import generate_semsql_database
+        with tempfile.TemporaryDirectory() as folder:
+            semsql_db_file = os.path.join(folder, "synthetic.db")
+            generate_semsql_database(semsql_db_file, 500)
+            self.assertEqual(compare_with_semsql(semsql_db_file), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from text2term import onto_utils
+from text2term.term import OntologyTerm
+from trait_mapping import TraitMapper, TraitMappingCache, ANALYZER, NGRAM_RANGE
+
+TARGET_LABELS = {"http://www.ebi.ac.uk/efo/EFO_0000001": ["body mass index"],
+                 "http://www.ebi.ac.uk/efo/EFO_0000002": ["type 2 diabetes mellitus", "type ii diabetes"],
+                 "http://www.ebi.ac.uk/efo/EFO_0000003": ["systolic blood pressure"],
+                 "http://www.ebi.ac.uk/efo/EFO_0000004": ["diastolic blood pressure"],
+                 "http://www.ebi.ac.uk/efo/EFO_0000005": ["height"],
+                 "http://www.ebi.ac.uk/efo/EFO_0000006": ["coronary artery disease"]}
+
+
+class _TestTraitMapper(TraitMapper):
+    """ TraitMapper whose target ontology terms are given, rather than collected from an ontology file """
+
+    def __init__(self, **arguments):
+        super().__init__(target_ontology="test_ontology", min_score=0.3, max_mappings=2, **arguments)
+        self.collections = 0
+
+    def _collect_target_terms(self):
+        self.collections += 1
+        return {iri: OntologyTerm(iri, labels=labels[:1], synonyms=labels[1:]) for iri, labels in TARGET_LABELS.items()}
+
+
+class TraitMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def _get_scores(self, mappings_df):
+        return {(term, iri): score for term, iri, score in
+                mappings_df[["Source Term", "Mapped Term IRI", "Mapping Score"]].itertuples(index=False)}
+
+    def test_scores_do_not_depend_on_other_source_terms(self):
+        mapper = _TestTraitMapper()
+        scores = self._get_scores(mapper.map_terms(["Body mass index", "Systolic blood pressure", "Diabetes type 2",
+                                                    "Body mass index", "height (cm)"]))
+        self.assertIn(("Body mass index", "http://www.ebi.ac.uk/efo/EFO_0000001"), scores)
+        self.assertEqual(scores[("Body mass index", "http://www.ebi.ac.uk/efo/EFO_0000001")], 1.0)
+        for term in ("Systolic blood pressure", "Diabetes type 2", "height (cm)"):
+            single_scores = self._get_scores(_TestTraitMapper().map_terms([term]))
+            self.assertEqual(single_scores, {key: score for key, score in scores.items() if key[0] == term})
+
+    def test_mappings_of_repeated_traits_are_fanned_out_to_all_ids(self):
+        mappings_df = _TestTraitMapper().map_terms(["Body mass index", "Body mass index", "Height", "body mass index"],
+                                                   source_term_ids=["ukb-a-1", "ukb-a-1_AFR", "ukb-a-2", "ukb-a-3"])
+        self.assertEqual(mappings_df.groupby("Source Term ID")["Mapped Term IRI"].first().to_dict(),
+                         {"ukb-a-1": "http://www.ebi.ac.uk/efo/EFO_0000001",
+                          "ukb-a-1_AFR": "http://www.ebi.ac.uk/efo/EFO_0000001",
+                          "ukb-a-2": "http://www.ebi.ac.uk/efo/EFO_0000005",
+                          "ukb-a-3": "http://www.ebi.ac.uk/efo/EFO_0000001"})
+
+    def test_scores_use_inverse_document_frequencies_of_target_labels(self):
+        mapper = _TestTraitMapper()
+        term = onto_utils.normalize_list(["height (cm)"])[0]
+        target_labels = mapper._load_target_terms()[0]
+        # Vectors over all n-grams of the labels and the term, with the IDF of the labels (unseen n-grams have df=0)
+        counts = TfidfVectorizer(analyzer=ANALYZER, ngram_range=NGRAM_RANGE, use_idf=False, norm=None)
+        counts.fit(target_labels + [term])
+        document_frequencies = np.asarray((counts.transform(target_labels) > 0).sum(axis=0)).ravel()
+        idf = np.log((1 + len(target_labels)) / (1 + document_frequencies)) + 1
+        term_vector = counts.transform([term]).toarray()[0] * idf
+        label_vector = counts.transform(["height"]).toarray()[0] * idf
+        expected_score = term_vector.dot(label_vector) / np.linalg.norm(term_vector) / np.linalg.norm(label_vector)
+        mappings = mapper._map_unique_terms([term])[term]
+        self.assertEqual(mappings[0][1], "http://www.ebi.ac.uk/efo/EFO_0000005")
+        self.assertAlmostEqual(mappings[0][2], expected_score)
+
+    def test_cached_mappings_are_reused_for_other_source_terms(self):
+        cache = TraitMappingCache(os.path.join(self.folder.name, "cache.db"))
+        mappings_df = _TestTraitMapper(cache=cache).map_terms(["Body mass index", "Coronary artery disease"])
+
+        mapper = _TestTraitMapper(cache=cache)
+        mapper._map_unique_terms = lambda terms: self.fail(f"{terms} should be in the cache")
+        cached_df = mapper.map_terms(["Coronary artery disease", "Body mass index", "Body mass index"])
+        self.assertEqual(self._get_scores(cached_df), self._get_scores(mappings_df))
+        self.assertEqual(mapper.collections, 0)
+
+        # A new trait is mapped, and a new ontology version or mapping parameter needs new mappings
+        mapper = _TestTraitMapper(cache=cache)
+        mapper.map_terms(["Body mass index", "Height"])
+        self.assertEqual(mapper.collections, 1)
+        self.assertEqual(cache.get(mapper.get_context(), ["body mass index", "height", "weight"]).keys(),
+                         {"body mass index", "height"})
+        new_version_mapper = _TestTraitMapper(cache=cache, ontology_version="2")
+        self.assertEqual(cache.get(new_version_mapper.get_context(), ["body mass index"]), {})
+        cache.close()
+
+    def test_mappings_file_has_text2term_header(self):
+        output_file = os.path.join(self.folder.name, "mappings", "test_mappings.csv")
+        source_terms = ["Body mass index", "Systolic blood pressure", "unmappable"]
+        mappings_df = _TestTraitMapper().map_terms(source_terms, output_file=output_file)
+        _TestTraitMapper().map_terms(source_terms, output_file=output_file)  # the file is replaced, not appended to
+        with open(output_file) as file_in:
+            header = [line for line in file_in if line.startswith("#")]
+        self.assertEqual(len(header), 11)
+        self.assertEqual(header[4], "# Mapper: tfidf\n")
+        self.assertEqual(header[-1], f"# Of 3 entries, 2 were successfully mapped to "
+                                     f"{mappings_df['Mapped Term IRI'].nunique()} unique terms\n")
+        saved_df = pd.read_csv(output_file, comment="#")
+        self.assertEqual(saved_df.columns.tolist(), mappings_df.columns.tolist())
+        self.assertEqual(len(saved_df), len(mappings_df))
+
+
+if __name__ == "__main__":
+    unittest.main()